@@ -0,0 +1,95 @@
+"""
+Load generator for the agent server (diffusion_edf/agent_server.py).
+Closed-loop clients, each with its own Pyro proxy, send requests back to back with the scenes of a demo test set,
+and the latency percentiles and throughput are reported for each concurrency level.
+Run the server first (set serving_configs.mode in server.yaml to compare the 'sequential' and 'batched' modes), e.g.,
+
+    python diffusion_edf/agent_server.py --configs-root-dir configs/panda_mug --init-nameserver
+    python benchmarks/agent_server_load.py --testset-dir demo/panda_mug_on_hanger_test --concurrency 1 2 4 8
+"""
+import argparse
+import threading
+import time
+from typing import List, Tuple
+
+import torch
+import Pyro5.api
+
+import edf_interface.pyro # Registers the serializers of edf_interface.data
+from edf_interface.data import SE3, PointCloud, DemoDataset
+
+
+def run_clients(uri: str, method: str, requests: List[Tuple[PointCloud, PointCloud, SE3]], task_name: str,
+                concurrency: int, n_requests: int) -> Tuple[List[float], float, int]:
+    latencies: List[float] = []
+    n_errors = 0
+    lock = threading.Lock()
+    counter = iter(range(n_requests))
+
+    def client():
+        nonlocal n_errors
+        with Pyro5.api.Proxy(uri) as proxy:
+            while True:
+                with lock:
+                    i = next(counter, None)
+                if i is None:
+                    return
+                scene_pcd, grasp_pcd, poses = requests[i % len(requests)]
+                t0 = time.perf_counter()
+                try:
+                    getattr(proxy, method)(scene_pcd=scene_pcd, grasp_pcd=grasp_pcd, current_poses=poses, task_name=task_name)
+                except Exception as e:
+                    print(f"Request {i} failed: {e}")
+                    with lock:
+                        n_errors += 1
+                    continue
+                with lock:
+                    latencies.append(time.perf_counter() - t0)
+
+    threads = [threading.Thread(target=client) for _ in range(concurrency)]
+    t0 = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return latencies, time.perf_counter() - t0, n_errors
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Latency and throughput of the agent server under concurrent clients')
+    parser.add_argument('--server-name', type=str, default='agent')
+    parser.add_argument('--nameserver-host-ip', type=str, default='localhost')
+    parser.add_argument('--nameserver-host-port', type=int, default=9090)
+    parser.add_argument('--testset-dir', type=str, default='demo/panda_mug_on_hanger_test')
+    parser.add_argument('--task-type', type=str, default='pick', choices=['pick', 'place'])
+    parser.add_argument('--method', type=str, default='request_trajectories', choices=['request_trajectories', 'denoise'])
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 2, 4, 8])
+    parser.add_argument('--n-requests', type=int, default=32, help='Number of requests of each concurrency level')
+    parser.add_argument('--n-poses', type=int, default=10, help='Number of initial poses of each request')
+    parser.add_argument('--n-demos', type=int, default=4, help='Number of test demos to draw the requests from')
+    args = parser.parse_args()
+
+    uri = Pyro5.api.locate_ns(host=args.nameserver_host_ip, port=args.nameserver_host_port).lookup(args.server_name)
+    testset = DemoDataset(dataset_dir=args.testset_dir)
+    T0 = SE3(poses=torch.tensor([[1., 0., 0., 0., 0., 0., 0.3]]).repeat(args.n_poses, 1))
+    requests = []
+    for i in range(min(args.n_demos, len(testset))):
+        demo = testset[i][0 if args.task_type == 'pick' else 1]
+        requests.append((demo.scene_pcd, demo.grasp_pcd, T0))
+
+    run_clients(uri=uri, method=args.method, requests=requests, task_name=args.task_type, concurrency=1, n_requests=1)   # Warmup
+    print(f"{args.method} | {args.task_type} | poses per request: {args.n_poses} | requests per level: {args.n_requests}")
+    print(f"{'clients':>7} | {'p50 (s)':>8} | {'p99 (s)':>8} | {'mean (s)':>8} | {'throughput (req/s)':>18} | {'errors':>6}")
+    for concurrency in args.concurrency:
+        latencies, elapsed, n_errors = run_clients(uri=uri, method=args.method, requests=requests, task_name=args.task_type,
+                                                   concurrency=concurrency, n_requests=args.n_requests)
+        if not latencies:
+            print(f"{concurrency:>7} | {'-':>8} | {'-':>8} | {'-':>8} | {0.:>18.2f} | {n_errors:>6}")
+            continue
+        latencies = torch.tensor(latencies, dtype=torch.float64)
+        p50, p99 = torch.quantile(latencies, torch.tensor([0.5, 0.99], dtype=torch.float64)).tolist()
+        print(f"{concurrency:>7} | {p50:>8.3f} | {p99:>8.3f} | {latencies.mean().item():>8.3f} | {len(latencies)/elapsed:>18.2f} | {n_errors:>6}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,81 @@
+"""
+Throughput of ScoreModelBase.sample_batched against sampling the scenes one after another, on synthetic scenes.
+The deterministic Heun integrator is used, so that both results can be compared.
+
+    python benchmarks/bench_batched_sampling.py --configs-root-dir configs/panda_mug/pick_highres --n-scenes 1 2 4 8
+"""
+import argparse
+import time
+from typing import List
+
+import torch
+
+from diffusion_edf.agent import load_inference_model
+from diffusion_edf.gnn_data import FeaturedPoints
+
+
+def synthetic_scene(n_points: int, device: str) -> FeaturedPoints:
+    bbox = torch.tensor([60., 60., 30.], device=device) # In centimeters, similar to our tabletop scenes
+    return FeaturedPoints(x=(torch.rand(n_points, 3, device=device) - torch.tensor([0.5, 0.5, 0.], device=device)) * bbox,
+                          f=torch.rand(n_points, 3, device=device),
+                          b=torch.zeros(n_points, device=device, dtype=torch.long))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark multi-scene batched sampling')
+    parser.add_argument('--configs-root-dir', type=str, default='configs/panda_mug/pick_highres')
+    parser.add_argument('--checkpoint-dir', type=str, default=None, help='Random weights if not given')
+    parser.add_argument('--device', type=str, default='cuda:0')
+    parser.add_argument('--n-scenes', type=int, nargs='+', default=[1, 2, 4, 8])
+    parser.add_argument('--n-poses', type=int, default=10, help='Number of poses per scene')
+    parser.add_argument('--n-scene-points', type=int, default=2000)
+    parser.add_argument('--n-grasp-points', type=int, default=300)
+    parser.add_argument('--n-steps', type=int, default=20, help='Number of steps of each diffusion schedule')
+    args = parser.parse_args()
+
+    torch.manual_seed(0)
+    model = load_inference_model(configs_root_dir=args.configs_root_dir, checkpoint_dir=args.checkpoint_dir, device=args.device, n_warmups=2)
+    diffusion_schedules = model.diffusion_schedules
+    sample_kwargs = dict(diffusion_schedules=diffusion_schedules,
+                         N_steps=[args.n_steps for _ in diffusion_schedules],
+                         timesteps=[0.02 for _ in diffusion_schedules],
+                         temperatures=1.0, integrator='deterministic_heun', retention='final_only')
+
+    print(f"poses per scene: {args.n_poses} | steps: {sum(sample_kwargs['N_steps'])}")
+    print(f"{'n_scenes':>8} | {'sequential (s)':>14} | {'batched (s)':>11} | {'speedup':>7} | {'poses/s':>9} | {'max diff':>9}")
+    for n_scenes in args.n_scenes:
+        T_seeds_list: List[torch.Tensor] = []
+        scene_pcd_multiscale_list: List[List[FeaturedPoints]] = []
+        grasp_pcd_list: List[FeaturedPoints] = []
+        with torch.no_grad():
+            for _ in range(n_scenes):
+                scene = synthetic_scene(args.n_scene_points, device=args.device)
+                grasp = synthetic_scene(args.n_grasp_points, device=args.device)
+                grasp = grasp._replace(x=grasp.x / 6.)
+                scene_pcd_multiscale_list.append(model.get_key_pcd_multiscale(scene))
+                grasp_pcd_list.append(model.get_query_pcd(grasp))
+                q = torch.randn(args.n_poses, 4, device=args.device)
+                T_seeds_list.append(torch.cat([q / q.norm(dim=-1, keepdim=True), scene.x[torch.randint(len(scene.x), (args.n_poses,))]], dim=-1))
+
+            if args.device.startswith('cuda'):
+                torch.cuda.synchronize()
+            t0 = time.perf_counter()
+            Ts_seq = [model.sample(T_seed=T_seed, scene_pcd_multiscale=scene_pcd_multiscale, grasp_pcd=grasp_pcd, **sample_kwargs)
+                      for T_seed, scene_pcd_multiscale, grasp_pcd in zip(T_seeds_list, scene_pcd_multiscale_list, grasp_pcd_list)]
+            if args.device.startswith('cuda'):
+                torch.cuda.synchronize()
+            t_seq = time.perf_counter() - t0
+
+            t0 = time.perf_counter()
+            Ts_batched = model.sample_batched(T_seeds_list=T_seeds_list, scene_pcd_multiscale_list=scene_pcd_multiscale_list,
+                                              grasp_pcd_list=grasp_pcd_list, **sample_kwargs)
+            if args.device.startswith('cuda'):
+                torch.cuda.synchronize()
+            t_batched = time.perf_counter() - t0
+
+        max_diff = max((Ts_b - Ts_s).abs().max().item() for Ts_b, Ts_s in zip(Ts_batched, Ts_seq))
+        print(f"{n_scenes:>8} | {t_seq:>14.2f} | {t_batched:>11.2f} | {t_seq/t_batched:>6.2f}x | {n_scenes*args.n_poses/t_batched:>9.1f} | {max_diff:>9.2e}")
+
+
+if __name__ == '__main__':
+    main()
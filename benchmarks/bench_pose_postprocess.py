@@ -0,0 +1,53 @@
+"""
+Cost of the pose post-processing of AgentService.denoise: the per-pose path (an SE3 and an unprocess_fn call for every pose)
+against the batched path (compose_pose_unprocess_fn on the whole (nFrames, nT, 7) tensor, then one SE3 per pose for the reply).
+
+    python benchmarks/bench_pose_postprocess.py --configs-root-dir configs/panda_mug --n-poses 10 100 500
+"""
+import argparse
+import os
+import time
+
+import yaml
+import torch
+
+from edf_interface.data import SE3
+from diffusion_edf import train_utils
+from diffusion_edf.agent import compose_pose_unprocess_fn
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the per-pose and batched pose post-processing')
+    parser.add_argument('--configs-root-dir', type=str, default='configs/panda_mug')
+    parser.add_argument('--n-poses', type=int, nargs='+', default=[10, 100, 500])
+    parser.add_argument('--n-frames', type=int, default=102, help="Frames of the returned trajectories (nSteps + 2 with the 'full' retention)")
+    parser.add_argument('--n-repeats', type=int, default=10)
+    args = parser.parse_args()
+
+    with open(os.path.join(args.configs_root_dir, 'preprocess.yaml')) as f:
+        unprocess_config = yaml.load(f, Loader=yaml.FullLoader)['unprocess_config']
+    unprocess_fn = train_utils.compose_proc_fn(preprocess_config=unprocess_config)
+    unprocess_poses = compose_pose_unprocess_fn(unprocess_config=unprocess_config)
+
+    print(f"frames: {args.n_frames} | repeats: {args.n_repeats}")
+    print(f"{'n_poses':>7} | {'per-pose (ms)':>13} | {'batched (ms)':>12} | {'speedup':>7} | {'max diff':>9}")
+    for n_poses in args.n_poses:
+        q = torch.randn(args.n_frames, n_poses, 4)
+        traj_tensors = torch.cat([q / q.norm(dim=-1, keepdim=True), torch.randn(args.n_frames, n_poses, 3) * 30.], dim=-1)
+
+        t0 = time.perf_counter()
+        for _ in range(args.n_repeats):
+            per_pose = [unprocess_fn(SE3(poses=traj_tensors[:, i])) for i in range(n_poses)]
+        t_per_pose = (time.perf_counter() - t0) / args.n_repeats
+
+        t0 = time.perf_counter()
+        for _ in range(args.n_repeats):
+            batched = [SE3(poses=Ts) for Ts in unprocess_poses(traj_tensors).unbind(dim=-2)]
+        t_batched = (time.perf_counter() - t0) / args.n_repeats
+
+        max_diff = max((Ts_b.poses - Ts_p.poses).abs().max().item() for Ts_b, Ts_p in zip(batched, per_pose))
+        print(f"{n_poses:>7} | {t_per_pose*1000:>13.2f} | {t_batched*1000:>12.2f} | {t_per_pose/t_batched:>6.1f}x | {max_diff:>9.2e}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+"""
+Throughput of the pre-fork mode of the agent server (serving_configs.n_processes) against the number of worker processes, on CPU.
+For each worker count, the server is started on a fresh nameserver port, loaded with closed-loop clients
+(as in agent_server_load.py, with as many clients as clients_per_worker times the workers), and stopped.
+Run it on a machine with at least as many cores as the largest worker count, e.g.,
+
+    python benchmarks/bench_prefork_scaling.py --configs-root-dir configs/panda_mug --testset-dir demo/panda_mug_on_hanger_test --n-processes 1 2 4 8
+"""
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+import torch
+import Pyro5.api
+import Pyro5.errors
+
+from edf_interface.data import SE3, DemoDataset
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from agent_server_load import run_clients
+
+
+def wait_for_server(process: subprocess.Popen, port: int, server_name: str, timeout_s: float) -> str:
+    t0 = time.time()
+    while time.time() - t0 < timeout_s:
+        if process.poll() is not None:
+            raise RuntimeError(f"The server exited with code {process.returncode}")
+        try:
+            return Pyro5.api.locate_ns(host='localhost', port=port).lookup(server_name)
+        except Pyro5.errors.PyroError:
+            time.sleep(1.)
+    raise TimeoutError(f"The server did not start within {timeout_s}s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Requests/s of the pre-forked agent server against the number of worker processes')
+    parser.add_argument('--configs-root-dir', type=str, default='configs/panda_mug')
+    parser.add_argument('--testset-dir', type=str, default='demo/panda_mug_on_hanger_test')
+    parser.add_argument('--task-type', type=str, default='pick', choices=['pick', 'place'])
+    parser.add_argument('--method', type=str, default='request_trajectories', choices=['request_trajectories', 'denoise'])
+    parser.add_argument('--n-processes', type=int, nargs='+', default=[1, 2, 4, 8])
+    parser.add_argument('--clients-per-worker', type=int, default=2)
+    parser.add_argument('--n-requests', type=int, default=32, help='Number of requests of each worker count')
+    parser.add_argument('--n-poses', type=int, default=10, help='Number of initial poses of each request')
+    parser.add_argument('--n-demos', type=int, default=4, help='Number of test demos to draw the requests from')
+    parser.add_argument('--port', type=int, default=9190, help='Nameserver port of the first run (incremented for each run)')
+    parser.add_argument('--startup-timeout-s', type=float, default=600.)
+    args = parser.parse_args()
+
+    testset = DemoDataset(dataset_dir=args.testset_dir)
+    T0 = SE3(poses=torch.tensor([[1., 0., 0., 0., 0., 0., 0.3]]).repeat(args.n_poses, 1))
+    requests = []
+    for i in range(min(args.n_demos, len(testset))):
+        demo = testset[i][0 if args.task_type == 'pick' else 1]
+        requests.append((demo.scene_pcd, demo.grasp_pcd, T0))
+
+    print(f"{args.method} | {args.task_type} | cores: {os.cpu_count()} | poses per request: {args.n_poses} | requests per run: {args.n_requests}")
+    print(f"{'workers':>7} | {'clients':>7} | {'p50 (s)':>8} | {'throughput (req/s)':>18} | {'scaling':>7} | {'errors':>6}")
+    base_throughput = None
+    for i, n_processes in enumerate(args.n_processes):
+        port = args.port + i
+        server = subprocess.Popen([sys.executable, 'diffusion_edf/agent_server.py', '--configs-root-dir', args.configs_root_dir,
+                                   '--init-nameserver', '--nameserver-host-ip', 'localhost', '--nameserver-host-port', str(port),
+                                   '--device', 'cpu', '--n-processes', str(n_processes)],
+                                  stdout=subprocess.DEVNULL)
+        try:
+            uri = wait_for_server(process=server, port=port, server_name='agent', timeout_s=args.startup_timeout_s)
+            concurrency = args.clients_per_worker * n_processes
+            run_clients(uri=uri, method=args.method, requests=requests, task_name=args.task_type, concurrency=concurrency, n_requests=concurrency)   # Warmup
+            latencies, elapsed, n_errors = run_clients(uri=uri, method=args.method, requests=requests, task_name=args.task_type,
+                                                       concurrency=concurrency, n_requests=args.n_requests)
+        finally:
+            server.terminate()
+            server.wait()
+        if not latencies:
+            print(f"{n_processes:>7} | {concurrency:>7} | {'-':>8} | {0.:>18.2f} | {'-':>7} | {n_errors:>6}")
+            continue
+        throughput = len(latencies) / elapsed
+        base_throughput = base_throughput or throughput
+        p50 = torch.tensor(latencies, dtype=torch.float64).median().item()
+        print(f"{n_processes:>7} | {concurrency:>7} | {p50:>8.3f} | {throughput:>18.2f} | {throughput/base_throughput:>6.2f}x | {n_errors:>6}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,58 @@
+"""
+Benchmark of diffusion_edf.spatial_index against torch_cluster.radius on CPU.
+
+    python benchmarks/bench_spatial_index.py --n-queries 5000 --r 3.5
+"""
+import argparse
+import time
+
+import torch
+from torch_cluster import radius
+
+from diffusion_edf.spatial_index import build_spatial_index, radius_query
+
+
+def timeit(fn, n_repeats: int) -> float:
+    fn() # warmup
+    t0 = time.perf_counter()
+    for _ in range(n_repeats):
+        fn()
+    return (time.perf_counter() - t0) / n_repeats
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark SpatialIndex against torch_cluster.radius')
+    parser.add_argument('--n-points', type=int, nargs='+', default=[1000, 10000, 100000])
+    parser.add_argument('--n-queries', type=int, default=5000)
+    parser.add_argument('--r', type=float, default=3.5, help='In centimeters')
+    parser.add_argument('--max-num-neighbors', type=int, default=1000)
+    parser.add_argument('--n-repeats', type=int, default=10)
+    args = parser.parse_args()
+
+    torch.manual_seed(0)
+    bbox = torch.tensor([60., 60., 30.]) # In centimeters, similar to our tabletop scenes
+    print(f"threads: {torch.get_num_threads()} | queries: {args.n_queries} | r: {args.r}")
+    print(f"{'n_points':>10} | {'build (ms)':>10} | {'index query (ms)':>16} | {'radius (ms)':>11} | {'speedup':>7} | {'n_edges':>9}")
+    for n_points in args.n_points:
+        x = torch.rand(n_points, 3) * bbox
+        batch_x = torch.zeros(n_points, dtype=torch.long)
+        y = torch.rand(args.n_queries, 3) * bbox
+        batch_y = torch.zeros(args.n_queries, dtype=torch.long)
+
+        index = build_spatial_index(points=x, batch=batch_x, cell_size=args.r)
+        edge_index = radius_query(index=index, y=y, r=args.r, batch_y=batch_y, max_num_neighbors=args.max_num_neighbors)
+        edge_radius = radius(x=x, y=y, r=args.r, batch_x=batch_x, batch_y=batch_y, max_num_neighbors=args.max_num_neighbors)
+        n_saturated = (torch.bincount(edge_radius[0], minlength=args.n_queries) >= args.max_num_neighbors).sum().item()
+        if n_saturated == 0:
+            key_index = (edge_index[0] * n_points + edge_index[1]).sort().values
+            key_radius = (edge_radius[0] * n_points + edge_radius[1]).sort().values
+            assert torch.equal(key_index, key_radius), "Edges do not match torch_cluster.radius"
+
+        t_build = timeit(lambda: build_spatial_index(points=x, batch=batch_x, cell_size=args.r), args.n_repeats)
+        t_query = timeit(lambda: radius_query(index=index, y=y, r=args.r, batch_y=batch_y, max_num_neighbors=args.max_num_neighbors), args.n_repeats)
+        t_radius = timeit(lambda: radius(x=x, y=y, r=args.r, batch_x=batch_x, batch_y=batch_y, max_num_neighbors=args.max_num_neighbors), args.n_repeats)
+        print(f"{n_points:>10} | {t_build*1000:>10.2f} | {t_query*1000:>16.2f} | {t_radius*1000:>11.2f} | {t_radius/t_query:>6.2f}x | {edge_index.shape[-1]:>9}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,112 @@
+"""
+Accuracy and CPU cost of the closed-form Wigner D matrices (l <= 2) of diffusion_edf.wigner against the Euler-angle path.
+
+Accuracy (float64, random rotations), asserted within the tolerances:
+    - closed form against wigner_D at the YXY Euler angles of the same quaternions 
+      (--atol-euler: the J matrices of e3nn that the Euler path uses are stored in float32),
+    - homomorphism D(q1 q2) = D(q1) D(q2) and orthogonality D D^T = I (--atol),
+    - equivariance of TransformFeatureQuaternion: rotating features by q1 q2 equals rotating by q2, then by q1,
+      and agreement with the Euler path (--atol-features, relative to the largest feature: 
+      its constant buffers are float32, hence errors around 1e-7).
+Cost: TransformFeatureQuaternion against the previous path (Euler angles, one D per irrep, torch.cat of the slices).
+
+    python benchmarks/bench_wigner.py --n-poses 1000 --n-points 64 --irreps 64x0e+32x1e+16x2e
+"""
+import argparse
+import time
+
+import torch
+
+from diffusion_edf import w3j
+from diffusion_edf.wigner import TransformFeatureQuaternion, wigner_D, wigner_D_from_quaternion, quat_to_angle_fast
+from diffusion_edf.transforms import quaternion_multiply, standardize_quaternion, random_quaternions
+
+
+def euler_path(module: TransformFeatureQuaternion, feature: torch.Tensor, q: torch.Tensor) -> torch.Tensor:
+    q = standardize_quaternion(q / torch.norm(q, dim=-1, keepdim=True))
+    angle = quat_to_angle_fast(q)
+    return torch.cat([transform(feature=feature, alpha=angle[0], beta=angle[1], gamma=angle[2]) for transform in module.transforms], dim=-1)
+
+
+def check_close(name: str, ref: torch.Tensor, out: torch.Tensor, atol: float, scale: float = 1.) -> float:
+    diff = (ref - out).abs().max().item() / scale
+    assert diff <= atol, f"{name}: difference {diff:.2e} exceeds {atol:.0e}"
+    return diff
+
+
+def accuracy(n: int, irreps: str, atol: float, atol_euler: float, atol_features: float):
+    q1 = random_quaternions(n, dtype=torch.float64)
+    q2 = random_quaternions(n, dtype=torch.float64)
+    q12 = quaternion_multiply(q1, q2)
+    print(f"{'l':>2} | {'vs Euler':>9} | {'D(q1q2)-D(q1)D(q2)':>18} | {'DD^T-I':>9}")
+    for l in (1, 2):
+        J = w3j._Jd[l].to(dtype=torch.float64)
+        angle = quat_to_angle_fast(standardize_quaternion(q1))
+        D_euler = wigner_D(l, angle[0], angle[1], angle[2], J)
+        D1, D2, D12 = (wigner_D_from_quaternion(l, q, J) for q in (q1, q2, q12))
+        eye = torch.eye(2*l+1, dtype=torch.float64).expand_as(D1)
+        diff_euler = check_close(f"l={l} | vs Euler", D_euler, D1, atol_euler)
+        diff_homomorphism = check_close(f"l={l} | homomorphism", D1 @ D2, D12, atol)
+        diff_orthogonality = check_close(f"l={l} | orthogonality", eye, D1 @ D1.transpose(-1, -2), atol)
+        print(f"{l:>2} | {diff_euler:>9.2e} | {diff_homomorphism:>18.2e} | {diff_orthogonality:>9.2e}")
+
+    module = TransformFeatureQuaternion(irreps).to(dtype=torch.float64)
+    feature = torch.randn(16, module.dim, dtype=torch.float64)
+    scale = feature.abs().max().item()
+    rotated_twice = torch.stack([module(module(feature, q2[i:i+1])[0], q1[i:i+1])[0] for i in range(min(n, 32))])
+    rotated_once = module(feature, q12[:min(n, 32)])
+    diff = check_close("equivariance", rotated_once, rotated_twice, atol_features, scale=scale)
+    print(f"equivariance of TransformFeatureQuaternion ({irreps}): {diff:.2e}")
+    diff = check_close("against the Euler path", euler_path(module, feature, q1), module(feature, q1), atol_features, scale=scale)
+    print(f"TransformFeatureQuaternion against the Euler path: {diff:.2e}")
+
+
+def timeit(fn, n_repeats: int, n_rounds: int = 3) -> float:
+    fn()
+    best = float('inf')
+    for _ in range(n_rounds):    # Best of the rounds, as a single round is easily disturbed at these sizes
+        t0 = time.perf_counter()
+        for _ in range(n_repeats):
+            fn()
+        best = min(best, (time.perf_counter() - t0) / n_repeats)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Closed-form Wigner D matrices against the Euler-angle path')
+    parser.add_argument('--n-poses', type=int, default=1000)
+    parser.add_argument('--n-points', type=int, nargs='+', default=[1, 16, 64])
+    parser.add_argument('--irreps', type=str, default='64x0e+32x1e+16x2e')
+    parser.add_argument('--n-repeats', type=int, default=20)
+    parser.add_argument('--n-threads', type=int, default=None)
+    parser.add_argument('--atol', type=float, default=1e-12)
+    parser.add_argument('--atol-euler', type=float, default=1e-7)
+    parser.add_argument('--atol-features', type=float, default=1e-6)
+    args = parser.parse_args()
+    if args.n_threads is not None:
+        torch.set_num_threads(args.n_threads)
+
+    accuracy(n=args.n_poses, irreps=args.irreps, atol=args.atol, atol_euler=args.atol_euler, atol_features=args.atol_features)
+
+    module = TransformFeatureQuaternion(args.irreps)
+    scripted = torch.jit.script(module)
+    q = random_quaternions(args.n_poses)
+    print(f"\nnT: {args.n_poses} | irreps: {args.irreps} | threads: {torch.get_num_threads()}")
+    print(f"{'op':>22} | {'nQ':>4} | {'Euler (ms)':>10} | {'closed form (ms)':>16} | {'speedup':>7}")
+    with torch.no_grad():
+        for l in (1, 2):
+            J = w3j._Jd[l]
+            def euler():
+                angle = quat_to_angle_fast(standardize_quaternion(q))
+                return wigner_D(l, angle[0], angle[1], angle[2], J)
+            t_euler, t_closed = timeit(euler, args.n_repeats), timeit(lambda: wigner_D_from_quaternion(l, q, J), args.n_repeats)
+            print(f"{f'D (l={l})':>22} | {'-':>4} | {t_euler*1000:>10.3f} | {t_closed*1000:>16.3f} | {t_euler/t_closed:>6.1f}x")
+        for n_points in args.n_points:
+            feature = torch.randn(n_points, module.dim)
+            t_euler = timeit(lambda: euler_path(module, feature, q), args.n_repeats)
+            t_closed = timeit(lambda: scripted(feature, q), args.n_repeats)
+            print(f"{'rotate features':>22} | {n_points:>4} | {t_euler*1000:>10.3f} | {t_closed*1000:>16.3f} | {t_euler/t_closed:>6.1f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,111 @@
+"""
+Pose accuracy vs. number of denoising steps of each SE(3) integrator on the demo test sets.
+The step counts of server.yaml are scaled by each --step-scales value (timesteps are scaled inversely,
+so that the total integration length is kept), and the lowest energy pose of each demo is compared to the target pose.
+
+    python benchmarks/integrator_sweep.py --configs-root-dir configs/panda_mug --testset-dir demo/panda_mug_on_hanger_test --task-type pick
+"""
+import os
+import argparse
+import time
+import warnings
+from typing import List, Dict
+
+import yaml
+import torch
+
+from edf_interface.data import SE3, DemoDataset, TargetPoseDemo
+from diffusion_edf.agent import DiffusionEdfAgent
+from diffusion_edf.score_model_base import INTEGRATORS
+
+
+def pose_errors(Ts: torch.Tensor, Ts_target: torch.Tensor):
+    """
+    Ts: (nT, 7) || Ts_target: (nTarget, 7)
+    Returns the position (same unit as the poses) and rotation (degrees) errors of each pose to its closest target.
+    """
+    pos_err = (Ts[:, None, 4:] - Ts_target[None, :, 4:]).norm(dim=-1)                                  # (nT, nTarget)
+    cos_half = torch.einsum('ti,gi->tg', Ts[:, :4], Ts_target[:, :4]).abs().clamp(max=1.)              # (nT, nTarget)
+    rot_err = torch.rad2deg(2 * torch.acos(cos_half))                                                  # (nT, nTarget)
+    closest = pos_err.argmin(dim=-1)
+    return pos_err.gather(-1, closest[:, None]).squeeze(-1), rot_err.gather(-1, closest[:, None]).squeeze(-1)
+
+
+def scaled_diffusion_configs(diffusion_configs: Dict, step_scale: float) -> Dict:
+    N_steps_list = [[max(int(round(N * step_scale)), 1) for N in N_steps] for N_steps in diffusion_configs['N_steps_list']]
+    timesteps_list = [[dt * N / N_scaled for dt, N, N_scaled in zip(timesteps, N_steps, N_steps_scaled)]
+                      for timesteps, N_steps, N_steps_scaled in zip(diffusion_configs['timesteps_list'], diffusion_configs['N_steps_list'], N_steps_list)]
+    return dict(
+        N_steps_list=N_steps_list,
+        timesteps_list=timesteps_list,
+        temperatures_list=diffusion_configs['temperatures_list'],
+        diffusion_schedules_list=diffusion_configs['diffusion_schedules_list'],
+        log_t_schedule=diffusion_configs['log_t_schedule'],
+        time_exponent_temp=diffusion_configs['time_exponent_temp'],
+        time_exponent_alpha=diffusion_configs['time_exponent_alpha'],
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Sweep SE(3) integrators and step counts on the demo test sets')
+    parser.add_argument('--configs-root-dir', type=str, default='configs/panda_mug')
+    parser.add_argument('--testset-dir', type=str, default='demo/panda_mug_on_hanger_test')
+    parser.add_argument('--task-type', type=str, default='pick', choices=['pick', 'place'])
+    parser.add_argument('--device', type=str, default='cuda:0')
+    parser.add_argument('--integrators', type=str, nargs='+', default=list(INTEGRATORS.keys()))
+    parser.add_argument('--step-scales', type=float, nargs='+', default=[1.0, 0.5, 0.33, 0.2])
+    parser.add_argument('--n-samples', type=int, default=10)
+    parser.add_argument('--n-demos', type=int, default=None, help='Number of test demos to use (default: all)')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    task_type: str = args.task_type
+
+    with open(os.path.join(args.configs_root_dir, 'agent.yaml')) as f:
+        model_kwargs = yaml.load(f, Loader=yaml.FullLoader)['model_kwargs']
+    with open(os.path.join(args.configs_root_dir, 'preprocess.yaml')) as f:
+        preprocess_config = yaml.load(f, Loader=yaml.FullLoader)
+    with open(os.path.join(args.configs_root_dir, 'server.yaml')) as f:
+        diffusion_configs = yaml.load(f, Loader=yaml.FullLoader)[f"{task_type}_diffusion_configs"]
+
+    with warnings.catch_warnings():
+        warnings.filterwarnings('ignore', message='The TorchScript type system doesn*')
+        agent = DiffusionEdfAgent(
+            model_kwargs_list=model_kwargs[f"{task_type}_models_kwargs"],
+            preprocess_config=preprocess_config['preprocess_config'],
+            unprocess_config=preprocess_config['unprocess_config'],
+            device=args.device,
+            critic_kwargs=model_kwargs.get(f"{task_type}_critic_kwargs", None)
+        )
+
+    testset = DemoDataset(dataset_dir=args.testset_dir)
+    n_demos = len(testset) if args.n_demos is None else min(args.n_demos, len(testset))
+    demos: List[TargetPoseDemo] = [testset[i][0 if task_type == 'pick' else 1].to(args.device) for i in range(n_demos)]
+    T0 = torch.cat([
+        torch.tensor([[1., 0., 0.0, 0.]], device=args.device),
+        torch.tensor([[0., 0., 0.3]], device=args.device)
+    ], dim=-1).repeat(args.n_samples, 1)
+
+    print(f"{task_type} | demos: {n_demos} | samples: {args.n_samples}")
+    print(f"{'integrator':>18} | {'scale':>5} | {'steps':>5} | {'score evals':>11} | {'pos err (cm)':>12} | {'rot err (deg)':>13} | {'time (s)':>8}")
+    for integrator in args.integrators:
+        for step_scale in args.step_scales:
+            configs = scaled_diffusion_configs(diffusion_configs, step_scale)
+            pos_errs, rot_errs, n_evals, n_steps, elapsed = [], [], 0, 0, 0.
+            for demo in demos:
+                torch.manual_seed(args.seed)
+                t0 = time.perf_counter()
+                Ts_out, _, _, info = agent.sample(scene_pcd=demo.scene_pcd, grasp_pcd=demo.grasp_pcd, Ts_init=SE3(poses=T0),
+                                                  integrator=integrator, retention='final_only', return_info=True, **configs)
+                elapsed += time.perf_counter() - t0
+                n_evals += sum(sampler_info['n_score_evals'] for sampler_info in info['sampler_info'])
+                n_steps += sum(sampler_info['n_steps'] for sampler_info in info['sampler_info'])
+                Ts_best = agent.unprocess_fn(SE3(poses=Ts_out[-1, :1])).poses   # Sorted by the critic energy if available
+                pos_err, rot_err = pose_errors(Ts_best, demo.target_poses.poses)
+                pos_errs.append(pos_err * 100.)   # Meters to centimeters
+                rot_errs.append(rot_err)
+            pos_err, rot_err = torch.cat(pos_errs).mean().item(), torch.cat(rot_errs).mean().item()
+            print(f"{integrator:>18} | {step_scale:>5.2f} | {n_steps // n_demos:>5} | {n_evals // n_demos:>11} | {pos_err:>12.3f} | {rot_err:>13.2f} | {elapsed / n_demos:>8.2f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,17 +1,23 @@
 import os
 # os.environ["PYTORCH_JIT_USE_NNC_NOT_NVFUSER"] = "1"
-from typing import List, Tuple, Optional, Union, Iterable, Dict, Sequence, Any
+from typing import List, Tuple, Optional, Union, Iterable, Dict, Sequence, Any, Callable
 import math
 import argparse
 import warnings
+import hashlib
+import threading
+from collections import OrderedDict
 
 from beartype import beartype
 import yaml
 import torch
 
 from edf_interface.data import SE3, PointCloud, TargetPoseDemo
-from diffusion_edf.gnn_data import FeaturedPoints, pcd_to_featured_points
-from diffusion_edf.trainer import DiffusionEdfTrainer
+from diffusion_edf.gnn_data import FeaturedPoints, PreparedKeyField, pcd_to_featured_points
+from diffusion_edf.trainer import DiffusionEdfTrainer, build_score_model
+from diffusion_edf.score_model_base import ScoreModelBase, SamplingCancelled, TimeBudget
+from diffusion_edf.transforms import random_quaternions
+from diffusion_edf.dist import diffuse_isotropic_se3
 from diffusion_edf import train_utils
 
 torch.set_printoptions(precision=4, sci_mode=False)
@@ -63,6 +69,261 @@ def get_models(configs_root_dir: str,
     
     return model
 
+@beartype
+def load_inference_model(configs_root_dir: str,
+                         checkpoint_dir: Optional[str],
+                         device: str,
+                         train_configs_file: str = 'train_configs.yaml',
+                         task_configs_file: Optional[str] = None,
+                         n_warmups: int = 10,
+                         compile_score_head: bool = False,
+                         strict_load: bool = False,
+                         half_precision: bool = False,
+                         ):
+    """
+    Inference-only counterpart of get_models.
+    The model is built from the score model configs alone, and the diffusion schedules are read from the train configs,
+    without creating a trainer or loading the demonstrations. The model is warmed up with synthetic inputs.
+    task_configs_file is not used, and only accepted so that the kwargs of get_models in agent.yaml can be used as they are.
+    """
+    with open(os.path.join(configs_root_dir, train_configs_file)) as f:
+        train_configs = yaml.load(f, Loader=yaml.FullLoader)
+    with open(os.path.join(configs_root_dir, train_configs['model_config_file'])) as f:
+        model_configs = yaml.load(f, Loader=yaml.FullLoader)
+
+    with warnings.catch_warnings():
+        warnings.filterwarnings('ignore', message='The TorchScript type system doesn*')
+
+        model = build_score_model(
+            model_configs=model_configs,
+            deterministic=False,
+            device = device,
+            checkpoint_dir=checkpoint_dir,
+            strict=strict_load
+        ).eval()
+        model.diffusion_schedules = train_configs['diffusion_configs']['time_schedules']
+    if half_precision:
+        model = model.half()
+
+    if compile_score_head:
+        if model.score_head.jittable:
+            model.score_head = torch.jit.script(model.score_head)
+
+    print(f"Warming up the model for {n_warmups} iterations", flush=True)
+    if n_warmups:
+        warmup_with_synthetic_inputs(
+            score_model = model,
+            n_warmups=n_warmups,
+            dtype = torch.float16 if half_precision else torch.float32
+        )
+
+    return model
+
+@beartype
+def warmup_with_synthetic_inputs(score_model: ScoreModelBase,
+                                 n_warmups: int = 10,
+                                 n_scene_points: int = 2000,
+                                 n_grasp_points: int = 300,
+                                 dtype: torch.dtype = torch.float32):
+    """
+    Same as DiffusionEdfTrainer.warmup_score_model, but with random point clouds and poses instead of the demonstrations.
+    Points are drawn in the preprocessed (centimeter) scale: the scene in a 60x60x30 box and the grasp in a 10cm cube.
+    """
+    device = next(iter(score_model.parameters())).device
+    score_model.requires_grad_(False)
+
+    for iters in range(n_warmups):
+        scene_input = FeaturedPoints(x=(torch.rand(n_scene_points, 3, device=device, dtype=dtype) - torch.tensor([0.5, 0.5, 0.], device=device, dtype=dtype)) * torch.tensor([60., 60., 30.], device=device, dtype=dtype),
+                                     f=torch.rand(n_scene_points, 3, device=device, dtype=dtype),
+                                     b=torch.zeros(n_scene_points, device=device, dtype=torch.long))
+        grasp_input = FeaturedPoints(x=(torch.rand(n_grasp_points, 3, device=device, dtype=dtype) - 0.5) * 10.,
+                                     f=torch.rand(n_grasp_points, 3, device=device, dtype=dtype),
+                                     b=torch.zeros(n_grasp_points, device=device, dtype=torch.long))
+        with torch.no_grad():
+            key_pcd_multiscale: List[FeaturedPoints] = score_model.get_key_pcd_multiscale(scene_input)
+            query_pcd: FeaturedPoints = score_model.get_query_pcd(grasp_input)
+
+        nT = 1+(iters%5)
+        for time_schedule in score_model.diffusion_schedules:
+            time = train_utils.random_time(
+                min_time=time_schedule[1],
+                max_time=time_schedule[0],
+                device=device,
+                dtype=dtype
+            ) # Shape: (1,)
+            T = torch.cat([random_quaternions(nT, device=device, dtype=dtype),
+                           scene_input.x[torch.randint(n_scene_points, (nT,), device=device)]], dim=-1)  # (nT, 7)
+
+            with torch.no_grad():
+                _ = score_model.score_head.warmup(
+                    Ts=T,
+                    key_pcd_multiscale=key_pcd_multiscale,
+                    query_pcd=query_pcd,
+                    time = time.repeat(nT)
+                )
+
+    score_model.requires_grad_(True)
+
+PRUNE_POLICY_KEYS = ('top_k', 'quantile', 'dedup_lin_tol', 'dedup_ang_tol')
+
+def prune_poses(Ts: torch.Tensor,
+                energy: torch.Tensor,
+                top_k: Optional[int] = None,
+                quantile: Optional[float] = None,
+                dedup_lin_tol: Optional[float] = None,
+                dedup_ang_tol: Optional[float] = None) -> Tuple[torch.Tensor, Dict[str, int]]:
+    """
+    Select the poses to keep by their critic energy (lower is better).
+        Ts: (nT, 7) || energy: (nT,)
+        top_k: Keep at most this many poses.
+        quantile: Keep the best ceil(quantile * n) poses, 0 < quantile <= 1.
+        dedup_lin_tol, dedup_ang_tol: If set, a pose within both dedup_lin_tol (same unit as Ts) and dedup_ang_tol (radian)
+            of a pose with lower energy is a duplicate of the same mode and removed first.
+            If only one of them is set, the other one is ignored.
+
+    Returns:
+        keep_idx: (nKeep,), indices of the kept poses, sorted by the energy in ascending order
+        stats: number of poses before pruning, after duplicate removal and after pruning
+    """
+    assert Ts.ndim == 2 and Ts.shape[-1] == 7, f"{Ts.shape}"
+    assert energy.shape == Ts.shape[:1], f"{energy.shape}"
+    n_before = len(Ts)
+    keep_idx = energy.argsort(descending=False)
+
+    if dedup_lin_tol is not None or dedup_ang_tol is not None:
+        Ts_sorted = Ts.index_select(0, keep_idx)
+        close = torch.ones(len(Ts_sorted), len(Ts_sorted), dtype=torch.bool, device=Ts.device)
+        if dedup_lin_tol is not None:
+            close &= torch.cdist(Ts_sorted[:, 4:], Ts_sorted[:, 4:]) <= dedup_lin_tol
+        if dedup_ang_tol is not None:
+            cos_half = torch.einsum('ti,si->ts', Ts_sorted[:, :4], Ts_sorted[:, :4]).abs()
+            close &= cos_half >= math.cos(dedup_ang_tol / 2)
+        close = close.cpu()
+        is_mode = torch.zeros(len(Ts_sorted), dtype=torch.bool)
+        suppressed = torch.zeros(len(Ts_sorted), dtype=torch.bool)
+        for i in range(len(Ts_sorted)):    # Greedy suppression from the lowest energy
+            if not suppressed[i]:
+                is_mode[i] = True
+                suppressed |= close[i]
+        keep_idx = keep_idx[is_mode.nonzero().squeeze(-1).to(device=keep_idx.device)]
+    n_dedup = len(keep_idx)
+
+    n_keep = n_dedup
+    if top_k is not None:
+        assert top_k >= 1, f"{top_k}"
+        n_keep = min(n_keep, top_k)
+    if quantile is not None:
+        assert 0. < quantile <= 1., f"{quantile}"
+        n_keep = min(n_keep, max(math.ceil(quantile * n_dedup), 1))
+    keep_idx = keep_idx[:n_keep]
+
+    return keep_idx, {'n_before': n_before, 'n_after_dedup': n_dedup, 'n_after': n_keep}
+
+def points_content_hash(points: FeaturedPoints) -> str:
+    """
+    Hash of the content (shape, dtype and values) of the points, used to recognize a re-queried scene or grasp.
+    """
+    h = hashlib.blake2b(digest_size=16)
+    for tensor in points:
+        if tensor is None:
+            h.update(b'none')
+            continue
+        h.update(f"{tuple(tensor.shape)}|{tensor.dtype}".encode())
+        h.update(tensor.detach().contiguous().cpu().numpy().tobytes())
+    return h.hexdigest()
+
+def _tensor_nbytes(obj: Any, seen: Optional[set] = None) -> int:
+    """
+    Total bytes of the tensors in obj (nested tuples, lists and dicts). Tensors sharing the same memory are counted once.
+    """
+    if seen is None:
+        seen = set()
+    if isinstance(obj, torch.Tensor):
+        key = (obj.device, obj.data_ptr())
+        if key in seen:
+            return 0
+        seen.add(key)
+        return obj.numel() * obj.element_size()
+    if isinstance(obj, (tuple, list)):
+        return sum(_tensor_nbytes(o, seen) for o in obj)
+    if isinstance(obj, dict):
+        return sum(_tensor_nbytes(o, seen) for o in obj.values())
+    return 0
+
+class FeatureCache():
+    """
+    LRU cache of the extracted features of scenes and grasps, keyed by (role, id of the model, content hash of the points).
+    The least recently used entries are evicted once the tensors held by the cache exceed max_bytes.
+    Entries of a model are stale once its weights change, so call clear() when replacing or reloading a model.
+    The cache can be shared by threads. A value missed by several threads at once may be computed more than once.
+    """
+    def __init__(self, max_bytes: int):
+        assert max_bytes > 0, f"{max_bytes}"
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._entries: OrderedDict = OrderedDict() # key -> (value, nbytes)
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get_or_compute(self, key: Tuple, compute_fn: Callable[[], Any]) -> Tuple[Any, bool]:
+        """
+        Returns the cached value of key (and True), or computes, caches and returns it (and False).
+        """
+        with self._lock:
+            entry = self._entries.get(key, None)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[0], True
+            self.misses += 1
+
+        value = compute_fn()
+        nbytes = _tensor_nbytes(value)
+        if nbytes <= self.max_bytes:
+            with self._lock:
+                if key not in self._entries:
+                    self._entries[key] = (value, nbytes)
+                    self.nbytes += nbytes
+                while self.nbytes > self.max_bytes:
+                    _, (_, evicted_nbytes) = self._entries.popitem(last=False)
+                    self.nbytes -= evicted_nbytes
+                    self.evictions += 1
+        return value, False
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.nbytes = 0
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                    'n_entries': len(self._entries), 'nbytes': self.nbytes, 'max_bytes': self.max_bytes}
+
+def compose_pose_unprocess_fn(unprocess_config: List[Dict]) -> Callable[[torch.Tensor], torch.Tensor]:
+    """
+    Same as train_utils.compose_proc_fn(unprocess_config) applied to SE3 poses, but on a pose tensor (..., 7) of any batch shape, in one shot.
+    If the processing only consists of rescales (as in our configs), the translations are rescaled by the overall factor.
+    Otherwise, the processing is applied once to all the poses flattened into a single SE3.
+    """
+    factor: Optional[float] = 1.
+    for proc in unprocess_config:
+        if proc['name'] != 'rescale' or set(proc['kwargs'].keys()) != {'rescale_factor'}:
+            factor = None
+            break
+        factor *= float(proc['kwargs']['rescale_factor'])
+
+    if factor is not None:
+        def unprocess_poses(Ts: torch.Tensor) -> torch.Tensor:
+            return torch.cat([Ts[..., :4], Ts[..., 4:] * factor], dim=-1)
+    else:
+        unprocess_fn = train_utils.compose_proc_fn(preprocess_config=unprocess_config)
+        def unprocess_poses(Ts: torch.Tensor) -> torch.Tensor:
+            return unprocess_fn(SE3(poses=Ts.reshape(-1, 7))).poses.reshape(Ts.shape)
+    return unprocess_poses
+
 @beartype
 class DiffusionEdfAgent():
     task_type: str
@@ -72,18 +333,27 @@ class DiffusionEdfAgent():
                  device: str,
                  compile_score_head: bool = False,
                  half_precision: bool = False,
-                 critic_kwargs: Optional[Dict] = None):
+                 critic_kwargs: Optional[Dict] = None,
+                 feature_cache_bytes: Optional[int] = 256 * 1024**2):
+        """
+        feature_cache_bytes: Memory cap of the LRU cache of the scene and grasp features (see FeatureCache).
+            The features of a re-queried scene or grasp are reused instead of extracted again. None disables the cache.
+        """
         if critic_kwargs is not None:
-            self.critic = get_models(**critic_kwargs, device=device, compile_score_head=compile_score_head, half_precision=half_precision)
+            self.critic = load_inference_model(**critic_kwargs, device=device, compile_score_head=compile_score_head, half_precision=half_precision)
         else:
             self.critic = None
         
         self.models = []
         for kwargs in model_kwargs_list:
-            self.models.append(get_models(**kwargs, device=device, compile_score_head=compile_score_head, half_precision=half_precision))
+            self.models.append(load_inference_model(**kwargs, device=device, compile_score_head=compile_score_head, half_precision=half_precision))
+
+        self.feature_cache: Optional[FeatureCache] = FeatureCache(max_bytes=feature_cache_bytes) if feature_cache_bytes else None
+        self.step_costs_s: List[Optional[float]] = [None for _ in self.models]     # Last measured cost of a denoising step of each model, see time_budget_s of sample
 
         self.proc_fn = train_utils.compose_proc_fn(preprocess_config=preprocess_config)
         self.unprocess_fn = train_utils.compose_proc_fn(preprocess_config=unprocess_config)
+        self.unprocess_poses = compose_pose_unprocess_fn(unprocess_config=unprocess_config)   # unprocess_fn on pose tensors (..., 7)
         
     def compute_critic_energy(self, key_pcd, query_pcd, Ts, time) -> torch.Tensor:
         key_pcd_multiscale: List[FeaturedPoints] = self.critic.get_key_pcd_multiscale(key_pcd)
@@ -95,6 +365,174 @@ class DiffusionEdfAgent():
                                                                      time = time)
         return energy
 
+    def _cached(self, role: str, model, points_hash: Optional[str], compute_fn: Callable[[], Any], cache_stats: Dict[str, int]) -> Any:
+        """
+        Returns compute_fn() through the feature cache, if enabled. cache_stats counts the hits and misses of the current call.
+        """
+        if self.feature_cache is None or points_hash is None:
+            return compute_fn()
+        value, hit = self.feature_cache.get_or_compute(key=(role, id(model), points_hash), compute_fn=compute_fn)
+        cache_stats['hits' if hit else 'misses'] += 1
+        return value
+
+    def _extract_features(self, model, 
+                          scene_input: FeaturedPoints, 
+                          grasp_input: FeaturedPoints,
+                          scene_hash: Optional[str] = None,
+                          grasp_hash: Optional[str] = None,
+                          cache_stats: Optional[Dict[str, int]] = None) -> Tuple[List[FeaturedPoints], FeaturedPoints]:
+        if cache_stats is None:
+            cache_stats = {'hits': 0, 'misses': 0}
+        with torch.no_grad():
+            key_pcd_multiscale: List[FeaturedPoints] = self._cached('key', model, scene_hash, lambda: model.get_key_pcd_multiscale(scene_input), cache_stats)
+            query_pcd: FeaturedPoints = self._cached('query', model, grasp_hash, lambda: model.get_query_pcd(grasp_input), cache_stats)
+        return key_pcd_multiscale, query_pcd
+
+    def _prepare_critic_inputs(self, scene_input: FeaturedPoints, 
+                               grasp_input: FeaturedPoints,
+                               scene_hash: Optional[str] = None,
+                               grasp_hash: Optional[str] = None,
+                               cache_stats: Optional[Dict[str, int]] = None) -> Tuple[List[FeaturedPoints], FeaturedPoints, PreparedKeyField]:
+        if cache_stats is None:
+            cache_stats = {'hits': 0, 'misses': 0}
+        key_pcd_multiscale, query_pcd = self._extract_features(self.critic, scene_input=scene_input, grasp_input=grasp_input,
+                                                               scene_hash=scene_hash, grasp_hash=grasp_hash, cache_stats=cache_stats)
+        with torch.no_grad():
+            key_field = self._cached('key_field', self.critic, scene_hash,      # Shared by every critic evaluation of the scene
+                                     lambda: self.critic.score_head.prepare_key_field(key_pcd_multiscale), cache_stats)
+        return key_pcd_multiscale, query_pcd, key_field
+
+    def _compute_critic_energy(self, critic_inputs: Tuple[List[FeaturedPoints], FeaturedPoints, PreparedKeyField], 
+                               Ts: torch.Tensor,
+                               max_edges: Optional[int] = None,
+                               max_bytes: Optional[int] = None) -> torch.Tensor:
+        key_pcd_multiscale, query_pcd, key_field = critic_inputs
+        with torch.no_grad():
+            Ds = self.critic.score_head.compute_wigner_Ds(Ts)    # Built once for the poses, shared by every chunk of the critic evaluation
+            energy: torch.Tensor = self.critic.score_head.compute_energy(Ts = Ts, 
+                                                                         key_pcd_multiscale = key_pcd_multiscale, 
+                                                                         query_pcd = query_pcd,
+                                                                         time = torch.ones(len(Ts), device=Ts.device, dtype=Ts.dtype), # Any arbitrary time encoding is okay because it will not be used in critic model (in score_model_configs.yaml, query_time_encoding and edge_time_encoding are both false)
+                                                                         key_field = key_field,
+                                                                         max_edges = max_edges,
+                                                                         max_bytes = max_bytes,
+                                                                         Ds = Ds)
+        return energy
+
+    def _check_sample_configs(self, N_steps_list: List[List[int]],
+                              timesteps_list: List[List[float]],
+                              temperatures_list: List,
+                              diffusion_schedules_list: Optional[List],
+                              prune_between_stages: Optional[Dict[str, Any]]) -> List:
+        if prune_between_stages is not None:
+            if self.critic is None:
+                raise ValueError("prune_between_stages requires a critic model.")
+            for key in prune_between_stages.keys():
+                if key not in PRUNE_POLICY_KEYS:
+                    raise ValueError(f"Unknown pruning policy '{key}' (available: {PRUNE_POLICY_KEYS})")
+
+        if diffusion_schedules_list is None:
+            diffusion_schedules_list = [None for _ in range(len(self.models))]
+        assert len(self.models) == len(N_steps_list), f"{len(self.models)} != {len(N_steps_list)}"
+        assert len(self.models) == len(timesteps_list), f"{len(self.models)} != {len(timesteps_list)}"
+        assert len(self.models) == len(temperatures_list), f"{len(self.models)} != {len(temperatures_list)}"
+        assert len(self.models) == len(diffusion_schedules_list), f"{len(self.models)} != {len(diffusion_schedules_list)}"
+        return diffusion_schedules_list
+
+    def _content_hashes(self, scene_input: FeaturedPoints, grasp_input: FeaturedPoints) -> Tuple[Optional[str], Optional[str]]:
+        if self.feature_cache is None:
+            return None, None
+        return points_content_hash(scene_input), points_content_hash(grasp_input)
+
+    def _prune_stage(self, stage: int,
+                     T0: torch.Tensor,
+                     seed_idx: torch.Tensor,
+                     Ts_out: List[torch.Tensor],
+                     info: Dict[str, Any],
+                     critic_inputs: Tuple[List[FeaturedPoints], FeaturedPoints, PreparedKeyField],
+                     prune_between_stages: Dict[str, Any],
+                     max_edges: Optional[int] = None,
+                     max_bytes: Optional[int] = None) -> Tuple[torch.Tensor, torch.Tensor, List[torch.Tensor]]:
+        energy = self._compute_critic_energy(critic_inputs=critic_inputs, Ts=T0, max_edges=max_edges, max_bytes=max_bytes)
+        keep_idx, prune_stats = prune_poses(Ts=T0, energy=energy, **prune_between_stages)
+        prune_stats['stage'] = stage
+        info['pruning'].append(prune_stats)
+
+        T0 = T0.index_select(0, keep_idx)
+        seed_idx = seed_idx.index_select(0, keep_idx)
+        Ts_out = [Ts.index_select(-2, keep_idx) for Ts in Ts_out]
+        for sampler_info in info['sampler_info']:
+            sampler_info['n_steps_per_pose'] = sampler_info['n_steps_per_pose'].index_select(0, keep_idx)
+        return T0, seed_idx, Ts_out
+
+    def _warm_start_seeds(self, warm_start_poses: SE3,
+                          model_idx: int,
+                          diffusion_schedules: Optional[List[Union[List[float], Tuple[float, float]]]] = None,
+                          warm_start_time: Optional[float] = None) -> torch.Tensor:
+        """
+        Processes the warm-start poses and perturbs them like the training targets at the time they join the sampling (see train_utils.diffuse_T_target).
+        The default time is the beginning of the first schedule of the model they join.
+        """
+        model = self.models[model_idx]
+        T_warm: torch.Tensor = self.proc_fn(warm_start_poses).poses
+        assert T_warm.ndim == 2 and T_warm.shape[-1] == 7, f"{T_warm.shape}"
+        if warm_start_time is None:
+            if diffusion_schedules is None:
+                diffusion_schedules = model.diffusion_schedules
+            warm_start_time = float(diffusion_schedules[0][0])
+        eps = warm_start_time / 2 * (float(model.ang_mult) ** 2)
+        std = math.sqrt(warm_start_time) * float(model.lin_mult)
+        T_warm, _, _, _ = diffuse_isotropic_se3(T0=T_warm, eps=eps, std=std, x_ref=None, double_precision=True)
+        return T_warm
+
+    def _join_warm_seeds(self, T0: torch.Tensor,
+                         seed_idx: torch.Tensor,
+                         Ts_out: List[torch.Tensor],
+                         info: Dict[str, Any],
+                         T_warm: torch.Tensor,
+                         n_cold_seeds: int) -> Tuple[torch.Tensor, torch.Tensor, List[torch.Tensor]]:
+        """
+        Appends the warm-start seeds to the current poses. In the trajectories of the models they skipped, they stay at their seed.
+        """
+        T_warm = T_warm.type(T0.dtype)
+        T0 = torch.cat([T0, T_warm], dim=0)
+        seed_idx = torch.cat([seed_idx, n_cold_seeds + torch.arange(len(T_warm), device=seed_idx.device)], dim=0)
+        Ts_out = [torch.cat([Ts, T_warm.expand(len(Ts), -1, -1)], dim=-2) for Ts in Ts_out]
+        for sampler_info in info['sampler_info']:
+            sampler_info['n_steps_per_pose'] = torch.cat([sampler_info['n_steps_per_pose'], 
+                                                          sampler_info['n_steps_per_pose'].new_zeros(len(T_warm))], dim=0)
+        info['n_warm_seeds'] = len(T_warm)
+        return T0, seed_idx, Ts_out
+
+    def _finalize_sample(self, Ts_out: List[torch.Tensor],
+                         seed_idx: torch.Tensor,
+                         info: Dict[str, Any],
+                         critic_inputs: Optional[Tuple[List[FeaturedPoints], FeaturedPoints, PreparedKeyField]],
+                         cache_stats: Dict[str, int],
+                         max_edges: Optional[int] = None,
+                         max_bytes: Optional[int] = None,
+                         time_budget: Optional[TimeBudget] = None) -> torch.Tensor:
+        """
+        Concatenate the trajectories of the models and sort the poses by the critic energy (if available). info is filled in place.
+        """
+        Ts_out = torch.cat(Ts_out, dim=0) # Ts_out: (nTime, nSample, 7)
+        info['n_steps_per_pose'] = torch.stack([sampler_info['n_steps_per_pose'] for sampler_info in info['sampler_info']], dim=0).sum(dim=0) # (nSample,), denoising steps spent on each pose
+        info['n_steps'] = sum(sampler_info['n_steps'] for sampler_info in info['sampler_info'])   # Denoising steps actually run
+        
+        if critic_inputs is not None:
+            energy = self._compute_critic_energy(critic_inputs=critic_inputs, Ts=Ts_out[-1,...], max_edges=max_edges, max_bytes=max_bytes)
+            energy_sorted, idx_sorted = energy.sort(descending=False)
+            Ts_out = Ts_out[..., idx_sorted, :]
+            seed_idx = seed_idx[idx_sorted]
+            info['n_steps_per_pose'] = info['n_steps_per_pose'][idx_sorted]
+            info["energy"] = energy_sorted
+        info['seed_idx'] = seed_idx  # (nSample,), index of the initial pose of each output pose
+        if time_budget is not None:
+            info['time_budget'] = dict(time_budget.stats(), n_models_run=len(info['sampler_info']))
+        if self.feature_cache is not None:
+            info['feature_cache'] = dict(self.feature_cache.stats(), **{'call_' + k: v for k, v in cache_stats.items()}) # Cumulative stats and hits/misses of this call
+        return Ts_out
+
     def sample(self, scene_pcd: PointCloud, 
                grasp_pcd: PointCloud, 
                Ts_init: SE3,
@@ -105,19 +543,46 @@ class DiffusionEdfAgent():
                log_t_schedule: bool = True,
                time_exponent_temp: float = 1.0, # Theoretically, this should be zero.
                time_exponent_alpha: float = 0.5, # Most commonly used exponent in image generation is 1.0, but it is too slow in our case.
+               neighbor_skin: Optional[float] = None,
+               max_edges: Optional[int] = None,
+               max_bytes: Optional[int] = None,
+               convergence_tol: Optional[float] = None,
+               convergence_window: int = 5,
+               integrator: str = 'euler_maruyama',
+               retention: str = 'full',
+               retain_every: int = 1,
+               progress_callback: Optional[Callable[[Dict[str, Any]], None]] = None,
+               should_stop: Optional[Callable[[], bool]] = None,
+               time_budget_s: Optional[float] = None,
+               warm_start_poses: Optional[SE3] = None,
+               warm_start_model: int = 1,
+               warm_start_time: Optional[float] = None,
+               prune_between_stages: Optional[Dict[str, Any]] = None,
                return_info: Optional[bool] = False,
                ) -> Union[Tuple[torch.Tensor, PointCloud, PointCloud], Tuple[torch.Tensor, PointCloud, PointCloud, Dict[str, Any]]]:
         """
         alpha = timestep * L^2 * (t^time_exponent_alpha)
         T = temperature * (t^time_exponent_temp)
+        retention, retain_every, progress_callback, should_stop: See ScoreModelBase.sample. should_stop is also checked before each model.
+            The retained trajectories of the models are concatenated, so Ts_out[-1] is always the final poses.
+        prune_between_stages: If set, the poses are scored by the critic after every model except the last one, 
+            and only the survivors are passed to the next model. See prune_poses for the keys (top_k, quantile, dedup_lin_tol, dedup_ang_tol).
+            The trajectories of the earlier models are pruned as well, and info['seed_idx'] tells which seed each output pose comes from.
+        info['feature_cache']: Cumulative stats of the feature cache, and the hits and misses of this call (call_hits, call_misses).
+        time_budget_s: If set, the wall-clock budget of the call. The per-step cost is measured during the first steps of each model,
+            and the remaining steps of each schedule are thinned out to fit in the budget (see TimeBudget), keeping the t endpoints of the schedules.
+            Later models are skipped if no step fits anymore. The poses reached so far are returned (ranked by the critic, if any).
+            info['n_steps'] is the number of denoising steps actually run, and info['time_budget'] has the stats of the budget.
+        warm_start_poses: If set, extra seeds (e.g., the best poses of the previous request on a nearly unchanged scene), 
+            which join the sampling at the model warm_start_model, skipping the earlier (coarser) models. 
+            They are first perturbed with dist.diffuse_isotropic_se3 at the diffusion time warm_start_time 
+            (default: the beginning of the first schedule of that model). Their seed_idx follow those of Ts_init (info['n_warm_seeds']),
+            and they stay at their seed in the trajectories of the models they skipped.
         """
-
-        if diffusion_schedules_list is None:
-            diffusion_schedules_list = [None for _ in range(len(self.models))]
-        assert len(self.models) == len(N_steps_list), f"{len(self.models)} != {len(N_steps_list)}"
-        assert len(self.models) == len(timesteps_list), f"{len(self.models)} != {len(timesteps_list)}"
-        assert len(self.models) == len(temperatures_list), f"{len(self.models)} != {len(temperatures_list)}"
-        assert len(self.models) == len(diffusion_schedules_list), f"{len(self.models)} != {len(diffusion_schedules_list)}"
+        diffusion_schedules_list = self._check_sample_configs(N_steps_list=N_steps_list, timesteps_list=timesteps_list, temperatures_list=temperatures_list,
+                                                              diffusion_schedules_list=diffusion_schedules_list, prune_between_stages=prune_between_stages)
+        time_budget = None if time_budget_s is None else TimeBudget(time_budget_s=time_budget_s)
+        assert warm_start_poses is None or 0 <= warm_start_model < len(self.models), f"{warm_start_model}"
 
         scene_pcd: PointCloud = self.proc_fn(scene_pcd)
         grasp_pcd: PointCloud = self.proc_fn(grasp_pcd)
@@ -128,13 +593,32 @@ class DiffusionEdfAgent():
         T0: torch.Tensor = Ts_init.poses
         assert T0.ndim == 2 and T0.shape[-1] == 7, f"{T0.shape}"
 
+        cache_stats = {'hits': 0, 'misses': 0}
+        scene_hash, grasp_hash = self._content_hashes(scene_input=scene_input, grasp_input=grasp_input)
+
         info = {}
+        info['sampler_info'] = []
+        if prune_between_stages is not None:
+            info['pruning'] = []
+        seed_idx = torch.arange(len(T0), device=T0.device)
+        n_cold_seeds = len(T0)
         Ts_out = []
-        for model, N_steps, timesteps, temperatures, diffusion_schedules in zip(self.models, N_steps_list, timesteps_list, temperatures_list, diffusion_schedules_list):
+        critic_inputs: Optional[Tuple[List[FeaturedPoints], FeaturedPoints, PreparedKeyField]] = None
+        for stage, (model, N_steps, timesteps, temperatures, diffusion_schedules) in enumerate(zip(self.models, N_steps_list, timesteps_list, temperatures_list, diffusion_schedules_list)):
+            if should_stop is not None and should_stop():
+                raise SamplingCancelled(f"Sampling stopped before model {stage}.")
+            if time_budget is not None:
+                time_budget.known_step_cost_s = self.step_costs_s[stage]
+                time_budget.later_steps = [(sum(N_steps_list[j]), self.step_costs_s[j]) for j in range(stage+1, len(self.models))]
+                if stage > 0 and time_budget.exhausted():
+                    break
+            if warm_start_poses is not None and stage == warm_start_model:
+                T_warm = self._warm_start_seeds(warm_start_poses, model_idx=stage, diffusion_schedules=diffusion_schedules, warm_start_time=warm_start_time)
+                T0, seed_idx, Ts_out = self._join_warm_seeds(T0=T0, seed_idx=seed_idx, Ts_out=Ts_out, info=info, T_warm=T_warm, n_cold_seeds=n_cold_seeds)
+
             #################### Feature extraction #####################
-            with torch.no_grad():
-                scene_out_multiscale: List[FeaturedPoints] = model.get_key_pcd_multiscale(scene_input)
-                grasp_out: FeaturedPoints = model.get_query_pcd(grasp_input)
+            scene_out_multiscale, grasp_out = self._extract_features(model, scene_input=scene_input, grasp_input=grasp_input,
+                                                                     scene_hash=scene_hash, grasp_hash=grasp_hash, cache_stats=cache_stats)
 
             if diffusion_schedules is None:
                 diffusion_schedules = model.diffusion_schedules
@@ -143,7 +627,7 @@ class DiffusionEdfAgent():
 
             #################### Sample #####################
             with torch.no_grad():
-                Ts = model.sample(
+                Ts, sampler_info = model.sample(
                     T_seed=T0.clone().detach(),
                     scene_pcd_multiscale=scene_out_multiscale,
                     grasp_pcd=grasp_out,
@@ -154,24 +638,39 @@ class DiffusionEdfAgent():
                     log_t_schedule=log_t_schedule,
                     time_exponent_temp=time_exponent_temp,
                     time_exponent_alpha=time_exponent_alpha,
+                    neighbor_skin=neighbor_skin,
+                    max_edges=max_edges,
+                    max_bytes=max_bytes,
+                    convergence_tol=convergence_tol,
+                    convergence_window=convergence_window,
+                    integrator=integrator,
+                    retention=retention,
+                    retain_every=retain_every,
+                    progress_callback=progress_callback,
+                    should_stop=should_stop,
+                    time_budget=time_budget,
+                    return_info=True,
                 )
+                info['sampler_info'].append(sampler_info)
+                if time_budget is not None and time_budget.call_step_cost_s is not None:
+                    self.step_costs_s[stage] = time_budget.call_step_cost_s     # Prior for the next calls
                 Ts = Ts.type(T0.dtype)
                 T0 = Ts[-1]
                 Ts_out.append(Ts)
-        Ts_out = torch.cat(Ts_out, dim=0) # Ts_out: (nTime, nSample, 7)
-        
-        if self.critic is not None:
-            with torch.no_grad():
-                key_pcd_multiscale: List[FeaturedPoints] = self.critic.get_key_pcd_multiscale(scene_input)
-                query_pcd: FeaturedPoints = self.critic.get_query_pcd(grasp_input)
 
-                energy: torch.Tensor = self.critic.score_head.compute_energy(Ts = Ts_out[-1,...], 
-                                                                             key_pcd_multiscale = key_pcd_multiscale, 
-                                                                             query_pcd = query_pcd,
-                                                                             time = torch.ones(Ts_out.shape[-2], device=Ts_out.device, dtype=Ts_out.dtype)) # Any arbitrary time encoding is okay because it will not be used in critic model (in score_model_configs.yaml, query_time_encoding and edge_time_encoding are both false)
-                energy_sorted, idx_sorted = energy.sort(descending=False)
-                Ts_out = Ts_out[..., idx_sorted, :]
-                info["energy"] = energy_sorted
+            #################### Prune #####################
+            if prune_between_stages is not None and stage < len(self.models) - 1:
+                if critic_inputs is None:
+                    critic_inputs = self._prepare_critic_inputs(scene_input=scene_input, grasp_input=grasp_input,
+                                                                scene_hash=scene_hash, grasp_hash=grasp_hash, cache_stats=cache_stats)
+                T0, seed_idx, Ts_out = self._prune_stage(stage=stage, T0=T0, seed_idx=seed_idx, Ts_out=Ts_out, info=info, critic_inputs=critic_inputs,
+                                                         prune_between_stages=prune_between_stages, max_edges=max_edges, max_bytes=max_bytes)
+
+        if self.critic is not None and critic_inputs is None:
+            critic_inputs = self._prepare_critic_inputs(scene_input=scene_input, grasp_input=grasp_input,
+                                                        scene_hash=scene_hash, grasp_hash=grasp_hash, cache_stats=cache_stats)
+        Ts_out = self._finalize_sample(Ts_out=Ts_out, seed_idx=seed_idx, info=info, critic_inputs=critic_inputs, 
+                                       cache_stats=cache_stats, max_edges=max_edges, max_bytes=max_bytes, time_budget=time_budget)
 
         if return_info:
             return Ts_out, scene_pcd, grasp_pcd, info
@@ -180,3 +679,151 @@ class DiffusionEdfAgent():
 
 
 
+
+    def sample_batched(self, scene_pcd_list: List[PointCloud], 
+                       grasp_pcd_list: List[PointCloud], 
+                       Ts_init_list: List[SE3],
+                       N_steps_list: List[List[int]],
+                       timesteps_list: List[List[float]],
+                       temperatures_list: List[Union[Union[int, float], Sequence[Union[int, float]]]],
+                       diffusion_schedules_list: Optional[List[Optional[List[Union[List[float], Tuple[float, float]]]]]] = None,
+                       log_t_schedule: bool = True,
+                       time_exponent_temp: float = 1.0,
+                       time_exponent_alpha: float = 0.5,
+                       max_edges: Optional[int] = None,
+                       max_bytes: Optional[int] = None,
+                       convergence_tol: Optional[float] = None,
+                       convergence_window: int = 5,
+                       integrator: str = 'euler_maruyama',
+                       retention: str = 'full',
+                       retain_every: int = 1,
+                       progress_callback: Optional[Callable[[Dict[str, Any]], None]] = None,
+                       should_stop: Optional[Callable[[], bool]] = None,
+                       time_budget_s: Optional[float] = None,
+                       warm_start_poses_list: Optional[List[Optional[SE3]]] = None,
+                       warm_start_model: int = 1,
+                       warm_start_time: Optional[float] = None,
+                       prune_between_stages: Optional[Dict[str, Any]] = None,
+                       return_info: Optional[bool] = False,
+                       ) -> Union[Tuple[List[torch.Tensor], List[PointCloud], List[PointCloud]], 
+                                  Tuple[List[torch.Tensor], List[PointCloud], List[PointCloud], List[Dict[str, Any]]]]:
+        """
+        Same as sample for several independent requests (scene, grasp and initial poses), 
+        whose poses are denoised together by ScoreModelBase.sample_batched, with a single score evaluation per step for all the requests.
+        Returns the lists of what sample returns for each request.
+        max_edges and max_bytes only apply to the critic, as the batched sampler does not split the poses into chunks.
+        Neighbor lists (neighbor_skin) are not available.
+        warm_start_poses_list: The warm_start_poses of each request (or None), see sample.
+        """
+        diffusion_schedules_list = self._check_sample_configs(N_steps_list=N_steps_list, timesteps_list=timesteps_list, temperatures_list=temperatures_list,
+                                                              diffusion_schedules_list=diffusion_schedules_list, prune_between_stages=prune_between_stages)
+        time_budget = None if time_budget_s is None else TimeBudget(time_budget_s=time_budget_s)
+        assert warm_start_poses_list is None or 0 <= warm_start_model < len(self.models), f"{warm_start_model}"
+        n_requests = len(scene_pcd_list)
+        assert len(grasp_pcd_list) == n_requests, f"{len(grasp_pcd_list)} != {n_requests}"
+        assert len(Ts_init_list) == n_requests, f"{len(Ts_init_list)} != {n_requests}"
+
+        scene_pcd_list: List[PointCloud] = [self.proc_fn(scene_pcd) for scene_pcd in scene_pcd_list]
+        grasp_pcd_list: List[PointCloud] = [self.proc_fn(grasp_pcd) for grasp_pcd in grasp_pcd_list]
+        scene_inputs: List[FeaturedPoints] = [pcd_to_featured_points(scene_pcd) for scene_pcd in scene_pcd_list]
+        grasp_inputs: List[FeaturedPoints] = [pcd_to_featured_points(grasp_pcd) for grasp_pcd in grasp_pcd_list]
+        T0_list: List[torch.Tensor] = [self.proc_fn(Ts_init).poses for Ts_init in Ts_init_list]
+        for T0 in T0_list:
+            assert T0.ndim == 2 and T0.shape[-1] == 7, f"{T0.shape}"
+
+        cache_stats_list = [{'hits': 0, 'misses': 0} for _ in range(n_requests)]
+        hashes = [self._content_hashes(scene_input=scene_input, grasp_input=grasp_input) for scene_input, grasp_input in zip(scene_inputs, grasp_inputs)]
+
+        info_list = [{'sampler_info': []} for _ in range(n_requests)]
+        if prune_between_stages is not None:
+            for info in info_list:
+                info['pruning'] = []
+        seed_idx_list = [torch.arange(len(T0), device=T0.device) for T0 in T0_list]
+        n_cold_seeds_list = [len(T0) for T0 in T0_list]
+        if warm_start_poses_list is not None:
+            assert len(warm_start_poses_list) == n_requests, f"{len(warm_start_poses_list)} != {n_requests}"
+        Ts_out_list: List[List[torch.Tensor]] = [[] for _ in range(n_requests)]
+        critic_inputs_list: List[Optional[Tuple[List[FeaturedPoints], FeaturedPoints, PreparedKeyField]]] = [None for _ in range(n_requests)]
+        def get_critic_inputs(i: int) -> Tuple[List[FeaturedPoints], FeaturedPoints, PreparedKeyField]:
+            if critic_inputs_list[i] is None:
+                critic_inputs_list[i] = self._prepare_critic_inputs(scene_input=scene_inputs[i], grasp_input=grasp_inputs[i],
+                                                                    scene_hash=hashes[i][0], grasp_hash=hashes[i][1], cache_stats=cache_stats_list[i])
+            return critic_inputs_list[i]
+
+        for stage, (model, N_steps, timesteps, temperatures, diffusion_schedules) in enumerate(zip(self.models, N_steps_list, timesteps_list, temperatures_list, diffusion_schedules_list)):
+            if should_stop is not None and should_stop():
+                raise SamplingCancelled(f"Sampling stopped before model {stage}.")
+            if time_budget is not None:
+                time_budget.known_step_cost_s = self.step_costs_s[stage]
+                time_budget.later_steps = [(sum(N_steps_list[j]), self.step_costs_s[j]) for j in range(stage+1, len(self.models))]
+                if stage > 0 and time_budget.exhausted():
+                    break
+            if warm_start_poses_list is not None and stage == warm_start_model:
+                for i, warm_start_poses in enumerate(warm_start_poses_list):
+                    if warm_start_poses is not None:
+                        T_warm = self._warm_start_seeds(warm_start_poses, model_idx=stage, diffusion_schedules=diffusion_schedules, warm_start_time=warm_start_time)
+                        T0_list[i], seed_idx_list[i], Ts_out_list[i] = self._join_warm_seeds(T0=T0_list[i], seed_idx=seed_idx_list[i], Ts_out=Ts_out_list[i], 
+                                                                                             info=info_list[i], T_warm=T_warm, n_cold_seeds=n_cold_seeds_list[i])
+
+            #################### Feature extraction #####################
+            features = [self._extract_features(model, scene_input=scene_input, grasp_input=grasp_input,
+                                               scene_hash=scene_hash, grasp_hash=grasp_hash, cache_stats=cache_stats)
+                        for scene_input, grasp_input, (scene_hash, grasp_hash), cache_stats in zip(scene_inputs, grasp_inputs, hashes, cache_stats_list)]
+
+            if diffusion_schedules is None:
+                diffusion_schedules = model.diffusion_schedules
+            assert len(diffusion_schedules) == len(N_steps), f"{len(diffusion_schedules)} != {len(N_steps)}"
+            assert len(diffusion_schedules) == len(timesteps), f"{len(diffusion_schedules)} != {len(timesteps)}"
+
+            #################### Sample #####################
+            with torch.no_grad():
+                Ts_list, sampler_info = model.sample_batched(
+                    T_seeds_list=[T0.clone().detach() for T0 in T0_list],
+                    scene_pcd_multiscale_list=[scene_out_multiscale for scene_out_multiscale, _ in features],
+                    grasp_pcd_list=[grasp_out for _, grasp_out in features],
+                    diffusion_schedules=diffusion_schedules,
+                    N_steps=N_steps,
+                    timesteps=timesteps,
+                    temperatures=temperatures,
+                    log_t_schedule=log_t_schedule,
+                    time_exponent_temp=time_exponent_temp,
+                    time_exponent_alpha=time_exponent_alpha,
+                    convergence_tol=convergence_tol,
+                    convergence_window=convergence_window,
+                    integrator=integrator,
+                    retention=retention,
+                    retain_every=retain_every,
+                    progress_callback=progress_callback,
+                    should_stop=should_stop,
+                    time_budget=time_budget,
+                    return_info=True,
+                )
+            if time_budget is not None and time_budget.call_step_cost_s is not None:
+                self.step_costs_s[stage] = time_budget.call_step_cost_s
+            for i, Ts in enumerate(Ts_list):
+                info_list[i]['sampler_info'].append({'n_steps': sampler_info['n_steps'], 
+                                                     'n_steps_per_pose': sampler_info['n_steps_per_pose'][i], 
+                                                     'n_score_evals': sampler_info['n_score_evals'],
+                                                     'n_batched_requests': n_requests})
+                Ts = Ts.type(T0_list[i].dtype)
+                T0_list[i] = Ts[-1]
+                Ts_out_list[i].append(Ts)
+
+            #################### Prune #####################
+            if prune_between_stages is not None and stage < len(self.models) - 1:
+                for i in range(n_requests):
+                    T0_list[i], seed_idx_list[i], Ts_out_list[i] = self._prune_stage(stage=stage, T0=T0_list[i], seed_idx=seed_idx_list[i], Ts_out=Ts_out_list[i], 
+                                                                                     info=info_list[i], critic_inputs=get_critic_inputs(i), 
+                                                                                     prune_between_stages=prune_between_stages, max_edges=max_edges, max_bytes=max_bytes)
+
+        Ts_out_final: List[torch.Tensor] = []
+        for i in range(n_requests):
+            critic_inputs = get_critic_inputs(i) if self.critic is not None else None
+            Ts_out_final.append(self._finalize_sample(Ts_out=Ts_out_list[i], seed_idx=seed_idx_list[i], info=info_list[i], critic_inputs=critic_inputs,
+                                                      cache_stats=cache_stats_list[i], max_edges=max_edges, max_bytes=max_bytes, 
+                                                      time_budget=time_budget))
+
+        if return_info:
+            return Ts_out_final, scene_pcd_list, grasp_pcd_list, info_list
+        else:
+            return Ts_out_final, scene_pcd_list, grasp_pcd_list
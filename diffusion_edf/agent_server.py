@@ -1,9 +1,19 @@
 import os
 os.environ["PYTORCH_JIT_USE_NNC_NOT_NVFUSER"] = "1"
-from typing import List, Tuple, Optional, Union, Iterable, Dict, Any
+from typing import List, Tuple, Optional, Union, Iterable, Dict, Any, Callable, Set, Iterator, Hashable
 import math
 import argparse
 import warnings
+import threading
+import itertools
+import time
+import copy
+import zlib
+import multiprocessing
+from multiprocessing.connection import Connection
+from concurrent.futures import Future
+from collections import OrderedDict
+from contextlib import contextmanager
 
 from beartype import beartype
 import yaml
@@ -12,11 +22,371 @@ import torch
 from edf_interface import data
 from edf_interface.pyro import PyroServer, expose
 from edf_interface.utils.manipulation_utils import compute_pre_pick_trajectories, compute_pre_place_trajectories
-from diffusion_edf.agent import DiffusionEdfAgent
+from diffusion_edf.agent import DiffusionEdfAgent, compose_pose_unprocess_fn, warmup_with_synthetic_inputs
+from diffusion_edf.request_batcher import DynamicBatcher, RequestCancelled, DeadlineExceeded
+from diffusion_edf.shm_transport import SharedSegmentStore, SharedTensors, request_from_tensors
 
 torch.set_printoptions(precision=4, sci_mode=False)
 
 
+def _agent_nbytes(agent: DiffusionEdfAgent) -> int:
+    """
+    Bytes of the parameters and buffers of the models of an agent.
+    """
+    modules = agent.models + ([] if agent.critic is None else [agent.critic])
+    return sum(t.numel() * t.element_size() for module in modules for t in itertools.chain(module.parameters(), module.buffers()))
+
+
+class _ResidentAgent():
+    def __init__(self, agent: DiffusionEdfAgent):
+        self.agent = agent
+        self.nbytes: int = _agent_nbytes(agent)
+        self.n_users: int = 0
+        self.last_used: float = time.monotonic()
+        self.retired: bool = False
+
+
+class ModelRegistry():
+    """
+    Agents of the tasks ('pick', 'place'), built by build_fn(task_name, agent_kwargs) on first use rather than at startup.
+    agent_kwargs (model_kwargs_list and critic_kwargs of DiffusionEdfAgent) are given for each task by kwargs_by_task.
+
+    Requests use an agent through use(task_name), which keeps it resident while they run.
+    If max_bytes is set, the least recently used agents that no request is using are evicted (and rebuilt on their next use)
+    once the parameters of the resident agents exceed it.
+
+    swap(task_name, ...) builds (and warms up) an agent with other checkpoints in a background thread, while the current one keeps serving.
+    The new agent then replaces it at once: requests already running finish with the old agent, and later ones use the new agent.
+    The old agent is dropped, with its feature cache, once its last request is done.
+    """
+    def __init__(self, build_fn: Callable[[str, Dict[str, Any]], DiffusionEdfAgent],
+                 kwargs_by_task: Dict[str, Dict[str, Any]],
+                 max_bytes: Optional[int] = None):
+        self.build_fn = build_fn
+        self.kwargs_by_task = kwargs_by_task
+        self.max_bytes = max_bytes
+        self._agents: Dict[str, _ResidentAgent] = {}
+        self._loading: Set[str] = set()
+        self._swap_status: Dict[str, str] = {}
+        self._cond = threading.Condition()
+        self.n_loads = 0
+        self.n_evictions = 0
+        self.n_swaps = 0
+
+    def _check_task(self, task_name: str):
+        if task_name not in self.kwargs_by_task:
+            raise ValueError(f"Unknown task name '{task_name}'")
+
+    @contextmanager
+    def use(self, task_name: str) -> Iterator[DiffusionEdfAgent]:
+        resident = self._acquire(task_name)
+        try:
+            yield resident.agent
+        finally:
+            with self._cond:
+                resident.n_users -= 1
+                resident.last_used = time.monotonic()
+                if resident.retired and resident.n_users == 0:
+                    self._drop(resident)
+                else:
+                    self._evict_over_cap()
+
+    def _acquire(self, task_name: str) -> _ResidentAgent:
+        self._check_task(task_name)
+        with self._cond:
+            while True:
+                resident = self._agents.get(task_name, None)
+                if resident is not None:
+                    resident.n_users += 1
+                    resident.last_used = time.monotonic()
+                    return resident
+                if task_name not in self._loading:
+                    break
+                self._cond.wait()    # Loaded by another request
+            self._loading.add(task_name)
+            agent_kwargs = self.kwargs_by_task[task_name]
+
+        try:
+            agent = self.build_fn(task_name, agent_kwargs)
+        finally:
+            with self._cond:
+                self._loading.discard(task_name)
+                self._cond.notify_all()
+        resident = _ResidentAgent(agent)
+        with self._cond:
+            resident.n_users += 1
+            self._install(task_name, resident)
+            self.n_loads += 1
+        return resident
+
+    def load(self, task_name: str):
+        """
+        Build the agent of a task now, if it is not resident.
+        """
+        with self.use(task_name):
+            pass
+
+    def resident_tasks(self) -> List[str]:
+        with self._cond:
+            return list(self._agents.keys())
+
+    def _install(self, task_name: str, resident: _ResidentAgent):
+        """
+        Must be called with self._cond held.
+        """
+        old = self._agents.get(task_name, None)
+        self._agents[task_name] = resident
+        if old is not None:
+            old.retired = True
+            if old.n_users == 0:
+                self._drop(old)
+        self._evict_over_cap()
+        self._cond.notify_all()
+
+    def _drop(self, resident: _ResidentAgent):
+        if resident.agent.feature_cache is not None:
+            resident.agent.feature_cache.clear()    # Features of the old weights
+        resident.agent = None
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+
+    def _evict_over_cap(self):
+        """
+        Must be called with self._cond held.
+        """
+        if self.max_bytes is None:
+            return
+        while sum(resident.nbytes for resident in self._agents.values()) > self.max_bytes:
+            idle = [(resident.last_used, task_name) for task_name, resident in self._agents.items() if resident.n_users == 0]
+            if not idle:
+                return   # Every resident agent is in use
+            _, task_name = min(idle)
+            self._drop(self._agents.pop(task_name))
+            self.n_evictions += 1
+
+    def unload(self, task_name: str) -> bool:
+        """
+        Evict the agent of a task, once the requests using it are done. Returns False if it is not resident.
+        """
+        with self._cond:
+            resident = self._agents.pop(task_name, None)
+            if resident is None:
+                return False
+            resident.retired = True
+            if resident.n_users == 0:
+                self._drop(resident)
+            return True
+
+    def swap(self, task_name: str, 
+             model_kwargs_list: Optional[List[Dict[str, Any]]] = None,
+             critic_kwargs: Optional[Dict[str, Any]] = None,
+             wait: bool = False) -> str:
+        """
+        Replace the agent of a task with one built from other kwargs, in a background thread (see the class docstring).
+        The entries of model_kwargs_list (one per model) and critic_kwargs update the current kwargs, e.g., [{'checkpoint_dir': ...}, {'checkpoint_dir': ...}].
+        The new kwargs also apply whenever the agent is rebuilt after an eviction. 
+        Returns the status of the swap (see swap_status), which is final if wait is True.
+        """
+        self._check_task(task_name)
+        agent_kwargs = copy.deepcopy(self.kwargs_by_task[task_name])
+        if model_kwargs_list is not None:
+            if len(model_kwargs_list) != len(agent_kwargs['model_kwargs_list']):
+                raise ValueError(f"{len(model_kwargs_list)} model kwargs given for the {len(agent_kwargs['model_kwargs_list'])} models of '{task_name}'")
+            for kwargs, update in zip(agent_kwargs['model_kwargs_list'], model_kwargs_list):
+                kwargs.update(update)
+        if critic_kwargs is not None:
+            if agent_kwargs['critic_kwargs'] is None:
+                raise ValueError(f"'{task_name}' has no critic")
+            agent_kwargs['critic_kwargs'].update(critic_kwargs)
+
+        with self._cond:
+            if self._swap_status.get(task_name, None) == 'building':
+                raise RuntimeError(f"A swap of '{task_name}' is already in progress.")
+            self._swap_status[task_name] = 'building'
+        thread = threading.Thread(target=self._swap, args=(task_name, agent_kwargs), name=f"swap-{task_name}", daemon=True)
+        thread.start()
+        if wait:
+            thread.join()
+        return self.swap_status(task_name)
+
+    def _swap(self, task_name: str, agent_kwargs: Dict[str, Any]):
+        try:
+            agent = self.build_fn(task_name, agent_kwargs)
+        except Exception as e:
+            with self._cond:
+                self._swap_status[task_name] = f"failed: {e!r}"
+            return
+        resident = _ResidentAgent(agent)
+        with self._cond:
+            self.kwargs_by_task[task_name] = agent_kwargs
+            self._install(task_name, resident)
+            self.n_swaps += 1
+            self._swap_status[task_name] = 'done'
+
+    def swap_status(self, task_name: str) -> str:
+        """
+        'building', 'done' or 'failed: <error>' for the last swap of the task, or 'none'.
+        """
+        with self._cond:
+            return self._swap_status.get(task_name, 'none')
+
+    def stats(self) -> Dict[str, Any]:
+        with self._cond:
+            return {'resident': {task_name: {'nbytes': resident.nbytes, 'n_users': resident.n_users, 'idle_s': time.monotonic() - resident.last_used}
+                                 for task_name, resident in self._agents.items()},
+                    'loading': sorted(self._loading), 'swaps': dict(self._swap_status), 'max_bytes': self.max_bytes,
+                    'n_loads': self.n_loads, 'n_evictions': self.n_evictions, 'n_swaps': self.n_swaps}
+
+
+def _worker_main(conn: Connection, make_service: Callable[[], Any], n_threads: Optional[int]):
+    """
+    Loop of a worker process of WorkerPool. Each call runs in its own thread, so that the service can batch concurrent requests.
+    The service is warmed up (service.warmup(), if any) once the intra-op thread count of the worker is set.
+    """
+    if n_threads is not None:
+        torch.set_num_threads(n_threads)
+    service = make_service()
+    warmup = getattr(service, 'warmup', None)
+    if warmup is not None:
+        warmup()
+    send_lock = threading.Lock()
+
+    def handle(call_id: int, method: str, kwargs: Dict[str, Any]):
+        try:
+            reply = (call_id, True, getattr(service, method)(**kwargs))
+        except Exception as e:
+            reply = (call_id, False, e)
+        with send_lock:
+            try:
+                conn.send(reply)
+            except Exception as e:     # e.g., an unpicklable result
+                conn.send((call_id, False, RuntimeError(f"{method} failed to send its result: {e!r}")))
+
+    while True:
+        try:
+            message = conn.recv()
+        except EOFError:
+            break
+        if message is None:
+            break
+        threading.Thread(target=handle, args=message, daemon=True).start()
+    close = getattr(service, 'close', None)
+    if close is not None:
+        close()
+
+
+class WorkerPool():
+    """
+    Pre-forked worker processes, each serving the calls routed to it with its own service (make_service()) and intra-op thread pool (n_threads).
+    Whatever the parent process has loaded before the pool is created (e.g., the models) is shared with the workers by the fork,
+    copy-on-write, and share_memory_() keeps tensors shared even if a worker writes to them.
+    The workers must not be forked after CUDA is initialized, so the pool is for CPU inference.
+    Nor after the parent has run multi-threaded ops: the OpenMP runtime (GNU libgomp) does not survive a fork, 
+    and a worker would hang on its first parallel op. The parent must run with torch.set_num_threads(1) until the pool is created.
+
+    call(method, kwargs, route_key) runs getattr(service, method)(**kwargs) in a worker and returns its result (or raises its exception).
+    Calls with the same route_key go to the same worker (e.g., the sessions of warm starts), the others to the worker with the fewest calls in progress.
+    """
+    def __init__(self, make_service: Callable[[], Any], n_workers: int, n_threads: Optional[int] = None):
+        assert n_workers >= 1, f"{n_workers}"
+        context = multiprocessing.get_context('fork')
+        self._conns: List[Connection] = []
+        self._send_locks: List[threading.Lock] = []
+        self._processes = []
+        for i in range(n_workers):
+            parent_conn, child_conn = context.Pipe()
+            process = context.Process(target=_worker_main, args=(child_conn, make_service, n_threads), name=f"agent-worker-{i}", daemon=True)
+            process.start()
+            child_conn.close()
+            self._conns.append(parent_conn)
+            self._send_locks.append(threading.Lock())
+            self._processes.append(process)
+
+        self._lock = threading.Lock()
+        self._pending: Dict[int, Tuple[int, Future]] = {}    # call id -> (worker, future)
+        self._n_in_progress = [0 for _ in range(n_workers)]
+        self._call_ids = itertools.count()
+        self._receivers = [threading.Thread(target=self._receive_loop, args=(i,), name=f"agent-worker-{i}-receiver", daemon=True) for i in range(n_workers)]
+        for receiver in self._receivers:
+            receiver.start()
+
+    def __len__(self) -> int:
+        return len(self._conns)
+
+    def _receive_loop(self, worker: int):
+        while True:
+            try:
+                call_id, ok, result = self._conns[worker].recv()
+            except (EOFError, OSError):
+                break
+            with self._lock:
+                _, future = self._pending.pop(call_id)
+                self._n_in_progress[worker] -= 1
+            if ok:
+                future.set_result(result)
+            else:
+                future.set_exception(result)
+        with self._lock:     # The worker exited
+            lost = [call_id for call_id, (w, _) in self._pending.items() if w == worker]
+            lost = [self._pending.pop(call_id)[1] for call_id in lost]
+        for future in lost:
+            future.set_exception(RuntimeError(f"Agent worker {worker} exited."))
+
+    def submit(self, worker: int, method: str, kwargs: Dict[str, Any]) -> Future:
+        future = Future()
+        with self._lock:
+            call_id = next(self._call_ids)
+            self._pending[call_id] = (worker, future)
+            self._n_in_progress[worker] += 1
+        try:
+            with self._send_locks[worker]:
+                self._conns[worker].send((call_id, method, kwargs))
+        except (OSError, BrokenPipeError) as e:
+            with self._lock:
+                if self._pending.pop(call_id, None) is not None:
+                    self._n_in_progress[worker] -= 1
+            raise RuntimeError(f"Agent worker {worker} is not running ({e!r}).") from None
+        return future
+
+    def route(self, route_key: Optional[Hashable] = None) -> int:
+        if route_key is not None:
+            return zlib.crc32(repr(route_key).encode()) % len(self)     # Stable across processes, unlike hash()
+        with self._lock:
+            return min(range(len(self)), key=lambda worker: self._n_in_progress[worker])
+
+    def call(self, method: str, kwargs: Dict[str, Any], route_key: Optional[Hashable] = None) -> Any:
+        return self.submit(worker=self.route(route_key), method=method, kwargs=kwargs).result()
+
+    def call_worker(self, worker: int, method: str, kwargs: Dict[str, Any]) -> Any:
+        return self.submit(worker=worker, method=method, kwargs=kwargs).result()
+
+    def broadcast(self, method: str, kwargs: Dict[str, Any]) -> List[Any]:
+        futures = [self.submit(worker=worker, method=method, kwargs=kwargs) for worker in range(len(self))]
+        return [future.result() for future in futures]
+
+    def close(self, timeout: Optional[float] = 10.):
+        for conn, send_lock in zip(self._conns, self._send_locks):
+            with send_lock:
+                try:
+                    conn.send(None)
+                except (OSError, BrokenPipeError):
+                    pass
+        for process in self._processes:
+            process.join(timeout=timeout)
+            if process.is_alive():
+                process.terminate()
+        for conn in self._conns:
+            conn.close()
+
+
+def share_agent_weights(agent: DiffusionEdfAgent):
+    """
+    Move the parameters and buffers of the models of an agent to shared memory, so that forked workers never copy them.
+    """
+    for module in agent.models + ([] if agent.critic is None else [agent.critic]):
+        module.share_memory()
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='EDF agents server for pick-and-place task')
     parser.add_argument('--configs-root-dir', type=str, help='')
@@ -25,6 +395,8 @@ if __name__ == '__main__':
     parser.add_argument('--compile-score-model-head', action='store_true', help='compile score head with torch.jit.script for faster inference, but may cause bug')
     parser.add_argument('--nameserver-host-ip', type=str, default='', help='')
     parser.add_argument('--nameserver-host-port', type=str, default='', help='')
+    parser.add_argument('--n-processes', type=int, default=None, help='number of pre-forked worker processes (overrides serving_configs.n_processes in server.yaml)')
+    parser.add_argument('--device', type=str, default=None, help='overrides the device in agent.yaml')
     args = parser.parse_args()
     configs_root_dir = args.configs_root_dir
     server_name = args.server_name
@@ -42,20 +414,13 @@ if __name__ == '__main__':
         nameserver_host_port = int(nameserver_host_port)
 
 
-    # ---------------------------------------------------------------------------- #
-    # Initialize Pyro Server
-    # ---------------------------------------------------------------------------- #
-    server = PyroServer(server_name='agent', init_nameserver=init_nameserver, 
-                        nameserver_host=nameserver_host_ip, nameserver_port=nameserver_host_port)
-
-
     # ---------------------------------------------------------------------------- #
     # Initialize Models
     # ---------------------------------------------------------------------------- #
     agent_configs_dir = os.path.join(configs_root_dir, 'agent.yaml')
     with open(agent_configs_dir) as f:
         agent_configs = yaml.load(f, Loader=yaml.FullLoader)
-    device = agent_configs['device']
+    device = agent_configs['device'] if args.device is None else args.device
 
     preprocess_configs_dir = os.path.join(configs_root_dir, 'preprocess.yaml')
     with open(preprocess_configs_dir) as f:
@@ -67,23 +432,38 @@ if __name__ == '__main__':
     with open(server_configs_dir) as f:
         server_configs = yaml.load(f, Loader=yaml.FullLoader)
         
-    pick_agent = DiffusionEdfAgent(
-        model_kwargs_list=agent_configs['model_kwargs'][f"pick_models_kwargs"],
-        preprocess_config=preprocess_config,
-        unprocess_config=unprocess_config,
-        device=device,
-        compile_score_head=compile_score_head,
-        critic_kwargs=agent_configs['model_kwargs'].get(f"pick_critic_kwargs", None)
-    )
+    def build_agent(task_name: str, agent_kwargs: Dict[str, Any]) -> DiffusionEdfAgent:
+        return DiffusionEdfAgent(
+            model_kwargs_list=agent_kwargs['model_kwargs_list'],
+            preprocess_config=preprocess_config,
+            unprocess_config=unprocess_config,
+            device=device,
+            compile_score_head=compile_score_head,
+            critic_kwargs=agent_kwargs['critic_kwargs'],
+            feature_cache_bytes=agent_configs.get('feature_cache_bytes', 256 * 1024**2)
+        )
 
-    place_agent = DiffusionEdfAgent(
-        model_kwargs_list=agent_configs['model_kwargs'][f"place_models_kwargs"],
-        preprocess_config=preprocess_config,
-        unprocess_config=unprocess_config,
-        device=device,
-        compile_score_head=compile_score_head,
-        critic_kwargs=agent_configs['model_kwargs'].get(f"place_critic_kwargs", None)
+    serving_configs: Dict[str, Any] = server_configs.get('serving_configs', {})
+    models = ModelRegistry(
+        build_fn=build_agent,
+        kwargs_by_task={task_name: {'model_kwargs_list': agent_configs['model_kwargs'][f"{task_name}_models_kwargs"],
+                                    'critic_kwargs': agent_configs['model_kwargs'].get(f"{task_name}_critic_kwargs", None)}
+                        for task_name in ('pick', 'place')},
+        max_bytes=serving_configs.get('max_model_bytes', None)
     )
+    n_processes: int = serving_configs.get('n_processes', 1) if args.n_processes is None else args.n_processes
+    if n_processes > 1:
+        if torch.device(device).type != 'cpu':
+            raise ValueError(f"Pre-forked workers (n_processes: {n_processes}) need a CPU device (got '{device}'), as CUDA cannot be used after a fork.")
+        # The OpenMP thread pool of the parent would deadlock the forked workers (see WorkerPool), 
+        # so the models are built and warmed up single-threaded here, and warmed up again in each worker.
+        torch.set_num_threads(1)
+        for task_name in ('pick', 'place'):   # Loaded once here and shared with the workers
+            with models.use(task_name) as agent:
+                share_agent_weights(agent)
+    else:
+        for task_name in serving_configs.get('preload_tasks', []):
+            models.load(task_name)
 
     @beartype
     class AgentService():
@@ -98,6 +478,39 @@ if __name__ == '__main__':
                                            'place_trajectory_configs']
             for config_name in self.reconfigurable_configs:
                 assert hasattr(self, config_name)
+
+            serving_configs: Dict[str, Any] = configs.get('serving_configs', {})
+            mode = serving_configs.get('mode', 'sequential')
+            if mode == 'sequential':    # Requests are still queued by priority, but served one at a time
+                max_batch_size, max_wait_s = 1, 0.
+            elif mode == 'batched':
+                max_batch_size, max_wait_s = serving_configs.get('max_batch_size', 8), serving_configs.get('max_wait_ms', 20) / 1000.
+            else:
+                raise ValueError(f"Unknown serving mode '{mode}' (available: 'sequential', 'batched')")
+            self.batcher = DynamicBatcher(batch_fn=self._denoise_batch,
+                                          n_workers=serving_configs.get('n_workers', 1),
+                                          max_batch_size=max_batch_size,
+                                          max_wait_s=max_wait_s,
+                                          name='agent')
+
+            self.unprocess_poses = compose_pose_unprocess_fn(unprocess_config=unprocess_config)   # Same for every agent, so that no model needs to be loaded
+
+            self.max_warm_start_sessions: int = serving_configs.get('max_warm_start_sessions', 64)
+            self.warm_start_cache: OrderedDict = OrderedDict()     # (session_id, task_name) -> best poses of the last request of the session
+            self.warm_start_lock = threading.Lock()
+
+            self.shared_memory: bool = serving_configs.get('shared_memory', True)
+            self.shm_store = SharedSegmentStore(max_age_s=serving_configs.get('shm_result_max_age_s', 60.))   # Result segments of denoise_shm
+            self.worker_warmups: int = serving_configs.get('worker_warmups', 3)
+
+        def warmup(self):
+            """
+            Warm up the resident models at the thread count of this process (called by the workers of the pre-fork mode, see _worker_main).
+            """
+            for task_name in models.resident_tasks():
+                with models.use(task_name) as agent:
+                    for model in agent.models + ([] if agent.critic is None else [agent.critic]):
+                        warmup_with_synthetic_inputs(score_model=model, n_warmups=self.worker_warmups)
         
         def _reconfigure(self, name: str, value: Dict[str, Any]):
             if name not in self.reconfigurable_configs:
@@ -108,6 +521,7 @@ if __name__ == '__main__':
         @expose
         def reconfigure(self, name: str, value: Dict[str, Any]) -> bool:
             self._reconfigure(name=name, value=value)
+            return True
 
         @expose
         def get_configs(self) -> Dict[str, Any]:
@@ -137,77 +551,228 @@ if __name__ == '__main__':
             return trajectories
 
 
+        @expose
+        def swap_checkpoint(self, task_name: str, 
+                            model_kwargs_list: Optional[List[Dict[str, Any]]] = None,
+                            critic_kwargs: Optional[Dict[str, Any]] = None,
+                            wait: bool = False) -> str:
+            """
+            Swap in other checkpoints for a task while the current models keep serving (see ModelRegistry.swap), e.g.,
+                swap_checkpoint('pick', model_kwargs_list=[{'checkpoint_dir': 'Pick_LowRes_400.pt'}, {'checkpoint_dir': 'Pick_HiRes_400.pt'}])
+            Returns 'building', or the final status ('done' or 'failed: <error>') if wait is True. See swap_status.
+            """
+            return models.swap(task_name=task_name, model_kwargs_list=model_kwargs_list, critic_kwargs=critic_kwargs, wait=wait)
+
+        @expose
+        def swap_status(self, task_name: str) -> str:
+            return models.swap_status(task_name=task_name)
+
+        @expose
+        def unload_models(self, task_name: str) -> bool:
+            """
+            Free the models of a task. They are loaded again on the next request of the task.
+            """
+            return models.unload(task_name=task_name)
+
+        @expose
+        def model_stats(self) -> Dict[str, Any]:
+            return models.stats()
+
+        def _get_diffusion_configs(self, task_name: str) -> Dict[str, Any]:
+            if task_name == 'pick':
+                return self.pick_diffusion_configs
+            elif task_name == 'place':
+                return self.place_diffusion_configs
+            else:
+                raise ValueError(f"Unknown task name '{task_name}'")
+
+        def _sampling_kwargs(self, task_name: str) -> Dict[str, Any]:
+            diffusion_configs = self._get_diffusion_configs(task_name)
+            return dict(
+                N_steps_list=diffusion_configs['N_steps_list'], 
+                timesteps_list=diffusion_configs['timesteps_list'], 
+                temperatures_list=diffusion_configs['temperatures_list'],
+                diffusion_schedules_list=diffusion_configs['diffusion_schedules_list'],
+                log_t_schedule=diffusion_configs['log_t_schedule'],
+                time_exponent_temp=diffusion_configs['time_exponent_temp'],
+                time_exponent_alpha=diffusion_configs['time_exponent_alpha'],
+                neighbor_skin=diffusion_configs.get('neighbor_skin', None),
+                max_edges=diffusion_configs.get('max_edges', None),
+                max_bytes=diffusion_configs.get('max_bytes', None),
+                convergence_tol=diffusion_configs.get('convergence_tol', None),
+                convergence_window=diffusion_configs.get('convergence_window', 5),
+                integrator=diffusion_configs.get('integrator', 'euler_maruyama'),
+                prune_between_stages=diffusion_configs.get('prune_between_stages', None),
+                time_budget_s=diffusion_configs.get('time_budget_s', None),
+                warm_start_model=(diffusion_configs.get('warm_start', None) or {}).get('start_model', 1),
+                warm_start_time=(diffusion_configs.get('warm_start', None) or {}).get('time', None),
+            )
+
+        def _split_warm_start_seeds(self, session_id: Optional[str], task_name: str, current_poses: data.SE3) -> Tuple[data.SE3, Optional[data.SE3]]:
+            """
+            If warm starts are configured and the session has a previous request, the last fraction of the initial poses 
+            is replaced by the best poses of that request (repeated as needed), which the agent perturbs and starts at a later model.
+            """
+            warm_start_configs = self._get_diffusion_configs(task_name).get('warm_start', None)
+            if session_id is None or warm_start_configs is None:
+                return current_poses, None
+            with self.warm_start_lock:
+                best_poses: Optional[data.SE3] = self.warm_start_cache.get((session_id, task_name), None)
+                if best_poses is not None:
+                    self.warm_start_cache.move_to_end((session_id, task_name))
+            if best_poses is None:
+                return current_poses, None
+            n_warm = min(int(round(warm_start_configs.get('fraction', 0.5) * len(current_poses))), len(current_poses) - 1)   # Keep at least one cold seed
+            if n_warm <= 0:
+                return current_poses, None
+            warm_poses = data.SE3(poses=best_poses.poses[torch.arange(n_warm) % len(best_poses)])
+            return data.SE3(poses=current_poses.poses[:len(current_poses) - n_warm]), warm_poses
+
+        def _remember_session(self, session_id: Optional[str], task_name: str, Ts: torch.Tensor):
+            warm_start_configs = self._get_diffusion_configs(task_name).get('warm_start', None)
+            if session_id is None or warm_start_configs is None:
+                return
+            best_poses = Ts[-1, :warm_start_configs.get('n_top', 4)].detach().cpu()     # Sorted by the critic energy if there is a critic
+            best_poses = data.SE3(poses=self.unprocess_poses(best_poses))
+            with self.warm_start_lock:
+                self.warm_start_cache[(session_id, task_name)] = best_poses
+                self.warm_start_cache.move_to_end((session_id, task_name))
+                while len(self.warm_start_cache) > self.max_warm_start_sessions:
+                    self.warm_start_cache.popitem(last=False)
+
         def _denoise(self, scene_pcd: data.PointCloud, 
                      grasp_pcd: data.PointCloud,
                      current_poses: data.SE3,
                      task_name: str,
+                     retention: str = 'full',
+                     retain_every: int = 1,
+                     priority: int = 0,
+                     deadline_s: Optional[Union[int, float]] = None,
+                     request_id: Optional[str] = None,
+                     session_id: Optional[str] = None,
                      ) -> Tuple[torch.Tensor, Dict[str, Any]]:
+            current_poses, warm_start_poses = self._split_warm_start_seeds(session_id=session_id, task_name=task_name, current_poses=current_poses)
+            try:
+                Ts, info = self.batcher.run(batch_key=(task_name, retention, retain_every), payload=(scene_pcd, grasp_pcd, current_poses, warm_start_poses),
+                                            priority=priority, deadline_s=deadline_s, request_id=request_id)
+            except DeadlineExceeded as e:   # Builtin exceptions, which Pyro can send to the client
+                raise TimeoutError(str(e)) from None
+            except RequestCancelled as e:
+                raise RuntimeError(str(e)) from None
+            self._remember_session(session_id=session_id, task_name=task_name, Ts=Ts)
+            return Ts, info
+
+        def _denoise_single(self, scene_pcd: data.PointCloud, 
+                            grasp_pcd: data.PointCloud,
+                            current_poses: data.SE3,
+                            task_name: str,
+                            retention: str = 'full',
+                            retain_every: int = 1,
+                            should_stop: Optional[Callable[[], bool]] = None,
+                            warm_start_poses: Optional[data.SE3] = None,
+                            ) -> Tuple[torch.Tensor, Dict[str, Any]]:
             
             assert current_poses.poses.ndim == 2 and current_poses.poses.shape[-1] == 7, f"{current_poses.shape}"
-            n_init_poses = len(current_poses)
+            n_init_poses = len(current_poses) + (0 if warm_start_poses is None else len(warm_start_poses))
             
-            if task_name == 'pick':
-                Ts, scene_proc, grasp_proc, info = pick_agent.sample(
+            with models.use(task_name) as agent:
+                Ts, scene_proc, grasp_proc, info = agent.sample(
                     scene_pcd=scene_pcd.to(device), 
                     grasp_pcd=grasp_pcd.to(device), 
                     Ts_init=current_poses.to(device),
-                    N_steps_list=self.pick_diffusion_configs['N_steps_list'], 
-                    timesteps_list=self.pick_diffusion_configs['timesteps_list'], 
-                    temperatures_list=self.pick_diffusion_configs['temperatures_list'],
-                    diffusion_schedules_list=self.pick_diffusion_configs['diffusion_schedules_list'],
-                    log_t_schedule=self.pick_diffusion_configs['log_t_schedule'],
-                    time_exponent_temp=self.pick_diffusion_configs['time_exponent_temp'],
-                    time_exponent_alpha=self.pick_diffusion_configs['time_exponent_alpha'],
-                    return_info=True
+                    warm_start_poses=None if warm_start_poses is None else warm_start_poses.to(device),
+                    retention=retention,
+                    retain_every=retain_every,
+                    should_stop=should_stop,
+                    return_info=True,
+                    **self._sampling_kwargs(task_name)
                 )
 
-                assert Ts.ndim == 3 and Ts.shape[-2] == n_init_poses and Ts.shape[-1] == 7, f"{Ts.shape}"
+            assert Ts.ndim == 3 and Ts.shape[-2] <= n_init_poses and Ts.shape[-1] == 7, f"{Ts.shape}"     # Poses may be pruned between the models
 
-            elif task_name == 'place':
-                Ts, scene_proc, grasp_proc, info = place_agent.sample(
-                    scene_pcd=scene_pcd.to(device), 
-                    grasp_pcd=grasp_pcd.to(device), 
-                    Ts_init=current_poses.to(device),
-                    N_steps_list=self.place_diffusion_configs['N_steps_list'], 
-                    timesteps_list=self.place_diffusion_configs['timesteps_list'], 
-                    temperatures_list=self.place_diffusion_configs['temperatures_list'],
-                    diffusion_schedules_list=self.place_diffusion_configs['diffusion_schedules_list'],
-                    log_t_schedule=self.place_diffusion_configs['log_t_schedule'],
-                    time_exponent_temp=self.place_diffusion_configs['time_exponent_temp'],
-                    time_exponent_alpha=self.place_diffusion_configs['time_exponent_alpha'],
-                    return_info=True
-                )
+            return Ts, info
 
-                assert Ts.ndim == 3 and Ts.shape[-2] == n_init_poses and Ts.shape[-1] == 7, f"{Ts.shape}"
-            else:
-                raise ValueError(f"Unknown task name '{task_name}'")
+        def _denoise_batch(self, batch_key: Tuple[str, str, int], 
+                           payloads: List[Tuple[data.PointCloud, data.PointCloud, data.SE3, Optional[data.SE3]]],
+                           should_stop: Callable[[], bool]) -> List[Tuple[torch.Tensor, Dict[str, Any]]]:
+            """
+            batch_fn of the DynamicBatcher. Requests of the same task (and retention) are sampled together by DiffusionEdfAgent.sample_batched.
+            Requests are not merged if neighbor lists or an edge budget (neighbor_skin, max_edges, max_bytes) are configured, 
+            as the batched sampler does not support them.
+            """
+            task_name, retention, retain_every = batch_key
+            sampling_kwargs = self._sampling_kwargs(task_name)
+            if len(payloads) == 1 or any(sampling_kwargs[key] is not None for key in ('neighbor_skin', 'max_edges', 'max_bytes')):
+                return [self._denoise_single(scene_pcd=scene_pcd, grasp_pcd=grasp_pcd, current_poses=current_poses, task_name=task_name,
+                                             retention=retention, retain_every=retain_every, should_stop=should_stop, warm_start_poses=warm_start_poses)
+                        for scene_pcd, grasp_pcd, current_poses, warm_start_poses in payloads]
 
-            return Ts, info
+            for _, _, current_poses, _ in payloads:
+                assert current_poses.poses.ndim == 2 and current_poses.poses.shape[-1] == 7, f"{current_poses.shape}"
+            sampling_kwargs.pop('neighbor_skin')
+            with models.use(task_name) as agent:
+                Ts_list, _, _, info_list = agent.sample_batched(
+                    scene_pcd_list=[scene_pcd.to(device) for scene_pcd, _, _, _ in payloads], 
+                    grasp_pcd_list=[grasp_pcd.to(device) for _, grasp_pcd, _, _ in payloads], 
+                    Ts_init_list=[current_poses.to(device) for _, _, current_poses, _ in payloads],
+                    warm_start_poses_list=[None if warm_start_poses is None else warm_start_poses.to(device) for _, _, _, warm_start_poses in payloads],
+                    retention=retention,
+                    retain_every=retain_every,
+                    should_stop=should_stop,
+                    return_info=True,
+                    **sampling_kwargs
+                )
+            for Ts, (_, _, current_poses, warm_start_poses) in zip(Ts_list, payloads):
+                n_init_poses = len(current_poses) + (0 if warm_start_poses is None else len(warm_start_poses))
+                assert Ts.ndim == 3 and Ts.shape[-2] <= n_init_poses and Ts.shape[-1] == 7, f"{Ts.shape}"     # Poses may be pruned between the models
+            return list(zip(Ts_list, info_list))
         
+        @expose
+        def cancel(self, request_id: str) -> bool:
+            """
+            Cancel a pending or running request of denoise or request_trajectories. 
+            The request fails with RuntimeError, and a running one stops at the next denoising step (unless it shares a batch with requests that are not cancelled).
+            Returns False if no such request is pending or running.
+            """
+            return self.batcher.cancel(request_id=request_id)
+
         @expose
         def denoise(self, scene_pcd: data.PointCloud, 
                      grasp_pcd: data.PointCloud,
                      current_poses: data.SE3,
                      task_name: str,
+                     priority: int = 0,
+                     deadline_s: Optional[Union[int, float]] = None,
+                     request_id: Optional[str] = None,
+                     session_id: Optional[str] = None,
                      ) -> Tuple[List[data.SE3], Dict[str, Any]]:
-            traj_tensors, info = self._denoise(scene_pcd=scene_pcd, grasp_pcd=grasp_pcd, current_poses=current_poses, task_name=task_name)
-            traj_tensors = traj_tensors.detach().cpu()
-            trajectories = []
-            for i in range(traj_tensors.shape[-2]):
-                Ts = traj_tensors[:,i]
-                Ts = data.SE3(poses=Ts)
-
-                if task_name == 'pick':
-                    unproc_fn = pick_agent.unprocess_fn
-                    Ts = unproc_fn(Ts)
-                elif task_name == 'place':
-                    unproc_fn = place_agent.unprocess_fn
-                    Ts = unproc_fn(Ts)
-                else:
-                    raise ValueError(f"Unknown task name: '{task_name}'")
-                
-                trajectories.append(Ts)
-                
+            """
+            priority: Requests of higher priority are served first.
+            deadline_s: If set, the request fails with TimeoutError if it is not done this many seconds after it is received.
+            request_id: If set, the request can be cancelled with cancel(request_id).
+            session_id: Client session. If warm_start is set in the diffusion configs, part of the initial poses is replaced 
+                by the best poses of the previous request of the same session and task (see DiffusionEdfAgent.sample).
+            """
+            traj_tensors, info = self._denoise_trajectories(scene_pcd=scene_pcd, grasp_pcd=grasp_pcd, current_poses=current_poses, task_name=task_name,
+                                                            priority=priority, deadline_s=deadline_s, request_id=request_id, session_id=session_id)
+            trajectories = [data.SE3(poses=Ts) for Ts in traj_tensors.unbind(dim=-2)]
+            return trajectories, info
+
+        def _denoise_trajectories(self, scene_pcd: data.PointCloud, 
+                                  grasp_pcd: data.PointCloud,
+                                  current_poses: data.SE3,
+                                  task_name: str,
+                                  priority: int = 0,
+                                  deadline_s: Optional[Union[int, float]] = None,
+                                  request_id: Optional[str] = None,
+                                  session_id: Optional[str] = None,
+                                  ) -> Tuple[torch.Tensor, Dict[str, Any]]:
+            diffusion_configs = self.pick_diffusion_configs if task_name == 'pick' else self.place_diffusion_configs
+            traj_tensors, info = self._denoise(scene_pcd=scene_pcd, grasp_pcd=grasp_pcd, current_poses=current_poses, task_name=task_name,
+                                               retention=diffusion_configs.get('retention', 'full'),
+                                               retain_every=diffusion_configs.get('retain_every', 1),
+                                               priority=priority, deadline_s=deadline_s, request_id=request_id, session_id=session_id)
+            traj_tensors = self.unprocess_poses(traj_tensors.detach().cpu())    # (nFrames, nT, 7), all the poses at once
 
             # info = {}
             def recursive_cuda_to_cpu(info: Dict):
@@ -218,31 +783,33 @@ if __name__ == '__main__':
                         info[k]=recursive_cuda_to_cpu(v)
             recursive_cuda_to_cpu(info)
             
-            return Ts, info
-            
-            
-            
+            return traj_tensors, info
         
         @expose
         def request_trajectories(self, scene_pcd: data.PointCloud, 
                                  grasp_pcd: data.PointCloud,
                                  current_poses: data.SE3,
                                  task_name: str,
+                                 priority: int = 0,
+                                 deadline_s: Optional[Union[int, float]] = None,
+                                 request_id: Optional[str] = None,
+                                 session_id: Optional[str] = None,
                                  ) -> Tuple[List[data.SE3], Dict[str, Any]]:
+            """
+            priority, deadline_s, request_id, session_id: See denoise.
+            """
             denoise_seq, info = self._denoise(
-                scene_pcd=scene_pcd, grasp_pcd=grasp_pcd, current_poses=current_poses, task_name=task_name
-            ) # (n_time, n_init_pose, 7)
+                scene_pcd=scene_pcd, grasp_pcd=grasp_pcd, current_poses=current_poses, task_name=task_name,
+                retention='final_only',    # Only the final poses are needed
+                priority=priority, deadline_s=deadline_s, request_id=request_id, session_id=session_id
+            ) # (1, n_init_pose, 7)
             denoise_seq = denoise_seq.to(device='cpu')
 
-            Ts = data.SE3(poses=denoise_seq[-1])
+            Ts = data.SE3(poses=self.unprocess_poses(denoise_seq[-1]))
 
             if task_name == 'pick':
-                unproc_fn = pick_agent.unprocess_fn
-                Ts = unproc_fn(Ts)
                 trajectories = self.compute_pick_trajectory(pick_poses=Ts)
             elif task_name == 'place':
-                unproc_fn = place_agent.unprocess_fn
-                Ts = unproc_fn(Ts)
                 trajectories = self.compute_place_trajectory(place_poses=Ts, scene_pcd=scene_pcd, grasp_pcd=grasp_pcd)
             else:
                 raise ValueError(f"Unknown task name: '{task_name}'")
@@ -257,11 +824,202 @@ if __name__ == '__main__':
             recursive_cuda_to_cpu(info)
 
             return trajectories, info
+
+        # ---------------------------------------------------------------------------- #
+        # Shared-memory transport (diffusion_edf/shm_transport.py)
+        # ---------------------------------------------------------------------------- #
+        def _check_shared_memory(self):
+            if not self.shared_memory:
+                raise RuntimeError("The shared-memory transport is disabled (serving_configs.shared_memory).")
+
+        @expose
+        def shm_probe(self, descriptor: Dict[str, Any]) -> bool:
+            """
+            Whether the client can use the shared-memory transport, i.e., whether it is enabled and the server can attach to a segment of the client.
+            """
+            if not self.shared_memory:
+                return False
+            try:
+                SharedTensors(descriptor=descriptor, copy=True)
+            except (FileNotFoundError, OSError, ValueError, KeyError):   # Client on another host
+                return False
+            return True
+
+        @expose
+        def denoise_shm(self, request: Dict[str, Any],
+                        task_name: str,
+                        priority: int = 0,
+                        deadline_s: Optional[Union[int, float]] = None,
+                        request_id: Optional[str] = None,
+                        session_id: Optional[str] = None,
+                        ) -> Tuple[Dict[str, Any], Dict[str, Any]]:
+            """
+            denoise with the point clouds and initial poses in a shared-memory segment of the client (descriptor of shm_transport.request_tensors).
+            The trajectories, of shape (nFrames, nT, 7), are returned in a segment of the server whose descriptor comes with the info.
+            The client must call release_shm with the name of that segment once it has read it (otherwise it is unlinked after serving_configs.shm_result_max_age_s).
+            """
+            self._check_shared_memory()
+            with SharedTensors(descriptor=request) as tensors:
+                scene_pcd, grasp_pcd, current_poses = request_from_tensors(tensors)
+                traj_tensors, info = self._denoise_trajectories(scene_pcd=scene_pcd, grasp_pcd=grasp_pcd, current_poses=current_poses, task_name=task_name,
+                                                                priority=priority, deadline_s=deadline_s, request_id=request_id, session_id=session_id)
+            return self.shm_store.create({'trajectories': traj_tensors}), info
+
+        @expose
+        def request_trajectories_shm(self, request: Dict[str, Any],
+                                     task_name: str,
+                                     priority: int = 0,
+                                     deadline_s: Optional[Union[int, float]] = None,
+                                     request_id: Optional[str] = None,
+                                     session_id: Optional[str] = None,
+                                     ) -> Tuple[List[data.SE3], Dict[str, Any]]:
+            """
+            request_trajectories with the point clouds and initial poses in a shared-memory segment of the client (see denoise_shm).
+            The trajectories are small, and are returned as request_trajectories does.
+            """
+            self._check_shared_memory()
+            with SharedTensors(descriptor=request) as tensors:
+                scene_pcd, grasp_pcd, current_poses = request_from_tensors(tensors)
+                output = self.request_trajectories(scene_pcd=scene_pcd, grasp_pcd=grasp_pcd, current_poses=current_poses, task_name=task_name,
+                                                   priority=priority, deadline_s=deadline_s, request_id=request_id, session_id=session_id)
+            return output
+
+        @expose
+        def release_shm(self, name: str) -> bool:
+            """
+            Release the client's reference to a result segment of denoise_shm.
+            """
+            return self.shm_store.release(name=name)
+
+        def close(self):
+            self.batcher.close()
+            self.shm_store.close()
+
+
+    @beartype
+    class AgentDispatcher():
+        """
+        Pyro service of the pre-fork mode (serving_configs.n_processes > 1), with the same methods as AgentService.
+        Requests are routed to the AgentService of a worker process of a WorkerPool: the requests of a session always go to the same worker
+        (which holds its warm starts), and the others to the least busy worker. Reconfigurations and model management apply to every worker.
+        Models swapped in after the fork are loaded by each worker separately, and are not shared.
+        """
+        def __init__(self, pool: WorkerPool):
+            self.pool = pool
+            self.shm_workers: Dict[str, int] = {}    # Result segment of denoise_shm -> worker that owns it
+            self.shm_lock = threading.Lock()
+
+        @expose
+        def reconfigure(self, name: str, value: Dict[str, Any]) -> bool:
+            return all(self.pool.broadcast('reconfigure', dict(name=name, value=value)))
+
+        @expose
+        def get_configs(self) -> Dict[str, Any]:
+            return self.pool.call_worker(0, 'get_configs', {})
+
+        @expose
+        def cancel(self, request_id: str) -> bool:
+            return any(self.pool.broadcast('cancel', dict(request_id=request_id)))
+
+        @expose
+        def denoise(self, scene_pcd: data.PointCloud, grasp_pcd: data.PointCloud, current_poses: data.SE3, task_name: str,
+                    priority: int = 0, deadline_s: Optional[Union[int, float]] = None, request_id: Optional[str] = None, session_id: Optional[str] = None,
+                    ) -> Tuple[List[data.SE3], Dict[str, Any]]:
+            return self.pool.call('denoise', dict(scene_pcd=scene_pcd, grasp_pcd=grasp_pcd, current_poses=current_poses, task_name=task_name,
+                                                  priority=priority, deadline_s=deadline_s, request_id=request_id, session_id=session_id),
+                                  route_key=session_id)
+
+        @expose
+        def request_trajectories(self, scene_pcd: data.PointCloud, grasp_pcd: data.PointCloud, current_poses: data.SE3, task_name: str,
+                                 priority: int = 0, deadline_s: Optional[Union[int, float]] = None, request_id: Optional[str] = None, session_id: Optional[str] = None,
+                                 ) -> Tuple[List[data.SE3], Dict[str, Any]]:
+            return self.pool.call('request_trajectories', dict(scene_pcd=scene_pcd, grasp_pcd=grasp_pcd, current_poses=current_poses, task_name=task_name,
+                                                               priority=priority, deadline_s=deadline_s, request_id=request_id, session_id=session_id),
+                                  route_key=session_id)
+
+        @expose
+        def shm_probe(self, descriptor: Dict[str, Any]) -> bool:
+            return self.pool.call('shm_probe', dict(descriptor=descriptor))
+
+        @expose
+        def denoise_shm(self, request: Dict[str, Any], task_name: str,
+                        priority: int = 0, deadline_s: Optional[Union[int, float]] = None, request_id: Optional[str] = None, session_id: Optional[str] = None,
+                        ) -> Tuple[Dict[str, Any], Dict[str, Any]]:
+            worker = self.pool.route(session_id)
+            result, info = self.pool.call_worker(worker, 'denoise_shm', dict(request=request, task_name=task_name,
+                                                                             priority=priority, deadline_s=deadline_s, request_id=request_id, session_id=session_id))
+            with self.shm_lock:
+                self.shm_workers[result['name']] = worker
+            return result, info
+
+        @expose
+        def request_trajectories_shm(self, request: Dict[str, Any], task_name: str,
+                                     priority: int = 0, deadline_s: Optional[Union[int, float]] = None, request_id: Optional[str] = None, session_id: Optional[str] = None,
+                                     ) -> Tuple[List[data.SE3], Dict[str, Any]]:
+            return self.pool.call('request_trajectories_shm', dict(request=request, task_name=task_name,
+                                                                   priority=priority, deadline_s=deadline_s, request_id=request_id, session_id=session_id),
+                                  route_key=session_id)
+
+        @expose
+        def release_shm(self, name: str) -> bool:
+            with self.shm_lock:
+                worker = self.shm_workers.pop(name, None)
+            if worker is None:
+                return False
+            return self.pool.call_worker(worker, 'release_shm', dict(name=name))
+
+        @expose
+        def swap_checkpoint(self, task_name: str, 
+                            model_kwargs_list: Optional[List[Dict[str, Any]]] = None,
+                            critic_kwargs: Optional[Dict[str, Any]] = None,
+                            wait: bool = False) -> str:
+            statuses = self.pool.broadcast('swap_checkpoint', dict(task_name=task_name, model_kwargs_list=model_kwargs_list, critic_kwargs=critic_kwargs, wait=wait))
+            return self._merge_statuses(statuses)
+
+        @expose
+        def swap_status(self, task_name: str) -> str:
+            return self._merge_statuses(self.pool.broadcast('swap_status', dict(task_name=task_name)))
+
+        @staticmethod
+        def _merge_statuses(statuses: List[str]) -> str:
+            for status in statuses:
+                if status.startswith('failed'):
+                    return status
+            for status in ('building', 'none'):
+                if status in statuses:
+                    return status
+            return statuses[0]
+
+        @expose
+        def unload_models(self, task_name: str) -> bool:
+            return any(self.pool.broadcast('unload_models', dict(task_name=task_name)))
+
+        @expose
+        def model_stats(self) -> Dict[str, Any]:
+            return {'workers': self.pool.broadcast('model_stats', {})}
+
+        def close(self):
+            self.pool.close()
         
 
-    server.register_service(service=AgentService(configs=server_configs))
+    if n_processes > 1:
+        # Forked before the Pyro server starts any thread
+        n_threads = serving_configs.get('threads_per_process', None) or max(1, (os.cpu_count() or 1) // n_processes)
+        pool = WorkerPool(make_service=lambda: AgentService(configs=server_configs), n_workers=n_processes, n_threads=n_threads)
+        service = AgentDispatcher(pool=pool)
+    else:
+        service = AgentService(configs=server_configs)
+
+
+    # ---------------------------------------------------------------------------- #
+    # Initialize Pyro Server
+    # ---------------------------------------------------------------------------- #
+    server = PyroServer(server_name='agent', init_nameserver=init_nameserver, 
+                        nameserver_host=nameserver_host_ip, nameserver_port=nameserver_host_port)
+    server.register_service(service=service)
     server.run(nonblocking=False)
 
+    service.close()
     server.close()
 
 
@@ -4,6 +4,8 @@ import torch
 from torch_cluster import radius_graph, radius, fps, graclus
 from torch_scatter import scatter_add, scatter_mean
 
+from diffusion_edf.spatial_index import SpatialIndex, radius_query
+
 
 class RadiusGraph(torch.nn.Module):
     def __init__(self, r: float, max_num_neighbors: int):
@@ -38,8 +40,15 @@ class RadiusConnect(torch.nn.Module):
             raise NotImplementedError
         self.offset = offset
 
-    def forward(self, node_coord_src: torch.Tensor, batch_src: torch.Tensor, node_coord_dst: torch.Tensor, batch_dst: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
-        edge = radius(x = node_coord_src, y = node_coord_dst, r=self.r, batch_x=batch_src, batch_y=batch_dst, max_num_neighbors=self.max_num_neighbors)
+    def forward(self, node_coord_src: torch.Tensor, batch_src: torch.Tensor, node_coord_dst: torch.Tensor, batch_dst: torch.Tensor,
+                src_index: Optional[SpatialIndex] = None) -> Tuple[torch.Tensor, torch.Tensor]:
+        """
+        If src_index (prebuilt on node_coord_src and batch_src) is given, it is probed instead of building a search structure from scratch.
+        """
+        if src_index is None:
+            edge = radius(x = node_coord_src, y = node_coord_dst, r=self.r, batch_x=batch_src, batch_y=batch_dst, max_num_neighbors=self.max_num_neighbors)
+        else:
+            edge = radius_query(index=src_index, y=node_coord_dst, r=self.r, batch_y=batch_dst, max_num_neighbors=self.max_num_neighbors)
         edge_dst = edge[0]
         edge_src = edge[1]
 
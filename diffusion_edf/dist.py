@@ -271,7 +271,8 @@ def diffuse_isotropic_se3(T0: torch.Tensor,
                                                                   SE3_SCORE_TYPE, 
                                                                   SE3_SCORE_TYPE]:
     assert T0.ndim == 2 and T0.shape[-1] == 7  # T0: shape (nT, 7)
-    assert x_ref.ndim == 2 and x_ref.shape[-1] == 3 # x_ref: shape (nT, 3)
+    if x_ref is not None:
+        assert x_ref.ndim == 2 and x_ref.shape[-1] == 3 # x_ref: shape (nT, 3)
 
     input_dtype = T0.dtype
     if double_precision:
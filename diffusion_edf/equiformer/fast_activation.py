@@ -27,6 +27,25 @@ class SmoothLeakyReLU(torch.nn.Module):
         return 'negative_slope={}'.format(self.alpha)
 
 
+def _same_activation(act1: torch.nn.Module, act2: torch.nn.Module) -> bool:
+    '''
+        Whether two activations (normalize2mom-wrapped, or Identity) compute the same function.
+        Parameter-free modules of the same type and representation (e.g., two torch.nn.SiLU()) count as the same function.
+    '''
+    if act1 is act2:
+        return True
+    f1, f2 = getattr(act1, 'f', act1), getattr(act2, 'f', act2)
+    if getattr(act1, 'cst', None) != getattr(act2, 'cst', None) or type(act1) is not type(act2):
+        return False
+    if f1 is f2:
+        return True
+    if not (isinstance(f1, torch.nn.Module) and isinstance(f2, torch.nn.Module)) or type(f1) is not type(f2):
+        return False
+    if any(True for _ in f1.parameters()) or any(True for _ in f2.parameters()):
+        return False
+    return repr(f1) == repr(f2)
+
+
 #@compile_mode('script')
 class Activation(torch.nn.Module):
     r"""Scalar activation function. 
@@ -109,10 +128,33 @@ class Activation(torch.nn.Module):
         
         assert len(self.irreps_in) == len(self.acts)
 
-        # If there is only one irrep in o3.Irreps, and the irrep is a scalar, then just apply the only activation to it.
-        # For example, "8x0e" is the case.
-        # On the other hand, "8x0e+7x0e", "8x1e", "8x0e+7x1e" is not the case.
-        if len(self.acts) == 1 and self.acts[0] is not None: # activation for non-scalar irrep cannot be 'None', thus the only irrep must be scalar (L=0).
+        # Runs of consecutive irreps with the same activation (or none) are applied at once, 
+        # e.g., "8x0e+7x0e" with two SiLU's is activated as a single 15x0e block, and "8x1e+4x2e" is passed through as is.
+        run_starts: List[int] = []
+        run_lengths: List[int] = []
+        run_acts: List[torch.nn.Module] = []
+        run_is_act_none: List[bool] = []
+        index = 0
+        for (mul, ir), act, is_act_none in zip(self.irreps_in, self.acts, self.is_acts_none):
+            if mul * ir.dim == 0:
+                continue
+            if run_acts and run_is_act_none[-1] == is_act_none and (is_act_none or _same_activation(run_acts[-1], act)):
+                run_lengths[-1] += mul * ir.dim
+            else:
+                run_starts.append(index)
+                run_lengths.append(mul * ir.dim)
+                run_acts.append(act)
+                run_is_act_none.append(is_act_none)
+            index += mul * ir.dim
+        self.run_starts = tuple(run_starts)
+        self.run_lengths = tuple(run_lengths)
+        self.run_acts = torch.nn.ModuleList(run_acts)
+        self.run_is_act_none = tuple(run_is_act_none)
+
+        # If all the irreps are activated by the same function, then just apply it to the whole input.
+        # For example, "8x0e" or "8x0e+7x0e" with the same activation is the case.
+        # On the other hand, "8x1e", "8x0e+7x1e" is not the case.
+        if len(self.run_acts) == 1 and not self.run_is_act_none[0]:
             self.simple: bool = True
         else:
             self.simple: bool = False
@@ -128,21 +170,17 @@ class Activation(torch.nn.Module):
     
 
     def forward(self, features: torch.Tensor, dim: int = -1) -> torch.Tensor:
-        # If there is only one irrep in o3.Irreps, and the irrep is a scalar, then just apply the only activation to it.
-        # For example, "8x0e" is the case.
-        # On the other hand, "8x0e+7x0e", "8x1e", "8x0e+7x1e" is not the case.
-        if self.simple: # activation for non-scalar irrep cannot be 'None', thus the only irrep must be scalar (L=0).
-            return self.acts[0](features)
+        # If all the irreps are activated by the same function, then just apply it to the whole input.
+        if self.simple:
+            return self.run_acts[0](features)
         
-        # Otherwise, same behavior as e3nn.nn.Activation.forward()
+        # Otherwise, same behavior as e3nn.nn.Activation.forward(), on the runs of irreps with the same activation
         output = []
-        index = 0
-        for (mul, ir), act, is_act_none in zip(self.irreps_in, self.acts, self.is_acts_none):
+        for start, length, act, is_act_none in zip(self.run_starts, self.run_lengths, self.run_acts, self.run_is_act_none):
             if not is_act_none:
-                output.append(act(features.narrow(dim, index, mul)))
+                output.append(act(features.narrow(dim, start, length)))
             else:
-                output.append(features.narrow(dim, index, mul * (2*ir[0] + 1)))
-            index += mul * (2*ir[0] + 1)
+                output.append(features.narrow(dim, start, length))
 
         if len(output) > 1:
             return torch.cat(output, dim=dim)
@@ -157,6 +195,8 @@ class Gate(torch.nn.Module):
     '''
         1. Use `narrow` to split tensor.
         2. Use `Activation` in this file.
+        3. Multiply the gated irreps by their gates gathered with precomputed indices, 
+           instead of calling `self.mul` (o3.ElementwiseTensorProduct, kept for its irreps).
     '''
     def __init__(self, irreps_scalars: o3.Irreps, act_scalars: List[Callable], 
                  irreps_gates: o3.Irreps, act_gates: List[Callable], 
@@ -201,6 +241,10 @@ class Gate(torch.nn.Module):
         self.gated_dim: int = self.irreps_gated.dim
         self.input_dim: int = self.irreps_in.dim
         assert self.scalars_dim + self.gates_dim + self.gated_dim == self.input_dim
+
+        # Index of the gate of each column of the gated irreps: gated * gates[..., gate_idx]
+        gate_idx = [i for i, ir in enumerate(ir for mul, ir in self.irreps_gated for _ in range(mul)) for _ in range(ir.dim)]
+        self.register_buffer('gate_idx', torch.tensor(gate_idx, dtype=torch.long), persistent=False)
         
 
     def __repr__(self):
@@ -217,7 +261,7 @@ class Gate(torch.nn.Module):
         scalars = self.act_scalars(scalars)
         if gates.shape[-1]:
             gates = self.act_gates(gates)
-            gated = self.mul(gated, gates)
+            gated = gated * gates.index_select(-1, self.gate_idx)
             features = torch.cat([scalars, gated], dim=-1)
         else:
             features = scalars
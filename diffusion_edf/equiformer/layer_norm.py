@@ -62,13 +62,23 @@ class EquivariantLayerNorm(torch.nn.Module):
     
 #@compile_mode('script')
 class EquivariantLayerNormV2(nn.Module):
-    
-    def __init__(self, irreps: Irreps, eps: float = 1e-5, affine: bool = True, normalization: str = 'component'):
+    """
+    Per-irrep layer norm: the scalars (0e) are centered over their multiplicity, and each irrep block is rescaled by the
+    root mean square of its norms, then by a learnable weight per irrep (and shifted by a learnable bias for the scalars).
+    All the irrep blocks are normalized at once: the segment means over the feature axis are products with constant
+    (dim, num_segments) matrices built from the segment index of each feature column, and the per-segment factors are
+    broadcast back to the columns by a (num_segments, dim) matrix. forward_per_irrep is the per-irrep reference.
+    The backward of these products is memory bound and no faster than that of forward_per_irrep on large inputs, 
+    so inputs of more than max_grad_numel elements that require gradients go through forward_per_irrep.
+    """
+    def __init__(self, irreps: Irreps, eps: float = 1e-5, affine: bool = True, normalization: str = 'component',
+                 max_grad_numel: int = 10_000_000):
         super().__init__()
 
         self.irreps: Irreps = Irreps(irreps)
         self.eps: float = eps
         self.affine: bool = affine
+        self.max_grad_numel: int = max_grad_numel
 
         num_scalar: int = sum(mul for mul, ir in self.irreps if ir.l == 0 and ir.p == 1)
         num_features: int = self.irreps.num_irreps
@@ -83,12 +93,91 @@ class EquivariantLayerNormV2(nn.Module):
         assert normalization in ['norm', 'component'], "normalization needs to be 'norm' or 'component'"
         self.normalization: str = normalization
 
+        # Segment (irrep block) and irrep-copy index of each feature column
+        segment_idx, irrep_idx, bias_idx = [], [], []
+        mean_matrix = torch.zeros(self.irreps.dim, len(self.irreps))   # Segment mean of the scalars (zero for the other irreps)
+        norm_matrix = torch.zeros(self.irreps.dim, len(self.irreps))   # Segment mean of the squared norms
+        ix, iw, ib = 0, 0, 0
+        for i, (mul, ir) in enumerate(self.irreps):
+            d = ir.dim
+            is_scalar = ir.l == 0 and ir.p == 1
+            if mul == 0:
+                continue
+            segment_idx += [i] * (mul * d)
+            irrep_idx += [iw + j for j in range(mul) for _ in range(d)]
+            bias_idx += [ib + j for j in range(mul)] if is_scalar else [num_scalar] * (mul * d)  # num_scalar: zero bias
+            if is_scalar:
+                mean_matrix[ix: ix + mul, i] = 1. / mul
+            norm_matrix[ix: ix + mul * d, i] = 1. / (mul * d) if normalization == 'component' else 1. / mul
+            ix, iw = ix + mul * d, iw + mul
+            ib += mul if is_scalar else 0
+        segment_idx = torch.tensor(segment_idx, dtype=torch.long)
+        expand_matrix = torch.zeros(len(self.irreps), self.irreps.dim)  # Broadcast of the segments to their columns
+        expand_matrix[segment_idx, torch.arange(self.irreps.dim)] = 1.
+        self.has_scalars: bool = num_scalar > 0
+        self.register_buffer('irrep_idx', torch.tensor(irrep_idx, dtype=torch.long), persistent=False)
+        self.register_buffer('bias_idx', torch.tensor(bias_idx, dtype=torch.long), persistent=False)
+        self.register_buffer('mean_matrix', mean_matrix, persistent=False)
+        self.register_buffer('norm_matrix', norm_matrix, persistent=False)
+        self.register_buffer('expand_matrix', expand_matrix, persistent=False)
+
 
     def __repr__(self):
         return f"{self.__class__.__name__}({self.irreps}, eps={self.eps})"
 
 
     def forward(self, node_input: torch.Tensor, batch: Optional[torch.Tensor] = None) -> torch.Tensor:
+        dim: int = node_input.shape[-1]
+        if dim != self.expand_matrix.shape[1]:
+            fmt: str = "`node_input.size(-1)` ({}) should be the dimension of the irreps ({})"
+            msg: str = fmt.format(dim, self.expand_matrix.shape[1])
+            raise AssertionError(msg)
+
+        affine_weight = self.affine_weight
+        affine_bias = self.affine_bias
+        requires_grad: bool = node_input.requires_grad
+        if affine_weight is not None:
+            requires_grad = requires_grad or affine_weight.requires_grad
+        if affine_bias is not None:
+            requires_grad = requires_grad or affine_bias.requires_grad
+        requires_grad = requires_grad and torch.is_grad_enabled()
+        if requires_grad and node_input.numel() > self.max_grad_numel:
+            return self.forward_per_irrep(node_input)
+
+        # Center the scalars: field = node_input - segment means broadcast to the columns (zero for l > 0)
+        field = node_input
+        if self.has_scalars:
+            field_mean = torch.matmul(node_input, self.mean_matrix)                             # [batch * sample, num_segments]
+            field = torch.addmm(node_input, field_mean, self.expand_matrix, beta=1., alpha=-1.)  # [batch * sample, dim]
+
+        # Rescaling factor of each segment: inverse root mean of its squared norms ("norm") or squared components ("component")
+        field_sq = field * field
+        field_norm = torch.matmul(field_sq, self.norm_matrix)                                  # [batch * sample, num_segments]
+        field_norm = (field_norm + self.eps).pow(-0.5)
+
+        # Broadcast to the columns, with the weight of each irrep folded into the broadcast matrix
+        expand_matrix = self.expand_matrix
+        if affine_weight is not None:
+            expand_matrix = expand_matrix * affine_weight.index_select(0, self.irrep_idx)
+        bias: Optional[torch.Tensor] = None
+        if affine_bias is not None:
+            bias = torch.cat([affine_bias, affine_bias.new_zeros(1)], dim=0).index_select(0, self.bias_idx)
+
+        if not requires_grad:
+            # Nothing to backpropagate: the output reuses the buffer of field_sq (fresh allocations of this size are page-faulted in)
+            output = torch.matmul(field_norm, expand_matrix, out=field_sq).mul_(field)
+            if bias is not None:
+                output = output.add_(bias)
+            return output
+
+        scale = torch.matmul(field_norm, expand_matrix)                                        # [batch * sample, dim]
+        if bias is not None:
+            return torch.addcmul(bias, field, scale)
+        return field * scale
+
+
+    @torch.jit.export
+    def forward_per_irrep(self, node_input: torch.Tensor) -> torch.Tensor:
         # batch, *size, dim = node_input.shape  # TODO: deal with batch
         # node_input = node_input.reshape(batch, -1, dim)  # [batch, sample, stacked features]
         # node_input has shape [batch * nodes, dim], but with variable nr of nodes.
@@ -136,7 +225,7 @@ class EquivariantLayerNormV2(nn.Module):
                 iw += mul
                 field_norm = field_norm * weight  # [batch, mul]
             
-            field = field * field_norm.reshape(-1, mul, 1)  # [batch * sample, mul, repr]
+            field = field * field_norm.unsqueeze(-1)  # [batch * sample, mul, repr]
             
             #if self.affine and d == 1 and ir.p == 1:  # scalars
             if self.affine and d == 1 and ir[1] == 1:  # scalars
@@ -161,14 +161,21 @@ class EquiformerBlock(torch.nn.Module):
             irreps_mlp_mid=self.irreps_mlp_mid,
             proj_drop=proj_drop)
             
+    @torch.jit.export
+    def get_message_src(self, src_features: torch.Tensor) -> torch.Tensor:
+        message_src: torch.Tensor = self.prenorm_src(src_features) # Shape: (N_src, F_src)
+        message_src: torch.Tensor = self.linear_src(message_src)   # Shape: (N_src, F_emb)
+        return message_src
+
     def forward(self, src_points: FeaturedPoints, 
                 dst_points: FeaturedPoints,
-                graph_edge: GraphEdge) -> FeaturedPoints:
+                graph_edge: GraphEdge,
+                message_src: Optional[torch.Tensor] = None) -> FeaturedPoints:
         assert src_points.x.ndim == 2
         assert dst_points.x.ndim == 2
         
-        message_src: torch.Tensor = self.prenorm_src(src_points.f) # Shape: (N_src, F_src)
-        message_src: torch.Tensor = self.linear_src(message_src)   # Shape: (N_src, F_emb)
+        if message_src is None:
+            message_src = self.get_message_src(src_points.f)       # Shape: (N_src, F_emb)
 
         if self.prenorm_dst is None:
             message_dst = None
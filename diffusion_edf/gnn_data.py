@@ -7,6 +7,7 @@ from e3nn import o3
 from edf_interface.data import PointCloud
 from edf_interface.data.pcd_utils import transform_points
 from diffusion_edf.wigner import TransformFeatureQuaternion
+from diffusion_edf.spatial_index import SpatialIndex
 
 
 class FeaturedPoints(NamedTuple):
@@ -74,6 +75,18 @@ def merge_featured_points(pcds: Union[List[FeaturedPoints], Tuple[FeaturedPoints
     else:
         raise ValueError()
     
+def pack_featured_points(pcds: List[FeaturedPoints]) -> FeaturedPoints:
+    """
+    Concatenate the point clouds of different scenes, with the index of each point cloud in pcds as the batch index b.
+    Graphs between the packed points only connect points of the same scene.
+    """
+    packed: Optional[FeaturedPoints] = None
+    for batch_idx, pcd in enumerate(pcds):
+        pcd = set_featured_points_attribute(points=pcd, b=torch.full_like(pcd.b, batch_idx))
+        packed = pcd if packed is None else cat_featured_points(packed, pcd)
+    assert packed is not None
+    return packed
+
 def pcd_to_featured_points(pcd: PointCloud, batch_idx: int = 0) -> FeaturedPoints:
     return FeaturedPoints(x=pcd.points, f=pcd.colors, b = torch.empty_like(pcd.points[..., 0], dtype=torch.long).fill_(batch_idx))
 
@@ -85,10 +98,23 @@ class TransformPcd(torch.nn.Module):
         else:
             self.transform_features = TransformFeatureQuaternion(irreps=o3.Irreps(irreps))
 
-    def forward(self, pcd: FeaturedPoints, Ts: torch.Tensor) -> FeaturedPoints: 
+    @torch.jit.export
+    def wigner_Ds(self, Ts: torch.Tensor) -> List[torch.Tensor]:
+        """
+        Wigner D blocks of the poses Ts (nT, 7) for the features (see TransformFeatureQuaternion.wigner_Ds), to be passed to forward as Ds.
+        Empty if the features are not transformed.
+        """
+        if self.transform_features is None:
+            return []
+        return self.transform_features.wigner_Ds(Ts[..., :4])
+
+    def forward(self, pcd: FeaturedPoints, Ts: torch.Tensor, Ds: Optional[List[torch.Tensor]] = None) -> FeaturedPoints: 
+        """
+        Ds: Precomputed Wigner D blocks of Ts (see wigner_Ds). Built from Ts if not given.
+        """
         assert Ts.ndim == 2 and Ts.shape[-1] == 7, f"{Ts.shape}" # Ts: (nT, 4+3: quaternion + position) 
         if self.transform_features is not None:
-            f_transformed = self.transform_features(feature=pcd.f,  q=Ts[..., :4]) # (Nt, Np, F)
+            f_transformed = self.transform_features(feature=pcd.f,  q=Ts[..., :4], Ds=Ds) # (Nt, Np, F)
         else:
             f_transformed = pcd.f.expand(len(Ts), -1, -1)                      # (Nt, Np, F)
         x_transformed = transform_points(points=pcd.x, Ts=Ts)                  # (Nt, Np, 3)
@@ -217,6 +243,33 @@ def cat_graph_edges(graph_edge_1: GraphEdge, graph_edge_2: GraphEdge) -> GraphEd
                      edge_logits=edge_logits)
 
 
+@torch.jit.script
+def slice_graph_edges_by_dst(graph_edge: GraphEdge, start: int, end: int) -> GraphEdge:
+    """
+    Keep the edges with start <= edge_dst < end and shift edge_dst by -start, 
+    i.e., the subgraph of the destination nodes [start, end).
+    Only unencoded edges (edge_src and edge_dst) are supported.
+    """
+    assert graph_edge.edge_length is None and graph_edge.edge_attr is None and graph_edge.edge_scalars is None
+    assert graph_edge.edge_weights is None and graph_edge.edge_logits is None
+    idx = ((graph_edge.edge_dst >= start) & (graph_edge.edge_dst < end)).nonzero().squeeze(-1)
+    return GraphEdge(edge_src=graph_edge.edge_src.index_select(0, idx),
+                     edge_dst=graph_edge.edge_dst.index_select(0, idx) - start)
+
+
+@torch.jit.script
+def slice_candidate_edges(candidate_edges: Optional[List[Optional[GraphEdge]]], start: int, end: int) -> Optional[List[Optional[GraphEdge]]]:
+    if candidate_edges is None:
+        return None
+    sliced: List[Optional[GraphEdge]] = []
+    for candidate_edge in candidate_edges:
+        if candidate_edge is None:
+            sliced.append(None)
+        else:
+            sliced.append(slice_graph_edges_by_dst(candidate_edge, start=start, end=end))
+    return sliced
+
+
 @torch.jit.script
 def cat_featured_points(fp1: FeaturedPoints, fp2: FeaturedPoints) -> FeaturedPoints:
     x = torch.cat([fp1.x, fp2.x], dim=0)
@@ -235,3 +288,97 @@ def cat_featured_points(fp1: FeaturedPoints, fp2: FeaturedPoints) -> FeaturedPoi
 
 
 
+
+
+class PreparedKeyField(NamedTuple):
+    points_multiscale: List[FeaturedPoints] # Key points of each scale, used for graph parsing
+    points_flattened: FeaturedPoints        # Key points of all scales concatenated
+    offsets: List[int]                      # Index of the first point of each scale in points_flattened
+    messages_src: List[torch.Tensor]        # Projected source messages of each EquiformerBlock, (N_src, F_emb)
+    spatial_indices: List[Optional[SpatialIndex]] # Spatial index of each scale (None for scales without cutoff radius)
+
+
+class TimeEmbedding(NamedTuple):
+    multiscale: List[torch.Tensor]          # Edge time embedding of each scale, (nTime, time_emb_D)
+    query: Optional[torch.Tensor]           # Query time embedding, (nTime, time_emb_D). None if the query time encoding is not used
+
+
+class PackedQueryPoints(NamedTuple):
+    x: torch.Tensor                         # Query points transformed by their pose, (N, 3), N = sum of nQ over the poses
+    x_local: torch.Tensor                   # Query points in the frame of their pose, (N, 3)
+    f: torch.Tensor                         # Query features rotated by their pose, (N, F)
+    b: torch.Tensor                         # Batch index of the query points, (N,)
+    w: torch.Tensor                         # Weight of the query points, (N,)
+    pose_idx: torch.Tensor                  # Index of the pose of the query points, (N,), sorted
+    n_queries: int                          # nQ if every pose has the same nQ query points (a single scene), -1 otherwise
+
+
+@torch.jit.script
+def index_time_embedding(time_emb: TimeEmbedding, idx: torch.Tensor) -> TimeEmbedding:
+    """
+    Gather the rows idx of a tabulated time embedding, e.g., the embeddings of the current diffusion step.
+    """
+    multiscale: List[torch.Tensor] = []
+    for emb in time_emb.multiscale:
+        multiscale.append(emb.index_select(0, idx))
+    query = time_emb.query
+    if query is not None:
+        query = query.index_select(0, idx)
+    return TimeEmbedding(multiscale=multiscale, query=query)
+
+
+@torch.jit.script
+def slice_time_embedding(time_emb: TimeEmbedding, start: int, end: int) -> TimeEmbedding:
+    """
+    Rows [start, end) of a per-pose time embedding. Embeddings with a single row are broadcasted to every pose and kept as they are.
+    """
+    multiscale: List[torch.Tensor] = []
+    for emb in time_emb.multiscale:
+        multiscale.append(emb if len(emb) == 1 else emb[start:end])
+    query = time_emb.query
+    if query is not None and len(query) != 1:
+        query = query[start:end]
+    return TimeEmbedding(multiscale=multiscale, query=query)
+
+
+@torch.jit.script
+def slice_wigner_Ds(Ds: Optional[List[torch.Tensor]], start: int, end: int) -> Optional[List[torch.Tensor]]:
+    """
+    Wigner D blocks (see TransformPcd.wigner_Ds) of the poses [start, end).
+    """
+    if Ds is None:
+        return None
+    sliced: List[torch.Tensor] = []
+    for D in Ds:
+        sliced.append(D if D.numel() == 0 else D[start:end])
+    return sliced
+
+
+class PoseChunk(NamedTuple):
+    start: int                                              # The chunk is the poses [start, end)
+    end: int
+    time_emb: TimeEmbedding                                 # Time embedding of the poses of the chunk
+    candidate_edges: Optional[List[Optional[GraphEdge]]]    # Candidate edges of the query points of the chunk
+    Ds: Optional[List[torch.Tensor]]                        # Wigner D blocks of the poses of the chunk
+
+
+@torch.jit.script
+def split_pose_chunks(pose_chunks: List[int], n_queries: int,
+                      time_emb: TimeEmbedding,
+                      candidate_edges: Optional[List[Optional[GraphEdge]]] = None,
+                      Ds: Optional[List[torch.Tensor]] = None) -> List[PoseChunk]:
+    """
+    Slice the per-pose inputs of a score evaluation into the chunks pose_chunks ([0, ..., nT], see plan_pose_chunks of the score heads).
+    n_queries: Number of query points of each pose, i.e., the number of destination nodes of the candidate edges per pose.
+    A single chunk keeps the inputs as they are.
+    """
+    if len(pose_chunks) <= 2:
+        return [PoseChunk(start=0, end=pose_chunks[-1], time_emb=time_emb, candidate_edges=candidate_edges, Ds=Ds)]
+    chunks: List[PoseChunk] = []
+    for i in range(len(pose_chunks)-1):
+        start, end = pose_chunks[i], pose_chunks[i+1]
+        chunks.append(PoseChunk(start=start, end=end,
+                                time_emb=slice_time_embedding(time_emb, start=start, end=end),
+                                candidate_edges=slice_candidate_edges(candidate_edges, start=start*n_queries, end=end*n_queries),
+                                Ds=slice_wigner_Ds(Ds, start=start, end=end)))
+    return chunks
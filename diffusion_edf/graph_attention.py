@@ -212,6 +212,11 @@ class GraphAttentionMLP2(torch.nn.Module):
         if proj_drop != 0.0:
             self.proj_drop = EquivariantDropout(irreps = self.irreps_output, 
                                                 drop_prob = proj_drop)
+
+        # Approximate number of per-edge elements alive at the peak of forward(), used for memory budgeting.
+        # message, radial weights, dtp output, lin output, gated value, value dtp output, value and attn.
+        self.edge_numel: int = self.irreps_input.dim + self.sep_act.dtp.tp.weight_numel + 2 * self.sep_act.dtp.irreps_out.dim \
+                             + self.irreps_mid.dim + self.sep_value.dtp.irreps_out.dim + 2 * self.irreps_attn_heads.dim
         
 
         
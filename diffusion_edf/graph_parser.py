@@ -12,6 +12,7 @@ from e3nn import o3
 from diffusion_edf.gnn_data import FeaturedPoints, GraphEdge
 from diffusion_edf.radial_func import soft_square_cutoff_2, SinusoidalPositionEmbeddings, BesselBasisEncoder, GaussianRadialBasis
 from diffusion_edf.irreps_utils import cutoff_irreps
+from diffusion_edf.spatial_index import SpatialIndex, radius_query
 
 
 class GraphEdgeEncoderBase(torch.nn.Module):
@@ -271,7 +272,9 @@ class InfiniteBipartite(GraphEdgeEncoderBase):
         
     def forward(self, src: FeaturedPoints, 
                 dst: FeaturedPoints, 
-                max_neighbors: Optional[int] = None       # just a placeholder
+                max_neighbors: Optional[int] = None,      # just a placeholder
+                candidate_edge: Optional[GraphEdge] = None, # just a placeholder
+                src_index: Optional[SpatialIndex] = None    # just a placeholder
                 ) -> GraphEdge:
         assert src.x.ndim == 2
         assert dst.x.ndim == 2
@@ -279,6 +282,9 @@ class InfiniteBipartite(GraphEdgeEncoderBase):
         edge_src, edge_dst = torch.meshgrid(torch.arange(len(src.x), device = src.x.device), torch.arange(len(dst.x), device = dst.x.device), indexing='ij')
         edge_src = edge_src.reshape(-1)
         edge_dst = edge_dst.reshape(-1)
+        if len(dst.b) > 0 and bool(torch.any(src.b != dst.b[0]) | torch.any(dst.b != dst.b[0])):  # Multiple batches (e.g., scenes) are packed together
+            same_batch = src.b.index_select(0, edge_src) == dst.b.index_select(0, edge_dst)
+            edge_src, edge_dst = edge_src[same_batch], edge_dst[same_batch]
 
         if not self.requires_encoding:
             return GraphEdge(edge_src=edge_src, edge_dst=edge_dst)
@@ -333,13 +339,90 @@ class RadiusBipartite(GraphEdgeEncoderBase):
                          length_enc=length_enc,
                          sh_cutoff=sh_cutoff)
 
-    def forward(self, src: FeaturedPoints, dst: FeaturedPoints, max_neighbors: int = 1000) -> GraphEdge:
+    def forward(self, src: FeaturedPoints, dst: FeaturedPoints, max_neighbors: int = 1000, 
+                candidate_edge: Optional[GraphEdge] = None,
+                src_index: Optional[SpatialIndex] = None) -> GraphEdge:
+        """
+        If candidate_edge is given (e.g., from VerletNeighborList), the radius search is skipped 
+        and the candidate edges are only filtered by the cutoff radius.
+        If src_index (prebuilt on src) is given, it is probed instead of building a search structure from scratch.
+        """
         assert src.x.ndim == 2
         assert dst.x.ndim == 2
-        edge = radius(x = src.x, y = dst.x, r=self.r_cluster, batch_x=src.b, batch_y=dst.b, max_num_neighbors=max_neighbors)
-        edge_dst, edge_src = edge[0], edge[1]
+        if candidate_edge is None:
+            if src_index is None:
+                edge = radius(x = src.x, y = dst.x, r=self.r_cluster, batch_x=src.b, batch_y=dst.b, max_num_neighbors=max_neighbors)
+            else:
+                edge = radius_query(index=src_index, y=dst.x, r=self.r_cluster, batch_y=dst.b, max_num_neighbors=max_neighbors)
+            edge_dst, edge_src = edge[0], edge[1]
+        else:
+            edge_src, edge_dst = candidate_edge.edge_src, candidate_edge.edge_dst
+            edge_length = (src.x.index_select(0, edge_src) - dst.x.index_select(0, edge_dst)).norm(dim=1, p=2)
+            in_range_idx = (edge_length < self.r_cluster).nonzero().squeeze(-1)
+            edge_src, edge_dst = edge_src.index_select(0, in_range_idx), edge_dst.index_select(0, in_range_idx)
 
         if not self.requires_encoding:
             return GraphEdge(edge_src=edge_src, edge_dst=edge_dst)
         
-        return self._encode_edges(x_src=src.x, x_dst=dst.x, edge_src=edge_src, edge_dst=edge_dst)
\ No newline at end of file
+        return self._encode_edges(x_src=src.x, x_dst=dst.x, edge_src=edge_src, edge_dst=edge_dst)
+
+
+
+class VerletNeighborList():
+    """
+    Verlet-style neighbor list for RadiusBipartite with fixed src points and slowly moving dst points.
+    Candidate edges are searched with radius (r_cluster + skin), and are reused until 
+    the largest dst displacement since the last rebuild exceeds skin/2.
+    """
+    r_cluster: float
+    skin: float
+    max_neighbors: int
+    n_rebuilds: int
+
+    @beartype
+    def __init__(self, r_cluster: Union[float, int], skin: Union[float, int], max_neighbors: int = 1000):
+        assert skin >= 0., f"{skin}"
+        self.r_cluster = float(r_cluster)
+        self.skin = float(skin)
+        self.max_neighbors = max_neighbors
+        self.n_rebuilds = 0
+        self.reset()
+
+    def reset(self):
+        self.dst_x_ref: Optional[torch.Tensor] = None
+        self.candidate_edge: Optional[GraphEdge] = None
+
+    def _requires_rebuild(self, dst: FeaturedPoints) -> bool:
+        if self.candidate_edge is None or self.dst_x_ref is None:
+            return True
+        if self.dst_x_ref.shape != dst.x.shape:
+            return True
+        max_displacement = (dst.x - self.dst_x_ref).norm(dim=-1).max().item()
+        return max_displacement > self.skin / 2
+
+    def update(self, src: FeaturedPoints, dst: FeaturedPoints, src_index: Optional[SpatialIndex] = None) -> GraphEdge:
+        if self._requires_rebuild(dst=dst):
+            if src_index is None:
+                edge = radius(x = src.x, y = dst.x, r=self.r_cluster + self.skin, batch_x=src.b, batch_y=dst.b, max_num_neighbors=self.max_neighbors)
+            else:
+                edge = radius_query(index=src_index, y=dst.x, r=self.r_cluster + self.skin, batch_y=dst.b, max_num_neighbors=self.max_neighbors)
+            self.candidate_edge = GraphEdge(edge_src=edge[1], edge_dst=edge[0])
+            self.dst_x_ref = dst.x.detach().clone()
+            self.n_rebuilds += 1
+        assert self.candidate_edge is not None
+        return self.candidate_edge
+
+    def select_dst(self, dst_idx: torch.Tensor):
+        """
+        Keep only the dst points dst_idx (in the given order) without rebuilding, e.g., when converged poses leave the batch.
+        The dst points passed to the next update() must be ordered accordingly.
+        """
+        if self.candidate_edge is None or self.dst_x_ref is None:
+            return
+        new_dst = torch.full((len(self.dst_x_ref),), -1, device=dst_idx.device, dtype=torch.long)
+        new_dst[dst_idx] = torch.arange(len(dst_idx), device=dst_idx.device)
+        edge_dst = new_dst.index_select(0, self.candidate_edge.edge_dst)
+        keep = (edge_dst >= 0).nonzero().squeeze(-1)
+        self.candidate_edge = GraphEdge(edge_src=self.candidate_edge.edge_src.index_select(0, keep), 
+                                        edge_dst=edge_dst.index_select(0, keep))
+        self.dst_x_ref = self.dst_x_ref.index_select(0, dst_idx)
@@ -8,15 +8,19 @@ from e3nn import o3
 
 
 from diffusion_edf.gnn_block import EquiformerBlock
+from diffusion_edf import transforms
 from diffusion_edf.utils import multiply_irreps
-from diffusion_edf.gnn_data import FeaturedPoints, GraphEdge, set_graph_edge_attribute, cat_graph_edges, cat_featured_points
+from diffusion_edf.gnn_data import FeaturedPoints, GraphEdge, PreparedKeyField, set_graph_edge_attribute, cat_graph_edges, cat_featured_points
+from diffusion_edf.gnn_data import TimeEmbedding, PoseChunk, index_time_embedding, split_pose_chunks
 from diffusion_edf.graph_parser import RadiusBipartite, InfiniteBipartite
+from diffusion_edf.spatial_index import SpatialIndex, build_spatial_index, count_radius_candidates
 
 
 class MultiscaleTensorField(torch.nn.Module):
     r_cluster_multiscale: List[Optional[float]]
     n_scales: int
     cutoff_method: str
+    edge_numel: int
 
     @beartype
     def __init__(self,
@@ -188,11 +192,133 @@ class MultiscaleTensorField(torch.nn.Module):
                                 use_dst_point_attn=use_dst_point_attn,
                                 use_edge_weights=use_edge_weights)
             )
+
+        # Approximate number of per-edge elements alive during forward(), used for memory budgeting.
+        # edge_attr, edge_scalars, length, weights and logits are kept across the blocks. The attention temporaries peak in one block at a time.
+        self.edge_numel = self.irreps_sh.dim + fc_neurons[0] + 3 + max([self.gnn_block_init.ga.edge_numel] + [block.ga.edge_numel for block in self.gnn_blocks])
         
+    @torch.jit.export
+    def prepare_key_field(self, input_points_multiscale: List[FeaturedPoints], with_spatial_index: bool = True) -> PreparedKeyField:
+        """
+        Everything in the tensor field that only depends on the input (key) points.
+        Build it once per scene and pass it to forward() to avoid recomputing it at every call.
+        with_spatial_index: Also build a SpatialIndex of the key points of each scale (cell size r_cluster), 
+            probed by the radius graphs of every later call instead of torch_cluster.radius. 
+            Only worth it if the field is reused for many queries (e.g., across the denoising steps of a scene).
+        """
+        assert len(input_points_multiscale) == self.n_scales
+
+        offsets: List[int] = []
+        spatial_indices: List[Optional[SpatialIndex]] = []
+        n_total_points: int = 0
+        input_points_flattend: Optional[FeaturedPoints] = None
+        for n, input_points in enumerate(input_points_multiscale):
+            assert input_points.x.ndim == 2 and input_points.x.shape[-1] == 3, f"{input_points.x.shape}"
+            r_cluster = self.r_cluster_multiscale[n]
+            if r_cluster is None or not with_spatial_index:
+                spatial_indices.append(None)
+            else:
+                spatial_indices.append(build_spatial_index(points=input_points.x, batch=input_points.b, cell_size=r_cluster))
+            offsets.append(n_total_points)
+            n_total_points = n_total_points + len(input_points.x)
+            if n == 0:
+                input_points_flattend = input_points
+            else:
+                assert input_points_flattend is not None
+                input_points_flattend = cat_featured_points(input_points_flattend, input_points)
+        assert input_points_flattend is not None
+
+        messages_src: List[torch.Tensor] = [self.gnn_block_init.get_message_src(input_points_flattend.f)]
+        for block in self.gnn_blocks:
+            messages_src.append(block.get_message_src(input_points_flattend.f))
+
+        return PreparedKeyField(points_multiscale=input_points_multiscale,
+                                points_flattened=input_points_flattend,
+                                offsets=offsets,
+                                messages_src=messages_src,
+                                spatial_indices=spatial_indices)
+
+    @torch.jit.export
+    def estimate_n_edges(self, query_points: FeaturedPoints,
+                         key_field: PreparedKeyField,
+                         max_neighbors: int = 1000,
+                         candidate_edges: Optional[List[Optional[GraphEdge]]] = None) -> torch.Tensor:
+        """
+        Upper bound of the number of edges of each query point (summed over all scales) without parsing the graph.
+
+        Returns:
+            n_edges: (Nq,)
+        """
+        assert query_points.x.ndim == 2 # (Nq, 3)
+        n_queries: int = len(query_points.x)
+        n_edges = torch.zeros(n_queries, device=query_points.x.device, dtype=torch.long)
+        for n, r_cluster in enumerate(self.r_cluster_multiscale):
+            candidate_edge: Optional[GraphEdge] = None
+            if candidate_edges is not None:
+                candidate_edge = candidate_edges[n]
+            spatial_index = key_field.spatial_indices[n]
+            if candidate_edge is not None:
+                n_edges = n_edges + torch.bincount(candidate_edge.edge_dst, minlength=n_queries)
+            elif r_cluster is None or spatial_index is None:
+                n_edges = n_edges + len(key_field.points_multiscale[n].x)         # Fully connected
+            else:
+                n_candidates = count_radius_candidates(index=spatial_index, y=query_points.x, r=r_cluster, batch_y=query_points.b)
+                n_edges = n_edges + n_candidates.clamp(max=max_neighbors)
+        return n_edges
+
+    @torch.jit.export
+    def plan_chunks(self, n_edges: torch.Tensor,
+                    max_edges: Optional[int] = None,
+                    max_bytes: Optional[int] = None,
+                    element_size: int = 4) -> List[int]:
+        """
+        Greedily split consecutive groups (e.g., poses) into chunks such that the estimated number of edges 
+        (or the estimated memory of the edge tensors) of each chunk stays within the budget.
+        A group that exceeds the budget by itself forms its own chunk.
+
+        Args:
+            n_edges: (nGroup,), estimated number of edges of each group.
+            element_size: Bytes per element of the floating point edge tensors.
+
+        Returns:
+            chunk_boundaries: [0, ..., nGroup]. The i-th chunk is [chunk_boundaries[i], chunk_boundaries[i+1]).
+        """
+        assert n_edges.ndim == 1
+        budget: int = -1
+        if max_edges is not None:
+            assert max_edges > 0, f"{max_edges}"
+            budget = max_edges
+        if max_bytes is not None:
+            assert max_bytes > 0, f"{max_bytes}"
+            bytes_per_edge: int = self.edge_numel * element_size + 16    # + edge_src and edge_dst (int64)
+            budget_from_bytes: int = max(max_bytes // bytes_per_edge, 1)
+            budget = budget_from_bytes if budget < 0 else min(budget, budget_from_bytes)
+
+        n_edges_list: List[int] = n_edges.tolist()
+        chunk_boundaries: List[int] = [0]
+        n_edges_chunk: int = 0
+        for i, n in enumerate(n_edges_list):
+            if budget >= 0 and n_edges_chunk > 0 and n_edges_chunk + n > budget:
+                chunk_boundaries.append(i)
+                n_edges_chunk = 0
+            n_edges_chunk = n_edges_chunk + n
+        chunk_boundaries.append(len(n_edges_list))
+        return chunk_boundaries
+
     def forward(self, query_points: FeaturedPoints,
                 input_points_multiscale: List[FeaturedPoints],
                 context_emb: Optional[List[torch.Tensor]] = None,
-                max_neighbors: int = 1000) -> FeaturedPoints:
+                max_neighbors: int = 1000,
+                key_field: Optional[PreparedKeyField] = None,
+                candidate_edges: Optional[List[Optional[GraphEdge]]] = None) -> FeaturedPoints:
+        """
+        If key_field is given (see prepare_key_field), input_points_multiscale is ignored.
+        Otherwise, the radius graphs are searched with torch_cluster.radius, with no spatial index.
+        candidate_edges: Precomputed candidate edges of each scale (see graph_parser.VerletNeighborList).
+        """
+        if key_field is None:
+            key_field = self.prepare_key_field(input_points_multiscale, with_spatial_index=False)   # Used once, e.g., in training
+        input_points_multiscale = key_field.points_multiscale
         assert len(input_points_multiscale) == self.n_scales
         assert query_points.x.ndim == 2 # (Nq, 3)
         if self.context_emb_dim is not None:
@@ -202,15 +328,16 @@ class MultiscaleTensorField(torch.nn.Module):
             edge_encode_context = False
             assert context_emb is None
 
-        n_total_points: int = 0
         graph_edges_flattend: Optional[GraphEdge] = None
-        input_points_flattend: Optional[FeaturedPoints] = None
         for n, (graph_parser, edge_scalars_pre_linear) in enumerate(zip(self.graph_parsers, self.edge_scalars_pre_linears)):
             input_points: FeaturedPoints = input_points_multiscale[n]
-            assert input_points.x.ndim == 2 and input_points.x.shape[-1] == 3, f"{input_points.x.shape}"
 
             ### Parse Graph ###
-            graph_edge: GraphEdge = graph_parser(src=input_points, dst=query_points, max_neighbors=max_neighbors)
+            candidate_edge: Optional[GraphEdge] = None
+            if candidate_edges is not None:
+                candidate_edge = candidate_edges[n]
+            graph_edge: GraphEdge = graph_parser(src=input_points, dst=query_points, max_neighbors=max_neighbors, 
+                                                 candidate_edge=candidate_edge, src_index=key_field.spatial_indices[n])
 
             ### Encode length and context embeddings ###
             edge_scalars = graph_edge.edge_scalars
@@ -235,27 +362,130 @@ class MultiscaleTensorField(torch.nn.Module):
             ### Flatten graph ###
             graph_edge = set_graph_edge_attribute(graph_edge=graph_edge, 
                                                   edge_scalars=edge_scalars, 
-                                                  edge_src = graph_edge.edge_src + n_total_points)
-            n_total_points = n_total_points + len(input_points.x)
+                                                  edge_src = graph_edge.edge_src + key_field.offsets[n])
             if n == 0:
-                assert graph_edges_flattend is None and input_points_flattend is None
+                assert graph_edges_flattend is None
                 graph_edges_flattend = graph_edge
-                input_points_flattend = input_points
             else:
-                assert graph_edges_flattend is not None and input_points_flattend is not None
+                assert graph_edges_flattend is not None
                 graph_edges_flattend = cat_graph_edges(graph_edges_flattend, graph_edge)
-                input_points_flattend = cat_featured_points(input_points_flattend, input_points)
 
+        assert graph_edges_flattend is not None
         if len(graph_edges_flattend.edge_src) == 0:
             warnings.warn("Multiscale Tensor Field: zero edges detected!")
 
+        input_points_flattend: FeaturedPoints = key_field.points_flattened
         output_points: FeaturedPoints = self.gnn_block_init(src_points=input_points_flattend,
                                                             dst_points=query_points,
-                                                            graph_edge=graph_edges_flattend)
-        for block in self.gnn_blocks:
+                                                            graph_edge=graph_edges_flattend,
+                                                            message_src=key_field.messages_src[0])
+        for n, block in enumerate(self.gnn_blocks):
             output_points: FeaturedPoints = block(src_points=input_points_flattend,
                                                   dst_points=output_points,
-                                                  graph_edge=graph_edges_flattend)
+                                                  graph_edge=graph_edges_flattend,
+                                                  message_src=key_field.messages_src[n+1])
         
         return output_points
-        
\ No newline at end of file
+
+
+class TensorFieldHeadMixin:
+    """
+    Methods shared by the score heads that query a MultiscaleTensorField (self.key_tensor_field) with transformed query points.
+    The head provides self.key_tensor_field, self.query_transform and the time encoder 
+    (self.time_enc, self.time_mlps_multiscale, self.query_time_mlp, self.edge_time_encoding, self.query_time_encoding).
+    """
+
+    @torch.jit.export
+    def plan_pose_chunks(self, Ts: torch.Tensor,
+                         query_pcd: FeaturedPoints,
+                         key_field: PreparedKeyField,
+                         candidate_edges: Optional[List[Optional[GraphEdge]]] = None,
+                         max_edges: Optional[int] = None,
+                         max_bytes: Optional[int] = None) -> List[int]:
+        """
+        Split the poses into chunks whose estimated number of edges fits the budget.
+        The number of edges of each pose is bounded from the spatial index of the key points (or the candidate edges) without parsing the graph.
+
+        Returns:
+            pose_chunks: [0, ..., nT]. The i-th chunk is Ts[pose_chunks[i]:pose_chunks[i+1]]
+        """
+        nT = len(Ts)
+        nQ = len(query_pcd.x)
+        Ts = Ts.detach()
+        query_x = transforms.quaternion_apply(Ts[..., None, :4], query_pcd.x) + Ts[..., None, 4:]    # (nT, nQ, 3)
+        query_points = FeaturedPoints(x=query_x.reshape(-1,3), 
+                                      f=query_x.new_empty(nT*nQ, 0), 
+                                      b=query_pcd.b.expand(nT, -1).reshape(-1))                        # (nT*nQ, 3), (nT*nQ, 0), (nT*nQ,)
+        n_edges = self.key_tensor_field.estimate_n_edges(query_points=query_points, 
+                                                         key_field=key_field, 
+                                                         candidate_edges=candidate_edges)            # (nT*nQ,)
+        return self.key_tensor_field.plan_chunks(n_edges=n_edges.view(nT, nQ).sum(dim=-1), 
+                                                 max_edges=max_edges, 
+                                                 max_bytes=max_bytes, 
+                                                 element_size=query_pcd.f.element_size())
+
+    def _split_pose_chunks(self, Ts: torch.Tensor,
+                           key_pcd_multiscale: List[FeaturedPoints],
+                           query_pcd: FeaturedPoints,
+                           time_emb: TimeEmbedding,
+                           key_field: Optional[PreparedKeyField] = None,
+                           candidate_edges: Optional[List[Optional[GraphEdge]]] = None,
+                           max_edges: Optional[int] = None,
+                           max_bytes: Optional[int] = None,
+                           Ds: Optional[List[torch.Tensor]] = None) -> Tuple[List[PoseChunk], Optional[PreparedKeyField]]:
+        """
+        Plan the pose chunks within the budget (see plan_pose_chunks) and slice the per-pose inputs into them.
+        Returns the chunks and the key field shared across them.
+        """
+        if max_edges is None and max_bytes is None:
+            return [PoseChunk(start=0, end=len(Ts), time_emb=time_emb, candidate_edges=candidate_edges, Ds=Ds)], key_field
+        if key_field is None:
+            key_field = self.prepare_key_field(key_pcd_multiscale)   # Shared across the chunks
+        pose_chunks: List[int] = self.plan_pose_chunks(Ts=Ts, query_pcd=query_pcd, key_field=key_field, candidate_edges=candidate_edges, 
+                                                       max_edges=max_edges, max_bytes=max_bytes)
+        return split_pose_chunks(pose_chunks, n_queries=len(query_pcd.x), time_emb=time_emb, candidate_edges=candidate_edges, Ds=Ds), key_field
+
+    @torch.jit.export
+    def compute_wigner_Ds(self, Ts: torch.Tensor) -> List[torch.Tensor]:
+        """
+        Ts: (nT, 7)
+        Returns the Wigner D blocks of the poses for the query features, to be passed to the head as Ds.
+        They are built once for the poses of an evaluation and shared by all of its chunks.
+        """
+        return self.query_transform.wigner_Ds(Ts)
+
+    @torch.jit.export
+    def compute_time_embedding(self, time: torch.Tensor) -> TimeEmbedding:
+        """
+        time: (nTime,)
+        Returns the edge (of each scale) and query time embeddings, (nTime, time_emb_D).
+        The embeddings only depend on the time, so those of a diffusion schedule can be tabulated once 
+        and passed to the head as time_emb with the row index time_emb_idx of each step.
+        """
+        time_enc: torch.Tensor = self.time_enc(time)                       # (nTime, time_emb_mlp[0])
+        time_embs_multiscale: List[torch.Tensor] = []
+        if self.edge_time_encoding:
+            for time_mlp in self.time_mlps_multiscale:
+                time_embs_multiscale.append(time_mlp(time_enc))            # (nTime, time_emb_D)
+        query_time_emb: Optional[torch.Tensor] = None
+        if self.query_time_encoding:
+            assert self.query_time_mlp is not None
+            query_time_emb = self.query_time_mlp(time_enc)                 # (nTime, time_emb_D)
+        return TimeEmbedding(multiscale=time_embs_multiscale, query=query_time_emb)
+
+    def _resolve_time_embedding(self, Ts: torch.Tensor,
+                                time: Optional[torch.Tensor],
+                                time_emb: Optional[TimeEmbedding],
+                                time_emb_idx: Optional[torch.Tensor]) -> TimeEmbedding:
+        if time_emb is None:
+            assert time is not None, f"Either time or time_emb must be given."
+            assert time.ndim == 1 and len(time) == len(Ts), f"{time.shape}" # time: (nT,)
+            return self.compute_time_embedding(time)
+        if time_emb_idx is not None:
+            assert time_emb_idx.ndim == 1 and (len(time_emb_idx) == len(Ts) or len(time_emb_idx) == 1), f"{time_emb_idx.shape}" # time_emb_idx: (nT,) or (1,)
+            time_emb = index_time_embedding(time_emb, time_emb_idx)
+        return time_emb
+
+    @torch.jit.export
+    def prepare_key_field(self, key_pcd_multiscale: List[FeaturedPoints]) -> PreparedKeyField:
+        return self.key_tensor_field.prepare_key_field(input_points_multiscale=key_pcd_multiscale)
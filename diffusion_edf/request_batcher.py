@@ -0,0 +1,243 @@
+from typing import List, Optional, Any, Callable, Hashable, Dict, Tuple
+from concurrent.futures import Future
+import itertools
+import threading
+import time
+
+
+class RequestCancelled(RuntimeError):
+    pass
+
+
+class DeadlineExceeded(RequestCancelled):
+    pass
+
+
+class BatchRequest():
+    """
+    priority: Requests of higher priority are served first.
+    deadline_s: If set, the request expires this many seconds after its submission, whether it is still pending or already running.
+    request_id: If set, the request can be cancelled with DynamicBatcher.cancel.
+    """
+    _counter = itertools.count()
+
+    def __init__(self, batch_key: Hashable, payload: Any,
+                 priority: int = 0,
+                 deadline_s: Optional[float] = None,
+                 request_id: Optional[str] = None):
+        self.batch_key = batch_key
+        self.payload = payload
+        self.priority = priority
+        self.request_id = request_id
+        self.future: Future = Future()
+        self.t_submit: float = time.perf_counter()
+        self.deadline: float = float('inf') if deadline_s is None else self.t_submit + deadline_s
+        self.seq: int = next(BatchRequest._counter)
+        self.cancelled: bool = False
+
+    def sort_key(self) -> Tuple[int, float, int]:
+        return (-self.priority, self.deadline, self.seq)    # Highest priority, then earliest deadline, then first come
+
+    def stop_exception(self) -> Optional[RequestCancelled]:
+        """
+        The exception to fail the request with if it was cancelled or has expired, otherwise None.
+        """
+        name = "Request" if self.request_id is None else f"Request '{self.request_id}'"
+        if self.cancelled:
+            return RequestCancelled(f"{name} was cancelled.")
+        if time.perf_counter() > self.deadline:
+            return DeadlineExceeded(f"{name} missed its deadline ({self.deadline - self.t_submit:.3f}s).")
+        return None
+
+
+class DynamicBatcher():
+    """
+    Priority queue of requests served by a pool of worker threads.
+    A worker takes the most urgent pending request (highest priority, then earliest deadline, then first come)
+    and merges the pending requests with the same batch key into it, in the same order,
+    waiting until max_wait_s after the submission of the first request for more of them (up to max_batch_size).
+    The batch is then run as a single call of batch_fn(batch_key, payloads, should_stop) -> results (one per payload, in the same order).
+    If a batch fails, its requests are retried one by one, so that a bad request does not fail the others.
+
+    Cancelled (see cancel) and expired requests are dropped from the queue when a batch is collected, and fail with RequestCancelled or DeadlineExceeded.
+    should_stop() tells whether every request of a running batch was cancelled or has expired,
+    so that batch_fn can stop early by raising any exception (e.g., diffusion_edf.score_model_base.SamplingCancelled).
+
+    Only one worker collects a batch at a time, while the batches already collected run concurrently.
+    """
+    def __init__(self, batch_fn: Callable[[Hashable, List[Any], Callable[[], bool]], List[Any]],
+                 n_workers: int = 1,
+                 max_batch_size: int = 8,
+                 max_wait_s: float = 0.01,
+                 name: str = 'batcher'):
+        assert n_workers >= 1, f"{n_workers}"
+        assert max_batch_size >= 1, f"{max_batch_size}"
+        assert max_wait_s >= 0., f"{max_wait_s}"
+        self.batch_fn = batch_fn
+        self.max_batch_size = max_batch_size
+        self.max_wait_s = max_wait_s
+
+        self._pending: List[BatchRequest] = []
+        self._active: Dict[str, BatchRequest] = {}    # Pending and running requests with a request id
+        self._cond = threading.Condition()
+        self._collect_lock = threading.Lock()
+        self._closed = False
+        self.n_requests = 0
+        self.n_batches = 0
+        self.n_requests_batched = 0
+        self.n_batch_failures = 0
+        self.n_cancelled = 0
+        self.n_expired = 0
+
+        self._workers = [threading.Thread(target=self._worker_loop, name=f"{name}-{i}", daemon=True) for i in range(n_workers)]
+        for worker in self._workers:
+            worker.start()
+
+    def submit(self, batch_key: Hashable, payload: Any,
+               priority: int = 0,
+               deadline_s: Optional[float] = None,
+               request_id: Optional[str] = None) -> Future:
+        request = BatchRequest(batch_key=batch_key, payload=payload, priority=priority, deadline_s=deadline_s, request_id=request_id)
+        with self._cond:
+            if self._closed:
+                raise RuntimeError("The batcher is closed.")
+            if request_id is not None:
+                if request_id in self._active:
+                    raise ValueError(f"Request id '{request_id}' is already in use.")
+                self._active[request_id] = request
+            self._pending.append(request)
+            self.n_requests += 1
+            self._cond.notify_all()
+        return request.future
+
+    def run(self, batch_key: Hashable, payload: Any,
+            priority: int = 0,
+            deadline_s: Optional[float] = None,
+            request_id: Optional[str] = None,
+            timeout: Optional[float] = None) -> Any:
+        """
+        Submit a request and wait for its result.
+        """
+        return self.submit(batch_key=batch_key, payload=payload, priority=priority, deadline_s=deadline_s, request_id=request_id).result(timeout=timeout)
+
+    def cancel(self, request_id: str) -> bool:
+        """
+        Cancel a pending or running request. A pending request fails right away,
+        a running one as soon as its batch stops or finishes. Returns False if no such request is pending or running.
+        """
+        with self._cond:
+            request = self._active.get(request_id, None)
+            if request is None:
+                return False
+            request.cancelled = True
+            if request in self._pending:
+                self._pending.remove(request)
+                self._fail(request, request.stop_exception())
+            return True
+
+    def close(self, wait: bool = True):
+        """
+        Stop accepting requests. Pending requests are still served.
+        """
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        if wait:
+            for worker in self._workers:
+                worker.join()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._cond:
+            return {'n_requests': self.n_requests, 'n_batches': self.n_batches, 'n_pending': len(self._pending),
+                    'mean_batch_size': self.n_requests_batched / self.n_batches if self.n_batches else 0.,
+                    'n_batch_failures': self.n_batch_failures, 'n_cancelled': self.n_cancelled, 'n_expired': self.n_expired}
+
+    def _fail(self, request: BatchRequest, exception: BaseException):
+        """
+        Must be called with self._cond held.
+        """
+        if isinstance(exception, DeadlineExceeded):
+            self.n_expired += 1
+        elif isinstance(exception, RequestCancelled):
+            self.n_cancelled += 1
+        self._release(request)
+        request.future.set_exception(exception)
+
+    def _release(self, request: BatchRequest):
+        if request.request_id is not None and self._active.get(request.request_id, None) is request:
+            del self._active[request.request_id]
+
+    def _drop_stopped(self):
+        for request in [request for request in self._pending if request.stop_exception() is not None]:
+            self._pending.remove(request)
+            self._fail(request, request.stop_exception())
+
+    def _collect_batch(self) -> Optional[List[BatchRequest]]:
+        with self._cond:
+            while True:
+                self._drop_stopped()
+                if self._pending or self._closed:
+                    break
+                self._cond.wait()
+            if not self._pending:
+                return None    # Closed
+
+            self._pending.sort(key=BatchRequest.sort_key)
+            first = self._pending.pop(0)
+            batch = [first]
+            deadline = first.t_submit + self.max_wait_s
+            while True:
+                self._drop_stopped()
+                self._pending.sort(key=BatchRequest.sort_key)
+                for request in list(self._pending):
+                    if len(batch) >= self.max_batch_size:
+                        break
+                    if request.batch_key == first.batch_key:
+                        self._pending.remove(request)
+                        batch.append(request)
+                remaining = min(deadline, first.deadline) - time.perf_counter()
+                if len(batch) >= self.max_batch_size or remaining <= 0. or self._closed:
+                    break
+                self._cond.wait(timeout=remaining)
+            self.n_batches += 1
+            self.n_requests_batched += len(batch)
+            return batch
+
+    def _worker_loop(self):
+        while True:
+            with self._collect_lock:
+                batch = self._collect_batch()
+            if batch is None:
+                return
+            batch = [request for request in batch if request.future.set_running_or_notify_cancel()]
+            if batch:
+                self._run_batch(batch)
+
+    def _run_batch(self, batch: List[BatchRequest]):
+        def should_stop() -> bool:
+            return all(request.stop_exception() is not None for request in batch)
+
+        try:
+            results = self.batch_fn(batch[0].batch_key, [request.payload for request in batch], should_stop)
+            assert len(results) == len(batch), f"{len(results)} != {len(batch)}"
+        except BaseException as e:
+            with self._cond:
+                for request in batch:
+                    if request.stop_exception() is not None:
+                        self._fail(request, request.stop_exception())
+                if len(batch) == 1:
+                    if not batch[0].future.done():
+                        self._fail(batch[0], e)
+                    return
+                self.n_batch_failures += 1
+            for request in batch:
+                if not request.future.done():
+                    self._run_batch([request])
+            return
+        with self._cond:
+            for request, result in zip(batch, results):
+                if request.stop_exception() is not None:
+                    self._fail(request, request.stop_exception())
+                else:
+                    self._release(request)
+                    request.future.set_result(result)
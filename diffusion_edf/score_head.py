@@ -10,12 +10,13 @@ from e3nn import o3
 
 from diffusion_edf import transforms
 from diffusion_edf.equiformer.graph_attention_transformer import SeparableFCTP
-from diffusion_edf.multiscale_tensor_field import MultiscaleTensorField
-from diffusion_edf.gnn_data import FeaturedPoints, TransformPcd, set_featured_points_attribute, flatten_featured_points, detach_featured_points
+from diffusion_edf.multiscale_tensor_field import MultiscaleTensorField, TensorFieldHeadMixin
+from diffusion_edf.gnn_data import FeaturedPoints, GraphEdge, PreparedKeyField, TransformPcd, detach_featured_points
+from diffusion_edf.gnn_data import TimeEmbedding, PackedQueryPoints, slice_wigner_Ds
 from diffusion_edf.radial_func import SinusoidalPositionEmbeddings
 
 
-class ScoreModelHead(torch.nn.Module):
+class ScoreModelHead(TensorFieldHeadMixin, torch.nn.Module):
     jittable: bool = True
     max_time: float
     time_emb_mlp: List[int]
@@ -142,71 +143,205 @@ class ScoreModelHead(torch.nn.Module):
     def forward(self, Ts: torch.Tensor,
                 key_pcd_multiscale: List[FeaturedPoints],
                 query_pcd: FeaturedPoints,
-                time: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+                time: Optional[torch.Tensor] = None,
+                key_field: Optional[PreparedKeyField] = None,
+                candidate_edges: Optional[List[Optional[GraphEdge]]] = None,
+                max_edges: Optional[int] = None,
+                max_bytes: Optional[int] = None,
+                time_emb: Optional[TimeEmbedding] = None,
+                time_emb_idx: Optional[torch.Tensor] = None,
+                Ds: Optional[List[torch.Tensor]] = None,
+                out: Optional[Tuple[torch.Tensor, torch.Tensor]] = None) -> Tuple[torch.Tensor, torch.Tensor]:
+        """
+        max_edges / max_bytes: Budget on the number of graph edges (or on the memory of the edge tensors) of a single pass.
+            If set, the poses are split into chunks within the budget (see plan_pose_chunks). 
+            The result is identical to the unchunked forward.
+        time_emb / time_emb_idx: Precomputed time embeddings (see compute_time_embedding), used in place of time.
+            If time_emb_idx is given, its rows time_emb_idx ((nT,), or (1,) if every pose shares the same time) are used.
+        Ds: Precomputed Wigner D blocks of Ts (see compute_wigner_Ds), used to rotate the query features. Built from Ts if not given.
+        out: Output buffers (ang_vel, lin_vel) of shape (nT, 3) to write the scores into, e.g., kept across the steps of the sampler.
+            If not given, they are only allocated to gather multiple chunks.
+        """
+        time_emb = self._resolve_time_embedding(Ts=Ts, time=time, time_emb=time_emb, time_emb_idx=time_emb_idx)   # (nT or 1, time_emb_D)
+        chunks, key_field = self._split_pose_chunks(Ts=Ts, key_pcd_multiscale=key_pcd_multiscale, query_pcd=query_pcd, time_emb=time_emb, key_field=key_field, 
+                                                    candidate_edges=candidate_edges, max_edges=max_edges, max_bytes=max_bytes, Ds=Ds)
+        if out is None:
+            if len(chunks) == 1:
+                return self._forward(Ts=Ts, key_pcd_multiscale=key_pcd_multiscale, query_pcd=query_pcd, 
+                                     time_emb=time_emb, key_field=key_field, candidate_edges=candidate_edges, Ds=Ds)
+            out = (query_pcd.f.new_empty(len(Ts), 3), query_pcd.f.new_empty(len(Ts), 3))   # (N_T, 3), (N_T, 3)
+        ang_vel, lin_vel = out
+        assert len(ang_vel) == len(Ts) and len(lin_vel) == len(Ts), f"{ang_vel.shape}, {lin_vel.shape}"
+        for chunk in chunks:
+            ang_vel_chunk, lin_vel_chunk = self._forward(Ts=Ts[chunk.start:chunk.end], key_pcd_multiscale=key_pcd_multiscale, query_pcd=query_pcd, 
+                                                         time_emb=chunk.time_emb, key_field=key_field, candidate_edges=chunk.candidate_edges, Ds=chunk.Ds)
+            ang_vel[chunk.start:chunk.end] = ang_vel_chunk
+            lin_vel[chunk.start:chunk.end] = lin_vel_chunk
+
+        return ang_vel, lin_vel
+
+    @torch.jit.export
+    def forward_multiscene(self, Ts: torch.Tensor,
+                           key_pcd_multiscale: List[FeaturedPoints],
+                           query_pcd_list: List[FeaturedPoints],
+                           pose_counts: List[int],
+                           time: Optional[torch.Tensor] = None,
+                           key_field: Optional[PreparedKeyField] = None,
+                           time_emb: Optional[TimeEmbedding] = None,
+                           time_emb_idx: Optional[torch.Tensor] = None,
+                           Ds: Optional[List[torch.Tensor]] = None) -> Tuple[torch.Tensor, torch.Tensor]:
+        """
+        Scores of the poses of several scenes in a single pass.
+        key_pcd_multiscale: Key points of all the scenes, packed with the scene index as the batch index b (see gnn_data.pack_featured_points).
+        query_pcd_list: Query points of each scene.
+        pose_counts: Number of poses of each scene. Ts must be grouped by scene in the same order.
+        Query points are only connected to the key points of their own scene,
+        so the result equals that of forward on each scene (up to floating point rounding).
+        Ds: Precomputed Wigner D blocks of Ts (see compute_wigner_Ds). Built from Ts if not given.
+        """
+        time_emb = self._resolve_time_embedding(Ts=Ts, time=time, time_emb=time_emb, time_emb_idx=time_emb_idx)   # (nT or 1, time_emb_D)
+        assert Ts.ndim == 2 and Ts.shape[-1] == 7, f"{Ts.shape}" # Ts: (nT, 4+3: quaternion + position)
+        assert len(query_pcd_list) == len(pose_counts), f"{len(query_pcd_list)} != {len(pose_counts)}"
+        assert sum(pose_counts) == len(Ts), f"{sum(pose_counts)} != {len(Ts)}"
+
+        nT = len(Ts)
+        if nT == 0:
+            return Ts.new_zeros(0, 3), Ts.new_zeros(0, 3)
+
+        queries = self._pack_query_points(Ts=Ts, query_pcd_list=query_pcd_list, pose_counts=pose_counts, Ds=Ds, scene_batch=True)
+        return self._score(Ts=Ts, queries=queries, key_pcd_multiscale=key_pcd_multiscale, time_emb=time_emb, key_field=key_field, candidate_edges=None)
+
+    def _forward(self, Ts: torch.Tensor,
+                 key_pcd_multiscale: List[FeaturedPoints],
+                 query_pcd: FeaturedPoints,
+                 time_emb: TimeEmbedding,
+                 key_field: Optional[PreparedKeyField] = None,
+                 candidate_edges: Optional[List[Optional[GraphEdge]]] = None,
+                 Ds: Optional[List[torch.Tensor]] = None) -> Tuple[torch.Tensor, torch.Tensor]:
         # !!!!!!!!!!!!!!!! Warning !!!!!!!!!!!!!!
-        # Batched forward is not yet implemented
+        # Single scene only. Use forward_multiscene for the poses of multiple scenes.
         # !!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!
         assert Ts.ndim == 2 and Ts.shape[-1] == 7, f"{Ts.shape}" # Ts: (nT, 4+3: quaternion + position) 
-        assert time.ndim == 1 and len(time) == len(Ts), f"{time.shape}" # time: (nT,)
         assert query_pcd.f.ndim == 2 and query_pcd.f.shape[-1] == self.query_edf_dim, f"{query_pcd.f.shape}" # query_pcd: (nQ, 3), (nQ, F), (nQ,), (nQ)
 
-        nT = len(Ts)
-        nQ = len(query_pcd.x)
+        if len(Ts) == 0:
+            return Ts.new_zeros(0, 3), Ts.new_zeros(0, 3)
 
-        query_weight = query_pcd.w     # (nQ,)
-        assert isinstance(query_weight, torch.Tensor) # to tell torch.jit.script that it is tensor
+        queries = self._pack_query_points(Ts=Ts, query_pcd_list=[query_pcd], pose_counts=[len(Ts)], Ds=Ds, scene_batch=False)
+        return self._score(Ts=Ts, queries=queries, key_pcd_multiscale=key_pcd_multiscale, time_emb=time_emb, key_field=key_field, candidate_edges=candidate_edges)
+
+    def _pack_query_points(self, Ts: torch.Tensor,
+                           query_pcd_list: List[FeaturedPoints],
+                           pose_counts: List[int],
+                           Ds: Optional[List[torch.Tensor]],
+                           scene_batch: bool) -> PackedQueryPoints:
+        """
+        Transform the query points of each scene by the poses of the scene and pack them into (N, ...) rows, N = sum(n*nQ).
+        scene_batch: If True, the scene index is used as the batch index of the query points (see forward_multiscene). 
+            Otherwise, the batch index of query_pcd is kept.
+        """
+        x_list: List[torch.Tensor] = []
+        x_local_list: List[torch.Tensor] = []
+        f_list: List[torch.Tensor] = []
+        b_list: List[torch.Tensor] = []
+        w_list: List[torch.Tensor] = []
+        pose_idx_list: List[torch.Tensor] = []
+        n_queries: int = -1
+        start: int = 0
+        for scene_idx, query_pcd in enumerate(query_pcd_list):
+            n: int = pose_counts[scene_idx]
+            if n == 0:
+                continue
+            assert query_pcd.f.ndim == 2 and query_pcd.f.shape[-1] == self.query_edf_dim, f"{query_pcd.f.shape}" # query_pcd: (nQ, 3), (nQ, F), (nQ,), (nQ)
+            query_weight = query_pcd.w     # (nQ,)
+            assert isinstance(query_weight, torch.Tensor) # to tell torch.jit.script that it is tensor
+            nQ = len(query_pcd.x)
+            n_queries = nQ
+
+            query_transformed: FeaturedPoints = self.query_transform(pcd = query_pcd, Ts = Ts[start:start+n], 
+                                                                     Ds = slice_wigner_Ds(Ds, start=start, end=start+n))   # (n, nQ, 3), (n, nQ, F), (n, nQ,), (n, nQ,)
+            x_list.append(query_transformed.x.reshape(n*nQ, 3))
+            f_list.append(query_transformed.f.reshape(n*nQ, self.query_edf_dim))
+            x_local_list.append(query_pcd.x.expand(n, -1, -1).reshape(n*nQ, 3))
+            if scene_batch:
+                b_list.append(torch.full((n*nQ,), scene_idx, device=Ts.device, dtype=torch.long))
+            else:
+                b_list.append(query_transformed.b.reshape(n*nQ))
+            w_list.append(query_weight.expand(n, -1).reshape(n*nQ))
+            pose_idx_list.append(torch.arange(start, start+n, device=Ts.device).repeat_interleave(nQ))
+            start = start + n
+
+        if len(pose_idx_list) == 1:
+            return PackedQueryPoints(x=x_list[0], x_local=x_local_list[0], f=f_list[0], b=b_list[0], w=w_list[0], 
+                                     pose_idx=pose_idx_list[0], n_queries=n_queries)
+        return PackedQueryPoints(x=torch.cat(x_list, dim=0), x_local=torch.cat(x_local_list, dim=0), f=torch.cat(f_list, dim=0),
+                                 b=torch.cat(b_list, dim=0), w=torch.cat(w_list, dim=0), pose_idx=torch.cat(pose_idx_list, dim=0), 
+                                 n_queries=-1)
+
+    def _score(self, Ts: torch.Tensor,
+               queries: PackedQueryPoints,
+               key_pcd_multiscale: List[FeaturedPoints],
+               time_emb: TimeEmbedding,
+               key_field: Optional[PreparedKeyField] = None,
+               candidate_edges: Optional[List[Optional[GraphEdge]]] = None) -> Tuple[torch.Tensor, torch.Tensor]:
+        """
+        Scores of the poses Ts from their packed query points (see _pack_query_points).
+        """
+        nT = len(Ts)
+        pose_idx = queries.pose_idx                                                                              # (N,)
 
         time_embs_multiscale: List[torch.Tensor] = []
-        time_enc: torch.Tensor = self.time_enc(time)                       # (nT, time_emb_mlp[0])
-        for time_mlp in self.time_mlps_multiscale:
-            time_embs_multiscale.append(
-                time_mlp(time_enc).unsqueeze(-2).expand(-1, nQ, -1).reshape(nT*nQ, self.time_emb_dim)        # (nT, time_emb_D) -> # (nT*nQ, time_emb_D)
-            )        
-
-        ################# TODO: SCRUTINIZE THIS CODE ########################
-        query_transformed: FeaturedPoints = self.query_transform(pcd = query_pcd, Ts = Ts)                                     # (nT, nQ, 3), (nT, nQ, F), (nT, nQ,), (nT, nQ,)
-        query_features_transformed: torch.Tensor = query_transformed.f.clone()                                                 # (nT, nQ, F)         
+        for time_emb_scale in time_emb.multiscale:
+            time_embs_multiscale.append(time_emb_scale.expand(nT, -1).index_select(0, pose_idx))                 # (nT or 1, time_emb_D) -> (N, time_emb_D)
         if self.query_time_encoding:
-            assert self.query_time_mlp is not None
-            query_transformed = set_featured_points_attribute(points=query_transformed, 
-                                                                              f=self.query_time_mlp(time_enc).unsqueeze(-2).expand(nT, nQ, self.time_emb_dim),  # (nT, time_emb_D) -> # (nT, nQ, time_emb_D)
-                                                                              w=None)    # (nT, nQ, 3), (nT, nQ, time_emb), (nT, nQ,), None
+            query_time_emb = time_emb.query
+            assert query_time_emb is not None
+            query_f = query_time_emb.expand(nT, -1).index_select(0, pose_idx)                                    # (N, time_emb_D)
         else:
-            query_transformed = set_featured_points_attribute(points=query_transformed, f=torch.empty_like(query_transformed.f), w=None)   # (nT, nQ, 3), (nT, nQ, -), (nT, nQ,), None
+            query_f = torch.empty_like(queries.f)
+        query_points = FeaturedPoints(x=queries.x, f=query_f, b=queries.b, w=None)
 
-        query_transformed = flatten_featured_points(query_transformed)                                         # (nT*nQ, 3), (nT*nQ, time_emb), (nT*nQ,), None
         if self.edge_time_encoding:
-            query_transformed = self.key_tensor_field(query_points = query_transformed, 
-                                                                      input_points_multiscale = key_pcd_multiscale,
-                                                                      context_emb = time_embs_multiscale)                      # (nT*nQ, 3), (nT*nQ, F), (nT*nQ,), (nT*nQ,)
+            query_points = self.key_tensor_field(query_points = query_points,
+                                                 input_points_multiscale = key_pcd_multiscale,
+                                                 context_emb = time_embs_multiscale,
+                                                 key_field = key_field,
+                                                 candidate_edges = candidate_edges)                              # (N, 3), (N, F), (N,), (N,)
         else:
             assert self.query_time_encoding is True, f"You need to use at least one (query or edge) time encoding method."
-            query_transformed = self.key_tensor_field(query_points = query_transformed, 
-                                                                      input_points_multiscale = key_pcd_multiscale,
-                                                                      context_emb = None)                                         # (nT*nQ, 3), (nT*nQ, F), (nT*nQ,), (nT*nQ,)                                                         # (nT*nQ, F)
-        key_features: torch.Tensor = query_transformed.f
-        query_features_transformed = query_features_transformed.view(-1, query_features_transformed.shape[-1])                    # (nT*nQ, F)
+            query_points = self.key_tensor_field(query_points = query_points,
+                                                 input_points_multiscale = key_pcd_multiscale,
+                                                 context_emb = None,
+                                                 key_field = key_field,
+                                                 candidate_edges = candidate_edges)                              # (N, 3), (N, F), (N,), (N,)
+        key_features: torch.Tensor = query_points.f
 
-        ######################################################################
-
-        lin_vel: torch.Tensor = self.lin_vel_tp(query_features_transformed, key_features,   # (nT*nQ, 1+F_prescore)
+        lin_vel: torch.Tensor = self.lin_vel_tp(queries.f, key_features,   # (N, 1+F_prescore)
                                                 edge_scalars = None, batch=None,)           # batch does nothing unless you use batchnorm
-        ang_spin: torch.Tensor = self.ang_vel_tp(query_features_transformed, key_features,  # (nT*nQ, 1+F_prescore)
+        ang_spin: torch.Tensor = self.ang_vel_tp(queries.f, key_features,  # (N, 1+F_prescore)
                                                  edge_scalars = None, batch=None)           # batch does nothing unless you use batchnorm
         lin_vel, ang_spin = lin_vel[..., 1:], ang_spin[..., 1:] # Discard the placeholder 1x0e feature to avoid torch jit error. TODO: Remove this
 
-        lin_vel = lin_vel.view(nT, nQ, self.n_irreps_prescore, 3).mean(dim=-2)    # (N_T, N_Q, 3), Project multiple nx1e -> 1x1e 
-        ang_spin = ang_spin.view(nT, nQ, self.n_irreps_prescore, 3).mean(dim=-2)  # (N_T, N_Q, 3), Project multiple nx1e -> 1x1e 
+        lin_vel = lin_vel.view(-1, self.n_irreps_prescore, 3).mean(dim=-2)    # (N, 3), Project multiple nx1e -> 1x1e 
+        ang_spin = ang_spin.view(-1, self.n_irreps_prescore, 3).mean(dim=-2)  # (N, 3), Project multiple nx1e -> 1x1e 
 
-        q = Ts[..., :4]
-        qinv: torch.Tensor = transforms.quaternion_invert(q.unsqueeze(-2)) # (N_T, 1, 4)
-        lin_vel = transforms.quaternion_apply(qinv, lin_vel) # (N_T, N_Q, 3)
-        ang_spin = transforms.quaternion_apply(qinv, ang_spin) # (N_T, N_Q, 3)
-        ang_orbital = torch.cross(query_pcd.x.unsqueeze(0) / self.lin_mult, lin_vel, dim=-1) # (N_T, N_Q, 3)
+        qinv: torch.Tensor = transforms.quaternion_invert(Ts[..., :4]).index_select(0, pose_idx)  # (N, 4)
+        lin_vel = transforms.quaternion_apply(qinv, lin_vel) # (N, 3)
+        ang_spin = transforms.quaternion_apply(qinv, ang_spin) # (N, 3)
+        ang_orbital = torch.cross(queries.x_local / self.lin_mult, lin_vel, dim=-1) # (N, 3)
 
-        lin_vel = torch.einsum('q,tqi->ti', query_weight, lin_vel) # (N_T, 3)
-        ang_vel = (torch.einsum('q,tqi->ti', query_weight, ang_orbital)) \
-                +   (torch.einsum('q,tqi->ti', query_weight, ang_spin)) # (N_T, 3)
+        nQ = queries.n_queries
+        if nQ > 0:
+            # Every pose has the same query points
+            query_weight = queries.w[:nQ]                                                   # (nQ,)
+            lin_vel = torch.einsum('q,tqi->ti', query_weight, lin_vel.view(nT, nQ, 3)) # (nT, 3)
+            ang_vel = (torch.einsum('q,tqi->ti', query_weight, ang_orbital.view(nT, nQ, 3))) \
+                    + (torch.einsum('q,tqi->ti', query_weight, ang_spin.view(nT, nQ, 3))) # (nT, 3)
+        else:
+            query_weight = queries.w.unsqueeze(-1)                                          # (N, 1)
+            lin_vel = lin_vel.new_zeros(nT, 3).index_add_(0, pose_idx, query_weight * lin_vel)   # (nT, 3)
+            ang_vel = ang_spin.new_zeros(nT, 3).index_add_(0, pose_idx, query_weight * ang_orbital) \
+                    + ang_spin.new_zeros(nT, 3).index_add_(0, pose_idx, query_weight * ang_spin) # (nT, 3)
 
         return ang_vel, lin_vel
     
@@ -214,8 +349,17 @@ class ScoreModelHead(torch.nn.Module):
     def warmup(self, Ts: torch.Tensor,
                key_pcd_multiscale: List[FeaturedPoints],
                query_pcd: FeaturedPoints,
-               time: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
-        return self.forward(Ts=Ts, key_pcd_multiscale=key_pcd_multiscale, query_pcd=query_pcd, time=time)
+               time: Optional[torch.Tensor] = None,
+               key_field: Optional[PreparedKeyField] = None,
+               candidate_edges: Optional[List[Optional[GraphEdge]]] = None,
+               max_edges: Optional[int] = None,
+               max_bytes: Optional[int] = None,
+               time_emb: Optional[TimeEmbedding] = None,
+               time_emb_idx: Optional[torch.Tensor] = None,
+               Ds: Optional[List[torch.Tensor]] = None,
+               out: Optional[Tuple[torch.Tensor, torch.Tensor]] = None) -> Tuple[torch.Tensor, torch.Tensor]:
+        return self.forward(Ts=Ts, key_pcd_multiscale=key_pcd_multiscale, query_pcd=query_pcd, time=time, key_field=key_field, candidate_edges=candidate_edges,
+                            max_edges=max_edges, max_bytes=max_bytes, time_emb=time_emb, time_emb_idx=time_emb_idx, Ds=Ds, out=out)
     
     @torch.jit.ignore
     def _get_fake_input(self):
@@ -10,12 +10,13 @@ from e3nn import o3
 
 from diffusion_edf import transforms
 from diffusion_edf.equiformer.graph_attention_transformer import SeparableFCTP
-from diffusion_edf.multiscale_tensor_field import MultiscaleTensorField
-from diffusion_edf.gnn_data import FeaturedPoints, TransformPcd, set_featured_points_attribute, flatten_featured_points, detach_featured_points
+from diffusion_edf.multiscale_tensor_field import MultiscaleTensorField, TensorFieldHeadMixin
+from diffusion_edf.gnn_data import FeaturedPoints, GraphEdge, PreparedKeyField, TransformPcd, set_featured_points_attribute, flatten_featured_points, detach_featured_points
+from diffusion_edf.gnn_data import TimeEmbedding
 from diffusion_edf.radial_func import SinusoidalPositionEmbeddings
 
 
-class EbmScoreModelHead(torch.nn.Module):
+class EbmScoreModelHead(TensorFieldHeadMixin, torch.nn.Module):
     jittable: bool = False
     max_time: float
     time_emb_mlp: List[int]
@@ -122,12 +123,51 @@ class EbmScoreModelHead(torch.nn.Module):
     def compute_energy(self, Ts: torch.Tensor,
                        key_pcd_multiscale: List[FeaturedPoints],
                        query_pcd: FeaturedPoints,
-                       time: torch.Tensor) -> torch.Tensor:
+                       time: Optional[torch.Tensor] = None,
+                       key_field: Optional[PreparedKeyField] = None,
+                       candidate_edges: Optional[List[Optional[GraphEdge]]] = None,
+                       max_edges: Optional[int] = None,
+                       max_bytes: Optional[int] = None,
+                       time_emb: Optional[TimeEmbedding] = None,
+                       time_emb_idx: Optional[torch.Tensor] = None,
+                       Ds: Optional[List[torch.Tensor]] = None,
+                       out: Optional[torch.Tensor] = None) -> torch.Tensor:
+        """
+        max_edges / max_bytes: Budget on the number of graph edges (or on the memory of the edge tensors) of a single pass.
+            If set, the poses are split into chunks within the budget (see plan_pose_chunks). 
+            The result is identical to the unchunked computation.
+        time_emb / time_emb_idx: Precomputed time embeddings (see compute_time_embedding), used in place of time.
+            If time_emb_idx is given, its rows time_emb_idx ((nT,), or (1,) if every pose shares the same time) are used.
+        Ds: Precomputed Wigner D blocks of Ts (see compute_wigner_Ds), used to rotate the query features. Built from Ts if not given.
+            The energy is differentiable with respect to Ts only through the Ds that are built from it.
+        out: Output buffer of shape (nT,) to write the energy into. If not given, it is only allocated to gather multiple chunks.
+        """
+        time_emb = self._resolve_time_embedding(Ts=Ts, time=time, time_emb=time_emb, time_emb_idx=time_emb_idx)   # (nT or 1, time_emb_D)
+        chunks, key_field = self._split_pose_chunks(Ts=Ts, key_pcd_multiscale=key_pcd_multiscale, query_pcd=query_pcd, time_emb=time_emb, key_field=key_field, 
+                                                    candidate_edges=candidate_edges, max_edges=max_edges, max_bytes=max_bytes, Ds=Ds)
+        if out is None:
+            if len(chunks) == 1:
+                return self._compute_energy(Ts=Ts, key_pcd_multiscale=key_pcd_multiscale, query_pcd=query_pcd, 
+                                            time_emb=time_emb, key_field=key_field, candidate_edges=candidate_edges, Ds=Ds)
+            out = query_pcd.f.new_empty(len(Ts))   # (N_T,)
+        energy = out
+        assert len(energy) == len(Ts), f"{energy.shape}"
+        for chunk in chunks:
+            energy[chunk.start:chunk.end] = self._compute_energy(Ts=Ts[chunk.start:chunk.end], key_pcd_multiscale=key_pcd_multiscale, query_pcd=query_pcd, 
+                                                                 time_emb=chunk.time_emb, key_field=key_field, candidate_edges=chunk.candidate_edges, Ds=chunk.Ds)
+        return energy
+
+    def _compute_energy(self, Ts: torch.Tensor,
+                        key_pcd_multiscale: List[FeaturedPoints],
+                        query_pcd: FeaturedPoints,
+                        time_emb: TimeEmbedding,
+                        key_field: Optional[PreparedKeyField] = None,
+                        candidate_edges: Optional[List[Optional[GraphEdge]]] = None,
+                        Ds: Optional[List[torch.Tensor]] = None) -> torch.Tensor:
         # !!!!!!!!!!!!!!!! Warning !!!!!!!!!!!!!!
         # Batched forward is not yet implemented
         # !!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!
         assert Ts.ndim == 2 and Ts.shape[-1] == 7, f"{Ts.shape}" # Ts: (nT, 4+3: quaternion + position) 
-        assert time.ndim == 1 and len(time) == len(Ts), f"{time.shape}" # time: (nT,)
         assert query_pcd.f.ndim == 2 and query_pcd.f.shape[-1] == self.query_edf_dim, f"{query_pcd.f.shape}" # query_pcd: (nQ, 3), (nQ, F), (nQ,), (nQ)
 
         nT = len(Ts)
@@ -137,19 +177,19 @@ class EbmScoreModelHead(torch.nn.Module):
         assert isinstance(query_weight, torch.Tensor) # to tell torch.jit.script that it is tensor
 
         time_embs_multiscale: List[torch.Tensor] = []
-        time_enc: torch.Tensor = self.time_enc(time)                       # (nT, time_emb_mlp[0])
-        for time_mlp in self.time_mlps_multiscale:
+        for time_emb_scale in time_emb.multiscale:
             time_embs_multiscale.append(
-                time_mlp(time_enc).unsqueeze(-2).expand(-1, nQ, -1).reshape(nT*nQ, self.time_emb_dim)        # (nT, time_emb_D) -> # (nT*nQ, time_emb_D)
+                time_emb_scale.expand(nT, -1).unsqueeze(-2).expand(-1, nQ, -1).reshape(nT*nQ, self.time_emb_dim)        # (nT or 1, time_emb_D) -> # (nT*nQ, time_emb_D)
             )        
 
         ################# TODO: SCRUTINIZE THIS CODE ########################
-        query_transformed: FeaturedPoints = self.query_transform(pcd = query_pcd, Ts = Ts)                                     # (nT, nQ, 3), (nT, nQ, F), (nT, nQ,), (nT, nQ,)
+        query_transformed: FeaturedPoints = self.query_transform(pcd = query_pcd, Ts = Ts, Ds = Ds)                             # (nT, nQ, 3), (nT, nQ, F), (nT, nQ,), (nT, nQ,)
         query_features_transformed: torch.Tensor = query_transformed.f.clone()                                                 # (nT, nQ, F)         
         if self.query_time_encoding:
-            assert self.query_time_mlp is not None
+            query_time_emb = time_emb.query
+            assert query_time_emb is not None
             query_transformed = set_featured_points_attribute(points=query_transformed, 
-                                                                              f=self.query_time_mlp(time_enc).unsqueeze(-2).expand(nT, nQ, self.time_emb_dim),  # (nT, time_emb_D) -> # (nT, nQ, time_emb_D)
+                                                                              f=query_time_emb.expand(nT, -1).unsqueeze(-2).expand(nT, nQ, self.time_emb_dim),  # (nT or 1, time_emb_D) -> # (nT, nQ, time_emb_D)
                                                                               w=None)    # (nT, nQ, 3), (nT, nQ, time_emb), (nT, nQ,), None
         else:
             query_transformed = set_featured_points_attribute(points=query_transformed, f=torch.empty_like(query_transformed.f), w=None)   # (nT, nQ, 3), (nT, nQ, -), (nT, nQ,), None
@@ -158,12 +198,16 @@ class EbmScoreModelHead(torch.nn.Module):
         if self.edge_time_encoding:
             query_transformed = self.key_tensor_field(query_points = query_transformed, 
                                                                       input_points_multiscale = key_pcd_multiscale,
-                                                                      context_emb = time_embs_multiscale)                      # (nT*nQ, 3), (nT*nQ, F), (nT*nQ,), (nT*nQ,)
+                                                                      context_emb = time_embs_multiscale,
+                                                                      key_field = key_field,
+                                                                      candidate_edges = candidate_edges)                      # (nT*nQ, 3), (nT*nQ, F), (nT*nQ,), (nT*nQ,)
         else:
             # assert self.query_time_encoding is True, f"You need to use at least one (query or edge) time encoding method."
             query_transformed = self.key_tensor_field(query_points = query_transformed, 
                                                                       input_points_multiscale = key_pcd_multiscale,
-                                                                      context_emb = None)                                         # (nT*nQ, 3), (nT*nQ, F), (nT*nQ,), (nT*nQ,)                                                         # (nT*nQ, F)
+                                                                      context_emb = None,
+                                                                      key_field = key_field,
+                                                                      candidate_edges = candidate_edges)                                         # (nT*nQ, 3), (nT*nQ, F), (nT*nQ,), (nT*nQ,)                                                         # (nT*nQ, F)
         key_features: torch.Tensor = query_transformed.f
         query_features_transformed = query_features_transformed.view(-1, query_features_transformed.shape[-1])                    # (nT*nQ, F)
 
@@ -177,8 +221,17 @@ class EbmScoreModelHead(torch.nn.Module):
     def warmup(self, Ts: torch.Tensor,
                key_pcd_multiscale: List[FeaturedPoints],
                query_pcd: FeaturedPoints,
-               time: torch.Tensor) -> torch.Tensor:
-        return self.compute_energy(Ts=Ts, key_pcd_multiscale=key_pcd_multiscale, query_pcd=query_pcd, time=time)
+               time: Optional[torch.Tensor] = None,
+               key_field: Optional[PreparedKeyField] = None,
+               candidate_edges: Optional[List[Optional[GraphEdge]]] = None,
+               max_edges: Optional[int] = None,
+               max_bytes: Optional[int] = None,
+               time_emb: Optional[TimeEmbedding] = None,
+               time_emb_idx: Optional[torch.Tensor] = None,
+               Ds: Optional[List[torch.Tensor]] = None,
+               out: Optional[torch.Tensor] = None) -> torch.Tensor:
+        return self.compute_energy(Ts=Ts, key_pcd_multiscale=key_pcd_multiscale, query_pcd=query_pcd, time=time, key_field=key_field, candidate_edges=candidate_edges,
+                                   max_edges=max_edges, max_bytes=max_bytes, time_emb=time_emb, time_emb_idx=time_emb_idx, Ds=Ds, out=out)
         
     def train(self, mode: bool = True):
         super().train(mode=mode)
@@ -192,20 +245,59 @@ class EbmScoreModelHead(torch.nn.Module):
     def forward(self, Ts: torch.Tensor,
                 key_pcd_multiscale: List[FeaturedPoints],
                 query_pcd: FeaturedPoints,
-                time: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+                time: Optional[torch.Tensor] = None,
+                key_field: Optional[PreparedKeyField] = None,
+                candidate_edges: Optional[List[Optional[GraphEdge]]] = None,
+                max_edges: Optional[int] = None,
+                max_bytes: Optional[int] = None,
+                time_emb: Optional[TimeEmbedding] = None,
+                time_emb_idx: Optional[torch.Tensor] = None,
+                out: Optional[Tuple[torch.Tensor, torch.Tensor]] = None) -> Tuple[torch.Tensor, torch.Tensor]:
+        """
+        max_edges / max_bytes: See compute_energy. The energy and its gradient are computed chunk by chunk, 
+            so that only the graph of a single chunk is kept for backpropagation at a time.
+        out: Output buffers (ang_vel, lin_vel) of shape (nT, 3) to write the scores into. If not given, they are only allocated to gather multiple chunks.
+        """
+        time_emb = self._resolve_time_embedding(Ts=Ts, time=time, time_emb=time_emb, time_emb_idx=time_emb_idx)   # (nT or 1, time_emb_D)
+        chunks, key_field = self._split_pose_chunks(Ts=Ts, key_pcd_multiscale=key_pcd_multiscale, query_pcd=query_pcd, time_emb=time_emb, key_field=key_field, 
+                                                    candidate_edges=candidate_edges, max_edges=max_edges, max_bytes=max_bytes)
+        if out is None:
+            if len(chunks) == 1:
+                return self._forward(Ts=Ts, key_pcd_multiscale=key_pcd_multiscale, query_pcd=query_pcd, 
+                                     time_emb=time_emb, key_field=key_field, candidate_edges=candidate_edges)
+            out = (query_pcd.f.new_empty(len(Ts), 3), query_pcd.f.new_empty(len(Ts), 3))   # (N_T, 3), (N_T, 3)
+        ang_vel, lin_vel = out
+        assert len(ang_vel) == len(Ts) and len(lin_vel) == len(Ts), f"{ang_vel.shape}, {lin_vel.shape}"
+        for chunk in chunks:
+            ang_vel_chunk, lin_vel_chunk = self._forward(Ts=Ts[chunk.start:chunk.end], key_pcd_multiscale=key_pcd_multiscale, query_pcd=query_pcd, 
+                                                         time_emb=chunk.time_emb, key_field=key_field, candidate_edges=chunk.candidate_edges)
+            ang_vel[chunk.start:chunk.end] = ang_vel_chunk
+            lin_vel[chunk.start:chunk.end] = lin_vel_chunk
+
+        return ang_vel, lin_vel
+
+    def _forward(self, Ts: torch.Tensor,
+                 key_pcd_multiscale: List[FeaturedPoints],
+                 query_pcd: FeaturedPoints,
+                 time_emb: TimeEmbedding,
+                 key_field: Optional[PreparedKeyField] = None,
+                 candidate_edges: Optional[List[Optional[GraphEdge]]] = None) -> Tuple[torch.Tensor, torch.Tensor]:
         # !!!!!!!!!!!!!!!! Warning !!!!!!!!!!!!!!
         # Batched forward is not yet implemented
         # !!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!
         assert Ts.ndim == 2 and Ts.shape[-1] == 7, f"{Ts.shape}" # Ts: (nT, 4+3: quaternion + position) 
-        assert time.ndim == 1 and len(time) == len(Ts), f"{time.shape}" # time: (nT,)
         assert query_pcd.f.ndim == 2 and query_pcd.f.shape[-1] == self.query_edf_dim, f"{query_pcd.f.shape}" # query_pcd: (nQ, 3), (nQ, F), (nQ,), (nQ)
 
         T = Ts.detach().requires_grad_(True)
-        logP = -self.compute_energy(
+        Ds = self.compute_wigner_Ds(T)    # Built from T, so that the gradient flows through the rotation of the query features
+        logP = -self._compute_energy(
             Ts=T,
             key_pcd_multiscale=key_pcd_multiscale,
             query_pcd=query_pcd,
-            time=time
+            time_emb=time_emb,
+            key_field=key_field,
+            candidate_edges=candidate_edges,
+            Ds=Ds
         ) # shape: (nT,)
         
         # logP.sum().backward(inputs=T, create_graph=not self.inference_mode)
@@ -1,7 +1,8 @@
-from typing import List, Optional, Union, Tuple, Iterable, Callable, Dict, Sequence
+from typing import List, Optional, Union, Tuple, Iterable, Callable, Dict, Sequence, NamedTuple, Any
+from collections import OrderedDict
 import math
+import time
 import warnings
-from tqdm import tqdm
 from beartype import beartype
 
 import torch
@@ -14,9 +15,289 @@ from diffusion_edf.unet_feature_extractor import UnetFeatureExtractor
 from diffusion_edf.forward_only_feature_extractor import ForwardOnlyFeatureExtractor
 from diffusion_edf.multiscale_tensor_field import MultiscaleTensorField
 from diffusion_edf.keypoint_extractor import KeypointExtractor, StaticKeypointModel
-from diffusion_edf.gnn_data import FeaturedPoints, TransformPcd, set_featured_points_attribute, flatten_featured_points, detach_featured_points
+from diffusion_edf.gnn_data import FeaturedPoints, GraphEdge, PreparedKeyField, TimeEmbedding, TransformPcd, set_featured_points_attribute, flatten_featured_points, detach_featured_points, pack_featured_points
+from diffusion_edf.graph_parser import VerletNeighborList
 from diffusion_edf.radial_func import SinusoidalPositionEmbeddings
 from diffusion_edf.score_head import ScoreModelHead
+from diffusion_edf.score_head_ebm import EbmScoreModelHead
+
+
+ScoreFn = Callable[[torch.Tensor, int], Tuple[torch.Tensor, torch.Tensor]]    # (Ts, step) -> (ang_score, lin_score) at the time of the step
+
+
+class SamplingCancelled(RuntimeError):
+    """
+    Raised by the samplers when should_stop() returns True.
+    """
+    pass
+
+
+def quaternion_increment_update(T: torch.Tensor, ang_disp: torch.Tensor, lin_disp: torch.Tensor) -> torch.Tensor:
+    """
+    First-order update with the body frame displacement: q <- normalize(q + dq), x <- x + R(q) @ lin_disp
+    T: (nT, 7) || ang_disp, lin_disp: (nT, 3)
+    """
+    q_indices = torch.tensor([[1,2,3], [0,3,2], [3,0,1], [2,1,0]], dtype=torch.long, device=T.device)
+    q_factor = torch.tensor([[-0.5, -0.5, -0.5], [0.5, -0.5, 0.5], [0.5, 0.5, -0.5], [-0.5, 0.5, 0.5]], dtype=T.dtype, device=T.device)
+    L = T.detach()[...,q_indices] * q_factor
+    q, x = T[...,:4], T[...,4:]
+    dq = torch.einsum('...ij,...j->...i', L, ang_disp)
+    dx = transforms.quaternion_apply(q, lin_disp)
+    q = transforms.normalize_quaternion(q + dq)
+    return torch.cat([q, x+dx], dim=-1)
+
+
+def exp_map_update(T: torch.Tensor, ang_disp: torch.Tensor, lin_disp: torch.Tensor) -> torch.Tensor:
+    """
+    Group update with the body frame displacement: T <- T @ exp([lin_disp, ang_disp])
+    T: (nT, 7) || ang_disp, lin_disp: (nT, 3)
+    """
+    dT = transforms.se3_exp_map(torch.cat([lin_disp, ang_disp], dim=-1))                      # (nT, 4, 4)
+    dT = torch.cat([transforms.matrix_to_quaternion(dT[..., :3, :3]), dT[..., :3, 3]], dim=-1)  # (nT, 7)
+    return transforms.multiply_se3(T, dT)
+
+
+class SE3Integrator():
+    """
+    One step of the reverse diffusion on SE(3).
+    Subclasses implement step(), which returns the next poses and the deterministic (score-driven) part of the displacement.
+        step: index of the current step in the SamplingPlan, at which score_fn is evaluated
+        next_step: index of the next step, where the second score evaluation of higher-order schemes is done
+        alpha_ang, alpha_lin: step sizes of the current step
+        temperature: noise temperature of the current step
+    """
+    n_score_evals: int = 1      # Number of score evaluations per step
+
+    def step(self, score_fn: ScoreFn, 
+             T: torch.Tensor, 
+             step: int, 
+             next_step: int,
+             alpha_ang: torch.Tensor, 
+             alpha_lin: torch.Tensor, 
+             temperature: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+        raise NotImplementedError
+
+
+class EulerMaruyamaIntegrator(SE3Integrator):
+    """
+    First-order Langevin update, q <- normalize(q + dq)
+    """
+    n_score_evals: int = 1
+
+    def step(self, score_fn: ScoreFn, T, step, next_step, alpha_ang, alpha_lin, temperature):
+        ang_score, lin_score = score_fn(T, step)
+
+        ang_noise = torch.sqrt(temperature*alpha_ang) * torch.randn_like(ang_score, dtype=torch.float64) 
+        lin_noise = torch.sqrt(temperature*alpha_lin) * torch.randn_like(lin_score, dtype=torch.float64)
+
+        ang_drift = (alpha_ang/2) * ang_score
+        lin_drift = (alpha_lin/2) * lin_score
+        T_next = quaternion_increment_update(T, ang_disp=ang_drift + ang_noise, lin_disp=lin_drift + lin_noise)
+        return T_next, ang_drift, lin_drift
+
+
+class HeunIntegrator(SE3Integrator):
+    """
+    Stochastic Heun (predictor-corrector) update.
+    The predictor is the Euler-Maruyama step. The corrector re-evaluates the score at the predicted poses and the next step, 
+    and steps from the original poses with the averaged score and the same noise, using the exponential map.
+    """
+    n_score_evals: int = 2
+
+    def step(self, score_fn: ScoreFn, T, step, next_step, alpha_ang, alpha_lin, temperature):
+        ang_score, lin_score = score_fn(T, step)
+
+        ang_noise = torch.sqrt(temperature*alpha_ang) * torch.randn_like(ang_score, dtype=torch.float64) 
+        lin_noise = torch.sqrt(temperature*alpha_lin) * torch.randn_like(lin_score, dtype=torch.float64)
+
+        T_pred = exp_map_update(T, ang_disp=(alpha_ang/2) * ang_score + ang_noise, lin_disp=(alpha_lin/2) * lin_score + lin_noise)
+        ang_score_pred, lin_score_pred = score_fn(T_pred, next_step)
+
+        ang_drift = (alpha_ang/4) * (ang_score + ang_score_pred)
+        lin_drift = (alpha_lin/4) * (lin_score + lin_score_pred)
+        T_next = exp_map_update(T, ang_disp=ang_drift + ang_noise, lin_disp=lin_drift + lin_noise)
+        return T_next, ang_drift, lin_drift
+
+
+class DeterministicHeunIntegrator(SE3Integrator):
+    """
+    Heun update of HeunIntegrator without the noise, i.e., the averaged score drift only. The temperature is ignored.
+    This is not the probability flow ODE of the diffusion (whose drift would also depend on the schedule), 
+    but a deterministic integrator of the score drift, e.g., to compare the results of different sampling paths.
+    """
+    n_score_evals: int = 2
+
+    def step(self, score_fn: ScoreFn, T, step, next_step, alpha_ang, alpha_lin, temperature):
+        ang_score, lin_score = score_fn(T, step)
+        T_pred = exp_map_update(T, ang_disp=(alpha_ang/2) * ang_score, lin_disp=(alpha_lin/2) * lin_score)
+        ang_score_pred, lin_score_pred = score_fn(T_pred, next_step)
+
+        ang_drift = (alpha_ang/4) * (ang_score + ang_score_pred)
+        lin_drift = (alpha_lin/4) * (lin_score + lin_score_pred)
+        T_next = exp_map_update(T, ang_disp=ang_drift, lin_disp=lin_drift)
+        return T_next, ang_drift, lin_drift
+
+
+INTEGRATORS: Dict[str, type] = {
+    'euler_maruyama': EulerMaruyamaIntegrator,
+    'heun': HeunIntegrator,
+    'deterministic_heun': DeterministicHeunIntegrator,
+}
+
+def get_integrator(integrator: Union[str, SE3Integrator]) -> SE3Integrator:
+    if isinstance(integrator, SE3Integrator):
+        return integrator
+    if integrator not in INTEGRATORS.keys():
+        raise ValueError(f"Unknown integrator: {integrator} (available: {list(INTEGRATORS.keys())})")
+    return INTEGRATORS[integrator]()
+
+
+class SamplingPlan(NamedTuple):
+    """
+    Everything in ScoreModelBase.sample that only depends on the diffusion schedule, tabulated for all the steps of all the schedules.
+    The k-th row is the k-th step of the concatenated schedules.
+    """
+    t: torch.Tensor                     # (nSteps, 1), float64
+    temperature: torch.Tensor           # (nSteps, 1), float64
+    alpha_ang: torch.Tensor             # (nSteps, 1), float64
+    alpha_lin: torch.Tensor             # (nSteps, 1), float64
+    ang_score_denom: torch.Tensor       # (nSteps, 1), float64, ang_mult * sqrt(t)
+    lin_score_denom: torch.Tensor       # (nSteps, 1), float64, lin_mult * sqrt(t)
+    step_idx: torch.Tensor              # (nSteps,), long, row index of each step in time_emb
+    time_emb: TimeEmbedding             # (nSteps, time_emb_D), score head time embeddings of each step
+    stage_offsets: List[int]            # Steps of the n-th schedule are [stage_offsets[n], stage_offsets[n+1])
+    diffusion_schedules: List[Tuple[float, float]]
+    temperature_bases: List[float]
+    t_values: List[float]               # t of each step as python floats, for progress reports without device synchronization
+
+
+RETENTION_MODES = ('full', 'every_k', 'per_stage_endpoints', 'final_only')
+
+class TrajectoryBuffer():
+    """
+    Preallocated buffer of the poses kept from the sampling trajectory.
+        full:                the seed, the poses after every step, and the final poses (nSteps + 2 frames)
+        every_k:             the seed, the poses after every retain_every-th step, and the final poses
+        per_stage_endpoints: the seed and the poses at the end of each schedule
+        final_only:          the final poses only
+    The last frame is always the final poses. Frames of steps skipped after every pose has converged are not written.
+    """
+    def __init__(self, T0: torch.Tensor, retention: str, n_steps: int, n_stages: int, retain_every: int = 1):
+        if retention not in RETENTION_MODES:
+            raise ValueError(f"Unknown retention: {retention} (available: {RETENTION_MODES})")
+        assert retain_every >= 1, f"{retain_every}"
+        self.retention = retention
+        self.retain_every = retain_every if retention == 'every_k' else 1
+
+        if retention == 'final_only':
+            n_frames = 1
+        elif retention == 'per_stage_endpoints':
+            n_frames = 1 + max(n_stages, 1)
+        else:
+            n_frames = 1 + n_steps // self.retain_every + 1
+        self.frames = T0.new_empty(n_frames, *T0.shape)
+        self.n_frames = 0
+        if retention != 'final_only':
+            self._write(T0)
+
+    def _write(self, T: torch.Tensor):
+        self.frames[self.n_frames].copy_(T)
+        self.n_frames += 1
+
+    def step_done(self, step: int, T: torch.Tensor):
+        if self.retention in ('full', 'every_k') and (step + 1) % self.retain_every == 0:
+            self._write(T)
+
+    def stage_done(self, T: torch.Tensor):
+        if self.retention == 'per_stage_endpoints':
+            self._write(T)
+
+    def finalize(self, T: torch.Tensor) -> torch.Tensor:
+        if self.retention in ('full', 'every_k', 'final_only') or self.n_frames <= 1:
+            self._write(T)
+        return self.frames[:self.n_frames]
+
+
+class TimeBudget():
+    """
+    Wall-clock budget of the denoising steps, which may be shared by successive sample calls (e.g., the models of DiffusionEdfAgent).
+    The cost of a step is measured during the first n_calibration_steps steps of each sample call. 
+    Until then, known_step_cost_s is used if it was set by the caller (e.g., from earlier calls with the same model), otherwise the estimate of the previous call.
+    Whenever the remaining work no longer fits in the remaining time, the remaining steps of the current schedule are thinned out evenly
+    by the same factor as the rest of the work, always keeping the last step (the t endpoint) of the schedule.
+    Schedules that have not started keep both of their t endpoints. Step sizes are not changed, only the t grid gets coarser.
+    later_steps: (planned steps, per-step cost if known) of each sample call after the current one, set by the caller.
+    """
+    def __init__(self, time_budget_s: float, n_calibration_steps: int = 2):
+        assert time_budget_s > 0., f"{time_budget_s}"
+        assert n_calibration_steps >= 1, f"{n_calibration_steps}"
+        self.time_budget_s = time_budget_s
+        self.n_calibration_steps = n_calibration_steps
+        self.t_start = time.perf_counter()
+        self.deadline = self.t_start + time_budget_s
+        self.step_cost_s: Optional[float] = None
+        self.known_step_cost_s: Optional[float] = None
+        self.later_steps: List[Tuple[int, Optional[float]]] = []
+        self.n_steps_run = 0
+        self._call_steps = 0
+        self._call_t0 = self.t_start
+        self._call_t_last = self.t_start
+
+    def remaining_s(self) -> float:
+        return self.deadline - time.perf_counter()
+
+    def exhausted(self) -> bool:
+        step_cost_s = self.step_cost_s if self.known_step_cost_s is None else self.known_step_cost_s
+        return step_cost_s is not None and self.remaining_s() < step_cost_s
+
+    def begin_call(self):
+        if self.known_step_cost_s is not None:
+            self.step_cost_s, self.known_step_cost_s = self.known_step_cost_s, None
+        self._call_steps = 0
+        self._call_t0 = time.perf_counter()
+
+    @property
+    def call_step_cost_s(self) -> Optional[float]:
+        """
+        Mean cost of the steps of the current (or last) sample call.
+        """
+        return (self._call_t_last - self._call_t0) / self._call_steps if self._call_steps else None
+
+    def step_done(self, device: torch.device):
+        if device.type == 'cuda':
+            torch.cuda.synchronize(device)      # Otherwise, the step is not done but only launched.
+        self._call_t_last = time.perf_counter()
+        self._call_steps += 1
+        self.n_steps_run += 1
+        if self.step_cost_s is None or self._call_steps >= self.n_calibration_steps:
+            self.step_cost_s = self.call_step_cost_s
+
+    def select_steps(self, steps: List[int], started: bool, n_steps_later: int = 0) -> List[int]:
+        """
+        Steps to run among the remaining steps of a schedule.
+        started: whether steps of this schedule were already run || n_steps_later: planned steps of the later schedules of this call.
+        """
+        if self.step_cost_s is None or not steps:
+            return steps
+        work_s = (len(steps) + n_steps_later) * self.step_cost_s \
+                 + sum(n * (self.step_cost_s if cost_s is None else cost_s) for n, cost_s in self.later_steps)
+        remaining_s = max(self.remaining_s(), 0.)
+        if remaining_s >= work_s:
+            return steps
+        r = len(steps)
+        n_keep = int(math.floor(r * remaining_s / work_s + 0.5))
+        if n_keep >= r:
+            return steps
+        elif n_keep <= 0:
+            return []
+        elif started or n_keep == 1:
+            return [steps[int(math.floor((j+1) * r / n_keep + 0.5)) - 1] for j in range(n_keep)]
+        else:
+            return [steps[int(math.floor(j * (r-1) / (n_keep-1) + 0.5))] for j in range(n_keep)]
+
+    def stats(self) -> Dict[str, Any]:
+        return {'time_budget_s': self.time_budget_s, 'elapsed_s': time.perf_counter() - self.t_start,
+                'n_steps_run': self.n_steps_run, 'step_cost_s': self.step_cost_s}
 
 
 class ScoreModelBase(torch.nn.Module):
@@ -24,9 +305,11 @@ class ScoreModelBase(torch.nn.Module):
     ang_mult: float
     q_indices: torch.Tensor
     q_factor: torch.Tensor
+    max_cached_sampling_plans: int = 8
 
     def __init__(self, *args, **kwargs):
         super().__init__()
+        self._sampling_plans: Dict[tuple, SamplingPlan] = OrderedDict()     # See get_sampling_plan
 
         self.register_buffer('q_indices', torch.tensor([[1,2,3], [0,3,2], [3,0,1], [2,1,0]], dtype=torch.long), persistent=False)
         self.register_buffer('q_factor', torch.tensor([[-0.5, -0.5, -0.5], [0.5, -0.5, 0.5], [0.5, 0.5, -0.5], [-0.5, 0.5, 0.5]]), persistent=False)
@@ -106,6 +389,109 @@ class ScoreModelBase(torch.nn.Module):
 
         return loss, fp_info, tensor_info, statistics
 
+    def get_sampling_plan(self, diffusion_schedules: List[Union[List[float], Tuple[float, float]]],
+                          N_steps: List[int], 
+                          timesteps: List[float],
+                          temperatures: Union[Union[int, float], Sequence[Union[int, float]]] = 1.0,
+                          log_t_schedule: bool = True,
+                          time_exponent_temp: float = 0.5,
+                          time_exponent_alpha: float = 0.5,
+                          device: Union[str, torch.device] = 'cpu',
+                          dtype: torch.dtype = torch.float32) -> SamplingPlan:
+        """
+        Returns the SamplingPlan of the diffusion configs (see sample).
+        Plans are cached, so the same configs reuse the plan built by the first call. 
+        The cache is invalidated if the time encoder of the score head is modified (e.g., by an optimizer step or load_state_dict).
+        """
+        if isinstance(temperatures, (int, float)):
+            temperatures = [float(temperatures) for _ in range(len(diffusion_schedules))]
+        device = torch.device(device)
+        key = (tuple(tuple(float(t) for t in schedule) for schedule in diffusion_schedules), 
+               tuple(int(N) for N in N_steps), 
+               tuple(float(dt) for dt in timesteps), 
+               tuple(float(temp) for temp in temperatures), 
+               bool(log_t_schedule), float(time_exponent_temp), float(time_exponent_alpha), 
+               str(device), dtype, 
+               tuple((id(param), param._version) for name, param in self.score_head.named_parameters() if 'time_mlp' in name))
+        plan = self._sampling_plans.get(key, None)
+        if plan is None:
+            plan = self._build_sampling_plan(diffusion_schedules=diffusion_schedules, N_steps=N_steps, timesteps=timesteps, temperatures=temperatures, 
+                                             log_t_schedule=log_t_schedule, time_exponent_temp=time_exponent_temp, time_exponent_alpha=time_exponent_alpha,
+                                             device=device, dtype=dtype)
+            self._sampling_plans[key] = plan
+            while len(self._sampling_plans) > self.max_cached_sampling_plans:
+                try:
+                    self._sampling_plans.popitem(last=False)
+                except KeyError:     # Emptied by another thread sampling with this model
+                    break
+        else:
+            try:
+                self._sampling_plans.move_to_end(key)
+            except KeyError:         # Evicted by another thread in the meantime
+                pass
+        return plan
+
+    def _build_sampling_plan(self, diffusion_schedules: List[Union[List[float], Tuple[float, float]]],
+                             N_steps: List[int], 
+                             timesteps: List[float],
+                             temperatures: List[float],
+                             log_t_schedule: bool,
+                             time_exponent_temp: float,
+                             time_exponent_alpha: float,
+                             device: torch.device,
+                             dtype: torch.dtype) -> SamplingPlan:
+        """
+        alpha = timestep * L^2 * (t^time_exponent_alpha)
+        T = temperature * (t^time_exponent_temp)
+        """
+        temperatures_tensor = torch.tensor(temperatures, device=device, dtype=torch.float64)
+        schedules_tensor = torch.tensor(diffusion_schedules, device=device, dtype=torch.float64)
+
+        t_list, temperature_list, alpha_ang_list, alpha_lin_list = [], [], [], []
+        stage_offsets = [0]
+        for n, schedule in enumerate(schedules_tensor):
+            if log_t_schedule:
+                t_schedule = torch.logspace(
+                    start=torch.log(schedule[0]), 
+                    end=torch.log(schedule[1]), 
+                    steps=N_steps[n], 
+                    base=torch.e, 
+                    device=device, 
+                    dtype=torch.float64,
+                ).unsqueeze(-1)
+            else:
+                t_schedule = torch.linspace(
+                    start=schedule[0], 
+                    end=schedule[1], 
+                    steps=N_steps[n], 
+                    device=device, 
+                    dtype=torch.float64
+                ).unsqueeze(-1)
+            
+            # Scalars are computed step by step, exactly as they used to be computed inside the sampling loop.
+            for t in t_schedule:
+                t_list.append(t)
+                temperature_list.append(temperatures_tensor[n] * torch.pow(t,time_exponent_temp))
+                alpha_ang_list.append((self.ang_mult **2) * torch.pow(t,time_exponent_alpha) * timesteps[n])
+                alpha_lin_list.append((self.lin_mult **2) * torch.pow(t,time_exponent_alpha) * timesteps[n])
+            stage_offsets.append(stage_offsets[-1] + len(t_schedule))
+
+        t = torch.stack(t_list, dim=0)                                          # (nSteps, 1)
+        with torch.no_grad():
+            time_emb = self.score_head.compute_time_embedding(t.squeeze(-1).type(dtype))   # (nSteps, time_emb_D)
+        return SamplingPlan(t=t, 
+                            temperature=torch.stack(temperature_list, dim=0), 
+                            alpha_ang=torch.stack(alpha_ang_list, dim=0), 
+                            alpha_lin=torch.stack(alpha_lin_list, dim=0),
+                            ang_score_denom=self.ang_mult * torch.sqrt(t),
+                            lin_score_denom=self.lin_mult * torch.sqrt(t),
+                            step_idx=torch.arange(len(t), device=device),
+                            time_emb=time_emb,
+                            stage_offsets=stage_offsets,
+                            diffusion_schedules=[(float(schedule[0]), float(schedule[1])) for schedule in diffusion_schedules],
+                            temperature_bases=[float(temp) for temp in temperatures],
+                            t_values=t.squeeze(-1).tolist())
+
     @torch.jit.export
     def sample(self, T_seed: torch.Tensor,
                scene_pcd_multiscale: List[FeaturedPoints], 
@@ -119,14 +505,34 @@ class ScoreModelBase(torch.nn.Module):
                log_t_schedule: bool = True,
                time_exponent_temp: float = 0.5, # Theoretically, this should be zero.
                time_exponent_alpha: float = 0.5, # Most commonly used exponent in image generation is 1.0, but it is too slow in our case.
-               ) -> torch.Tensor:
+               neighbor_skin: Optional[float] = None,  # If set, reuse radius graphs across steps with Verlet neighbor lists of this skin margin.
+               max_edges: Optional[int] = None,        # If set, split the poses into chunks of at most this many graph edges per score evaluation.
+               max_bytes: Optional[int] = None,        # If set, split the poses into chunks whose edge tensors fit in this many bytes.
+               convergence_tol: Optional[float] = None,  # If set, a pose whose mean (dimensionless) drift over the last convergence_window steps falls below this is frozen until the next schedule.
+               convergence_window: int = 5,
+               integrator: Union[str, SE3Integrator] = 'euler_maruyama',   # See INTEGRATORS
+               retention: str = 'full',                # Poses to keep from the trajectory, see TrajectoryBuffer
+               retain_every: int = 1,                  # Step interval of the 'every_k' retention
+               progress_callback: Optional[Callable[[Dict[str, Any]], None]] = None,  # Called after every step with the progress (see below)
+               should_stop: Optional[Callable[[], bool]] = None,   # Checked before every step, SamplingCancelled is raised if it returns True
+               time_budget: Optional[TimeBudget] = None,           # If set, steps are skipped to fit in the wall-clock budget, see TimeBudget
+               return_info: bool = False,
+               ) -> Union[torch.Tensor, Tuple[torch.Tensor, Dict]]:
         """
         alpha = timestep * L^2 * (t^time_exponent_alpha)
         T = temperature * (t^time_exponent_temp)
-        """
+        The step sizes, temperatures and time embeddings of the schedule are tabulated once in a cached SamplingPlan (see get_sampling_plan).
 
-        if isinstance(temperatures, (int, float)):
-            temperatures = [float(temperatures) for _ in range(len(diffusion_schedules))]
+        progress_callback receives a dict with 
+            stage: index of the current diffusion schedule
+            step: number of steps done so far || n_steps: total number of steps of the plan
+            t: diffusion time of the step that was done || n_active: number of poses that are not frozen by convergence
+        No device synchronization is made for the report.
+
+        Returns:
+            Ts: (nFrames, nT, 7), the poses retained from the trajectory. Ts[-1] is the final poses.
+        """
+        assert convergence_window >= 1, f"{convergence_window}"
         
         # ---------------------------------------------------------------------------- #
         # Convert Data Type
@@ -134,74 +540,286 @@ class ScoreModelBase(torch.nn.Module):
         device = T_seed.device
         dtype = T_seed.dtype
         T = T_seed.clone().detach().type(torch.float64)
-        temperatures = torch.tensor(temperatures, device=device, dtype=torch.float64)
-        diffusion_schedules = torch.tensor(diffusion_schedules, device=device, dtype=torch.float64)
-        
+        plan = self.get_sampling_plan(diffusion_schedules=diffusion_schedules, N_steps=N_steps, timesteps=timesteps, temperatures=temperatures,
+                                      log_t_schedule=log_t_schedule, time_exponent_temp=time_exponent_temp, time_exponent_alpha=time_exponent_alpha,
+                                      device=device, dtype=dtype)
+
+        integrator = get_integrator(integrator)
+        with torch.no_grad():
+            key_field = self.score_head.prepare_key_field(scene_pcd_multiscale)     # Scene is fixed during sampling
+        if neighbor_skin is None:
+            neighbor_lists = None
+        else:
+            neighbor_lists = [None if r is None else VerletNeighborList(r_cluster=r, skin=neighbor_skin) 
+                              for r in self.score_head.key_tensor_field.r_cluster_multiscale]
+
+        n_score_evals = 0
+        score_buffers = (grasp_pcd.f.new_empty(len(T), 3), grasp_pcd.f.new_empty(len(T), 3))   # Kept across the steps. Active poses are a prefix of them.
+        def score_fn(T_query: torch.Tensor, step: int) -> Tuple[torch.Tensor, torch.Tensor]:
+            nonlocal n_score_evals
+            with torch.no_grad():
+                Ts_query = T_query.view(-1,7).type(dtype)
+                if neighbor_lists is None:
+                    candidate_edges = None
+                else:
+                    candidate_edges = self._update_neighbor_lists(neighbor_lists=neighbor_lists, 
+                                                                  key_field=key_field, 
+                                                                  query_pcd=grasp_pcd, 
+                                                                  Ts=Ts_query)
+                # Wigner D blocks of the poses, built once and shared by every chunk of the evaluation. 
+                # Energy-based heads build their own from the poses they differentiate with respect to.
+                wigner_kwargs = {} if isinstance(self.score_head, EbmScoreModelHead) else {'Ds': self.score_head.compute_wigner_Ds(Ts_query)}
+                (ang_score_dimless, lin_score_dimless) = self.score_head(Ts=Ts_query, 
+                                                                        key_pcd_multiscale=scene_pcd_multiscale,
+                                                                        query_pcd=grasp_pcd,
+                                                                        key_field=key_field,
+                                                                        candidate_edges=candidate_edges,
+                                                                        max_edges=max_edges,
+                                                                        max_bytes=max_bytes,
+                                                                        time_emb=plan.time_emb,
+                                                                        time_emb_idx=plan.step_idx[step:step+1],   # Shared by every pose
+                                                                        out=(score_buffers[0][:len(Ts_query)], score_buffers[1][:len(Ts_query)]),
+                                                                        **wigner_kwargs)
+            n_score_evals += 1
+            ang_score = ang_score_dimless.type(torch.float64) / plan.ang_score_denom[step]
+            lin_score = lin_score_dimless.type(torch.float64) / plan.lin_score_denom[step]
+            return ang_score, lin_score
+
+        def on_active_change(active_idx: Optional[torch.Tensor], keep_idx: Optional[torch.Tensor]):
+            if neighbor_lists is not None and keep_idx is not None:
+                nQ = len(grasp_pcd.x)
+                dst_idx = (keep_idx.unsqueeze(-1) * nQ + torch.arange(nQ, device=device)).view(-1)
+                for neighbor_list in neighbor_lists:
+                    if neighbor_list is not None:
+                        neighbor_list.select_dst(dst_idx)
 
         # ---------------------------------------------------------------------------- #
         # Begin Loop
         # ---------------------------------------------------------------------------- #
-        Ts = [T.clone().detach()]
-        steps = 0
-        for n, schedule in enumerate(diffusion_schedules):
-            temperature_base = temperatures[n]
-            if log_t_schedule:
-                t_schedule = torch.logspace(
-                    start=torch.log(schedule[0]), 
-                    end=torch.log(schedule[1]), 
-                    steps=N_steps[n], 
-                    base=torch.e, 
-                    device=device, 
-                    dtype=torch.float64,
-                ).unsqueeze(-1)
-            else:
-                t_schedule = torch.linspace(
-                    start=schedule[0], 
-                    end=schedule[1], 
-                    steps=N_steps[n], 
-                    device=device, 
-                    dtype=torch.float64
-                ).unsqueeze(-1)
+        trajectory = TrajectoryBuffer(T0=T, retention=retention, n_steps=len(plan.t), n_stages=len(plan.diffusion_schedules), retain_every=retain_every)
+        T, steps, n_steps_per_pose = self._denoise_loop(T=T, plan=plan, score_fn=score_fn, integrator=integrator, trajectory=trajectory,
+                                                        convergence_tol=convergence_tol, convergence_window=convergence_window, 
+                                                        progress_callback=progress_callback, should_stop=should_stop, time_budget=time_budget,
+                                                        on_active_change=on_active_change)
+        Ts = trajectory.finalize(T=T)
+
+        if not return_info:
+            return Ts
+        info = {'n_steps': steps, 'n_steps_per_pose': n_steps_per_pose, 'n_score_evals': n_score_evals}
+        if neighbor_lists is not None:
+            info['n_neighbor_list_rebuilds'] = [None if neighbor_list is None else neighbor_list.n_rebuilds for neighbor_list in neighbor_lists]
+        return Ts, info
+    
+    def sample_batched(self, T_seeds_list: List[torch.Tensor],
+                       scene_pcd_multiscale_list: List[List[FeaturedPoints]],
+                       grasp_pcd_list: List[FeaturedPoints],
+                       diffusion_schedules: List[
+                                                Union[List[float], Tuple[float, float]]
+                                            ],
+                       N_steps: List[int], 
+                       timesteps: List[float],
+                       temperatures: Union[Union[int, float], Sequence[Union[int, float]]] = 1.0,
+                       log_t_schedule: bool = True,
+                       time_exponent_temp: float = 0.5,
+                       time_exponent_alpha: float = 0.5,
+                       convergence_tol: Optional[float] = None,
+                       convergence_window: int = 5,
+                       integrator: Union[str, SE3Integrator] = 'euler_maruyama',
+                       retention: str = 'full',
+                       retain_every: int = 1,
+                       progress_callback: Optional[Callable[[Dict[str, Any]], None]] = None,
+                       should_stop: Optional[Callable[[], bool]] = None,
+                       time_budget: Optional[TimeBudget] = None,
+                       return_info: bool = False,
+                       ) -> Union[List[torch.Tensor], Tuple[List[torch.Tensor], Dict]]:
+        """
+        Denoise the poses of several scenes together, with a single score evaluation per step for all the scenes.
+        The key points of the scenes are packed with the scene index as the batch index, 
+        so that the radius graph of the query points of a scene only reaches the key points of the same scene.
+        Each scene may have its own grasp and number of poses. The other arguments are the same as in sample and shared by all the scenes.
+        Neighbor lists and pose chunking (neighbor_skin, max_edges, max_bytes) are not available here, use sample for those.
+        If the score head has no multi-scene forward (e.g., energy-based heads), the scenes are sampled one after another.
+
+        Returns:
+            Ts_list: Ts (nFrames, nT_i, 7) of each scene, see sample.
+            info: n_steps, n_score_evals (shared by the scenes), n_steps_per_pose (list of (nT_i,)), n_scenes
+        """
+        assert convergence_window >= 1, f"{convergence_window}"
+        n_scenes = len(T_seeds_list)
+        assert len(scene_pcd_multiscale_list) == n_scenes, f"{len(scene_pcd_multiscale_list)} != {n_scenes}"
+        assert len(grasp_pcd_list) == n_scenes, f"{len(grasp_pcd_list)} != {n_scenes}"
+
+        if not hasattr(self.score_head, 'forward_multiscene'):
+            outputs = [self.sample(T_seed=T_seed, scene_pcd_multiscale=scene_pcd_multiscale, grasp_pcd=grasp_pcd, 
+                                   diffusion_schedules=diffusion_schedules, N_steps=N_steps, timesteps=timesteps, temperatures=temperatures,
+                                   log_t_schedule=log_t_schedule, time_exponent_temp=time_exponent_temp, time_exponent_alpha=time_exponent_alpha,
+                                   convergence_tol=convergence_tol, convergence_window=convergence_window, integrator=integrator,
+                                   retention=retention, retain_every=retain_every, progress_callback=progress_callback, should_stop=should_stop, 
+                                   time_budget=time_budget, return_info=True)
+                       for T_seed, scene_pcd_multiscale, grasp_pcd in zip(T_seeds_list, scene_pcd_multiscale_list, grasp_pcd_list)]
+            Ts_list = [Ts for Ts, _ in outputs]
+            if not return_info:
+                return Ts_list
+            return Ts_list, {'n_steps': sum(info['n_steps'] for _, info in outputs), 
+                             'n_steps_per_pose': [info['n_steps_per_pose'] for _, info in outputs],
+                             'n_score_evals': sum(info['n_score_evals'] for _, info in outputs),
+                             'n_scenes': n_scenes}
 
-            print(f"{self.__class__.__name__}: sampling with (temp_base: {temperature_base} || t_schedule: {schedule.detach().cpu().numpy()})")
-            for i in tqdm(range(len(t_schedule))):
-                t = t_schedule[i]
-                temperature = temperature_base * torch.pow(t,time_exponent_temp)
-                alpha_ang = (self.ang_mult **2) * torch.pow(t,time_exponent_alpha) * timesteps[n]
-                alpha_lin = (self.lin_mult **2) * torch.pow(t,time_exponent_alpha) * timesteps[n]
-
-                with torch.no_grad():
-                    (ang_score_dimless, lin_score_dimless) = self.score_head(Ts=T.view(-1,7).type(dtype), 
-                                                                            key_pcd_multiscale=scene_pcd_multiscale,
-                                                                            query_pcd=grasp_pcd,
-                                                                            time = t.repeat(len(T)).type(dtype))
-                ang_score = ang_score_dimless.type(torch.float64) / (self.ang_mult * torch.sqrt(t))
-                lin_score = lin_score_dimless.type(torch.float64) / (self.lin_mult * torch.sqrt(t))
-
-                ang_noise = torch.sqrt(temperature*alpha_ang) * torch.randn_like(ang_score, dtype=torch.float64) 
-                lin_noise = torch.sqrt(temperature*alpha_lin) * torch.randn_like(lin_score, dtype=torch.float64)
-
-                ang_disp = (alpha_ang/2) * ang_score + ang_noise
-                lin_disp = (alpha_lin/2) * lin_score + lin_noise
-
-
-                L = T.detach()[...,self.q_indices] * (self.q_factor.type(torch.float64))
-                q, x = T[...,:4], T[...,4:]
-                dq = torch.einsum('...ij,...j->...i', L, ang_disp)
-                dx = transforms.quaternion_apply(q, lin_disp)
-                q = transforms.normalize_quaternion(q + dq)
-                T = torch.cat([q, x+dx], dim=-1)
-
-                # dT = transforms.se3_exp_map(torch.cat([lin_disp, ang_disp], dim=-1))
-                # dT = torch.cat([transforms.matrix_to_quaternion(dT[..., :3, :3]), dT[..., :3, 3]], dim=-1)
-                # T = transforms.multiply_se3(T, dT)
-                steps += 1
-                Ts.append(T.clone().detach())
+        # ---------------------------------------------------------------------------- #
+        # Pack Scenes
+        # ---------------------------------------------------------------------------- #
+        pose_counts: List[int] = [len(T_seed) for T_seed in T_seeds_list]
+        T_seed = torch.cat(T_seeds_list, dim=0)
+        device = T_seed.device
+        dtype = T_seed.dtype
+        T = T_seed.clone().detach().type(torch.float64)
+        scene_of_pose = torch.repeat_interleave(torch.arange(n_scenes, device=device), torch.tensor(pose_counts, device=device))   # (nT,)
+        plan = self.get_sampling_plan(diffusion_schedules=diffusion_schedules, N_steps=N_steps, timesteps=timesteps, temperatures=temperatures,
+                                      log_t_schedule=log_t_schedule, time_exponent_temp=time_exponent_temp, time_exponent_alpha=time_exponent_alpha,
+                                      device=device, dtype=dtype)
+
+        integrator = get_integrator(integrator)
+        key_pcd_multiscale: List[FeaturedPoints] = [pack_featured_points([scene_pcd_multiscale[n] for scene_pcd_multiscale in scene_pcd_multiscale_list]) 
+                                                    for n in range(len(scene_pcd_multiscale_list[0]))]
+        with torch.no_grad():
+            key_field = self.score_head.prepare_key_field(key_pcd_multiscale)     # Scenes are fixed during sampling
+
+        active_pose_counts: List[int] = pose_counts
+        def on_active_change(active_idx: Optional[torch.Tensor], keep_idx: Optional[torch.Tensor]):
+            nonlocal active_pose_counts
+            if active_idx is None:
+                active_pose_counts = pose_counts
+            else:           # Active poses stay grouped by scene, as active_idx is sorted.
+                active_pose_counts = torch.bincount(scene_of_pose.index_select(0, active_idx), minlength=n_scenes).tolist()
+
+        n_score_evals = 0
+        def score_fn(T_query: torch.Tensor, step: int) -> Tuple[torch.Tensor, torch.Tensor]:
+            nonlocal n_score_evals
+            with torch.no_grad():
+                (ang_score_dimless, lin_score_dimless) = self.score_head.forward_multiscene(Ts=T_query.view(-1,7).type(dtype), 
+                                                                                           key_pcd_multiscale=key_pcd_multiscale,
+                                                                                           query_pcd_list=grasp_pcd_list,
+                                                                                           pose_counts=active_pose_counts,
+                                                                                           key_field=key_field,
+                                                                                           time_emb=plan.time_emb,
+                                                                                           time_emb_idx=plan.step_idx[step:step+1])   # Shared by every pose
+            n_score_evals += 1
+            ang_score = ang_score_dimless.type(torch.float64) / plan.ang_score_denom[step]
+            lin_score = lin_score_dimless.type(torch.float64) / plan.lin_score_denom[step]
+            return ang_score, lin_score
 
-        Ts.append(T.clone().detach())
-        Ts = torch.stack(Ts, dim=0).detach()
+        # ---------------------------------------------------------------------------- #
+        # Begin Loop
+        # ---------------------------------------------------------------------------- #
+        trajectory = TrajectoryBuffer(T0=T, retention=retention, n_steps=len(plan.t), n_stages=len(plan.diffusion_schedules), retain_every=retain_every)
+        T, steps, n_steps_per_pose = self._denoise_loop(T=T, plan=plan, score_fn=score_fn, integrator=integrator, trajectory=trajectory,
+                                                        convergence_tol=convergence_tol, convergence_window=convergence_window, 
+                                                        progress_callback=progress_callback, should_stop=should_stop, time_budget=time_budget,
+                                                        on_active_change=on_active_change)
+        Ts_list = list(trajectory.finalize(T=T).split(pose_counts, dim=-2))
+
+        if not return_info:
+            return Ts_list
+        info = {'n_steps': steps, 'n_steps_per_pose': list(n_steps_per_pose.split(pose_counts, dim=0)), 'n_score_evals': n_score_evals, 'n_scenes': n_scenes}
+        return Ts_list, info
+
+    def _denoise_loop(self, T: torch.Tensor, 
+                      plan: SamplingPlan,
+                      score_fn: ScoreFn,
+                      integrator: SE3Integrator,
+                      trajectory: TrajectoryBuffer,
+                      convergence_tol: Optional[float] = None,
+                      convergence_window: int = 5,
+                      progress_callback: Optional[Callable[[Dict[str, Any]], None]] = None,
+                      should_stop: Optional[Callable[[], bool]] = None,
+                      time_budget: Optional[TimeBudget] = None,
+                      on_active_change: Optional[Callable[[Optional[torch.Tensor], Optional[torch.Tensor]], None]] = None,
+                      ) -> Tuple[torch.Tensor, int, torch.Tensor]:
+        """
+        Reverse diffusion loop of sample and sample_batched.
+        on_active_change(active_idx, keep_idx) is called whenever the set of active (not frozen) poses changes: 
+            at the beginning of each schedule (keep_idx=None, active_idx=None if convergence_tol is None), 
+            and when poses converge (keep_idx: indices of the remaining poses among the previously active ones).
+        If time_budget is set, steps are skipped to fit in it (see TimeBudget).
+
+        Returns:
+            T: (nT, 7), the final poses || steps: number of steps done || n_steps_per_pose: (nT,)
+        """
+        device = T.device
+        if time_budget is not None:
+            time_budget.begin_call()
+        steps = 0
+        n_steps_per_pose = torch.zeros(len(T), device=device, dtype=torch.long)
+        for n in range(len(plan.diffusion_schedules)):
+            stage_start, stage_end = plan.stage_offsets[n], plan.stage_offsets[n+1]
 
-        return Ts
+            if convergence_tol is None:
+                active_idx: Optional[torch.Tensor] = None
+            else:
+                active_idx = torch.arange(len(T), device=device)          # Every pose is active again at the beginning of each schedule
+                drift_history = T.new_zeros(len(T), 0)                     # (nActive, nHistory)
+            if on_active_change is not None:
+                on_active_change(active_idx, None)
+            stage_steps: List[int] = list(range(stage_start, stage_end))
+            if time_budget is not None:
+                stage_steps = time_budget.select_steps(stage_steps, started=False, n_steps_later=plan.stage_offsets[-1] - stage_end)
+            i = 0
+            while i < len(stage_steps):
+                k = stage_steps[i]
+                if active_idx is not None and len(active_idx) == 0:
+                    break
+                if should_stop is not None and should_stop():
+                    raise SamplingCancelled(f"Sampling stopped after {steps} of {len(plan.t_values)} steps.")
+                T_active = T if active_idx is None else T.index_select(0, active_idx)
+
+                T_active, ang_drift, lin_drift = integrator.step(score_fn=score_fn, T=T_active, 
+                                                                 step=k, next_step=stage_steps[i+1] if i+1 < len(stage_steps) else k, 
+                                                                 alpha_ang=plan.alpha_ang[k], alpha_lin=plan.alpha_lin[k], 
+                                                                 temperature=plan.temperature[k])
+                steps += 1
+                if active_idx is None:
+                    T = T_active
+                    n_steps_per_pose += 1
+                else:
+                    T = T.index_copy(0, active_idx, T_active)              # Converged poses stay frozen
+                    n_steps_per_pose[active_idx] += 1
+
+                    # Dimensionless norm of the score-driven (noise-free) displacement, averaged over the last convergence_window steps.
+                    drift = torch.sqrt(ang_drift.square().sum(dim=-1) / (self.ang_mult ** 2) 
+                                       + lin_drift.square().sum(dim=-1) / (self.lin_mult ** 2))      # (nActive,)
+                    drift_history = torch.cat([drift_history, drift.unsqueeze(-1)], dim=-1)[..., -convergence_window:]
+                    if drift_history.shape[-1] >= convergence_window:
+                        keep_idx = (drift_history.mean(dim=-1) >= convergence_tol).nonzero().squeeze(-1)
+                        if len(keep_idx) < len(active_idx):
+                            active_idx, drift_history = active_idx.index_select(0, keep_idx), drift_history.index_select(0, keep_idx)
+                            if on_active_change is not None:
+                                on_active_change(active_idx, keep_idx)
+                trajectory.step_done(step=k, T=T)
+                if progress_callback is not None:
+                    progress_callback({'stage': n, 'step': steps, 'n_steps': len(plan.t_values), 't': plan.t_values[k], 
+                                       'n_active': len(T) if active_idx is None else len(active_idx)})
+                if time_budget is not None:
+                    time_budget.step_done(device=device)
+                    stage_steps = stage_steps[:i+1] + time_budget.select_steps(stage_steps[i+1:], started=True, n_steps_later=plan.stage_offsets[-1] - stage_end)
+                i += 1
+            trajectory.stage_done(T=T)
+        return T, steps, n_steps_per_pose
+
+    def _update_neighbor_lists(self, neighbor_lists: List[Optional[VerletNeighborList]],
+                               key_field: PreparedKeyField,
+                               query_pcd: FeaturedPoints,
+                               Ts: torch.Tensor) -> List[Optional[GraphEdge]]:
+        query_x = transforms.quaternion_apply(Ts[..., None, :4], query_pcd.x) + Ts[..., None, 4:]    # (nT, nQ, 3)
+        query_points = FeaturedPoints(x=query_x.reshape(-1,3), 
+                                      f=query_x.new_empty(query_x.shape[0] * query_x.shape[1], 0), 
+                                      b=query_pcd.b.expand(len(Ts), -1).reshape(-1))                   # (nT*nQ, 3), (nT*nQ, 0), (nT*nQ,)
+        candidate_edges: List[Optional[GraphEdge]] = []
+        for neighbor_list, key_points, key_index in zip(neighbor_lists, key_field.points_multiscale, key_field.spatial_indices):
+            if neighbor_list is None:
+                candidate_edges.append(None)
+            else:
+                candidate_edges.append(neighbor_list.update(src=key_points, dst=query_points, src_index=key_index))
+        return candidate_edges
 
     def forward(self, Ts: torch.Tensor, 
                 time: torch.Tensor, 
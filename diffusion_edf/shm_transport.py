@@ -0,0 +1,235 @@
+"""
+Transport of point clouds and poses between the agent server and clients on the same host through named POSIX shared-memory segments.
+The tensors are written once into a segment, and only a small descriptor (a dict of builtins) goes over Pyro.
+The process that creates a segment owns it and unlinks it when its reference count drops to zero (see SharedSegmentStore).
+Readers attach to the segment by name and get tensors that are views of the shared memory (see SharedTensors).
+"""
+from typing import List, Optional, Any, Dict, Tuple
+from multiprocessing import shared_memory
+import secrets
+import threading
+import time
+import warnings
+
+import numpy as np
+import torch
+
+from edf_interface.data import SE3, PointCloud
+
+
+ALIGNMENT = 64     # Byte alignment of each tensor in a segment
+_created_names = set()   # Segments created by this process
+
+
+def _attach(name: str) -> shared_memory.SharedMemory:
+    """
+    Attaches to a segment of another process.
+    Python's resource tracker unlinks every segment a process has attached to when the process exits (and warns about them),
+    so the segment is untracked: it belongs to the process that created it.
+    """
+    try:
+        return shared_memory.SharedMemory(name=name, create=False, track=False)   # Python >= 3.13
+    except TypeError:
+        pass
+    shm = shared_memory.SharedMemory(name=name, create=False)
+    if name in _created_names:    # Same process: the registration is the creator's
+        return shm
+    try:
+        from multiprocessing import resource_tracker
+        resource_tracker.unregister(shm._name, 'shared_memory')
+    except Exception:
+        pass
+    return shm
+
+
+def write_tensors(tensors: Dict[str, torch.Tensor]) -> Tuple[shared_memory.SharedMemory, Dict[str, Any]]:
+    """
+    Copies the tensors into a new shared-memory segment.
+    Returns the segment (which the caller owns and must unlink) and its descriptor:
+        {'name': segment name, 'tensors': {key: {'dtype': numpy dtype string, 'shape': [...], 'offset': bytes}}}
+    """
+    arrays = {key: tensor.detach().cpu().contiguous().numpy() for key, tensor in tensors.items()}
+    layout: Dict[str, Dict[str, Any]] = {}
+    size = 0
+    for key, array in arrays.items():
+        layout[key] = {'dtype': array.dtype.str, 'shape': list(array.shape), 'offset': size}
+        size += (array.nbytes + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+    shm = shared_memory.SharedMemory(name=f"edf_{secrets.token_hex(8)}", create=True, size=max(size, 1))   # Unlinked by the resource tracker if this process dies
+    _created_names.add(shm.name)
+    for key, array in arrays.items():
+        np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf, offset=layout[key]['offset'])[...] = array
+    return shm, {'name': shm.name, 'tensors': layout}
+
+
+class SharedTensors():
+    """
+    Tensors of a segment described by a descriptor of write_tensors, as zero-copy views of the shared memory.
+    The views keep the segment mapped after close() (and after the owner unlinks it) until they are garbage-collected.
+    Use copy=True to read the tensors out of the segment and close it right away.
+
+        with SharedTensors(descriptor) as tensors:
+            points = tensors['points']
+    """
+    def __init__(self, descriptor: Dict[str, Any], copy: bool = False):
+        self.shm: Optional[shared_memory.SharedMemory] = _attach(descriptor['name'])
+        tensors: Dict[str, torch.Tensor] = {}
+        for key, layout in descriptor['tensors'].items():
+            array = np.ndarray(layout['shape'], dtype=np.dtype(layout['dtype']), buffer=self.shm.buf, offset=layout['offset'])
+            tensors[key] = torch.from_numpy(array.copy() if copy else array)
+        if copy:
+            self.close()
+        self.tensors = tensors
+
+    def close(self):
+        """
+        Closes the file descriptor of the segment. Closing the SharedMemory would unmap the segment under the numpy arrays,
+        which do not pin it, so the mapping is left to the memoryview they reference and goes away with the last view.
+        """
+        if self.shm is None:
+            return
+        self.tensors = {}
+        self.shm._buf, self.shm._mmap = None, None
+        self.shm.close()
+        self.shm = None
+
+    def __enter__(self) -> Dict[str, torch.Tensor]:
+        return self.tensors
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class SharedSegmentStore():
+    """
+    Reference counts of the segments created by this process.
+    A segment is unlinked when its count drops to zero, or once it is older than max_age_s (for readers that never released it).
+    """
+    def __init__(self, max_age_s: Optional[float] = 60.):
+        self.max_age_s = max_age_s
+        self._segments: Dict[str, Tuple[shared_memory.SharedMemory, int, float]] = {}   # name -> (segment, reference count, creation time)
+        self._lock = threading.Lock()
+
+    def create(self, tensors: Dict[str, torch.Tensor], n_refs: int = 1) -> Dict[str, Any]:
+        """
+        Writes the tensors into a new segment held by n_refs references, and returns its descriptor.
+        """
+        self.sweep()
+        shm, descriptor = write_tensors(tensors)
+        with self._lock:
+            self._segments[shm.name] = (shm, n_refs, time.monotonic())
+        return descriptor
+
+    def acquire(self, name: str) -> bool:
+        with self._lock:
+            if name not in self._segments:
+                return False
+            shm, n_refs, t_created = self._segments[name]
+            self._segments[name] = (shm, n_refs + 1, t_created)
+            return True
+
+    def release(self, name: str) -> bool:
+        """
+        Drops a reference to the segment, and unlinks it if it was the last one. Returns False if there is no such segment.
+        """
+        with self._lock:
+            if name not in self._segments:
+                return False
+            shm, n_refs, t_created = self._segments[name]
+            if n_refs > 1:
+                self._segments[name] = (shm, n_refs - 1, t_created)
+                return True
+            del self._segments[name]
+        self._unlink(shm)
+        return True
+
+    def sweep(self):
+        if self.max_age_s is None:
+            return
+        now = time.monotonic()
+        with self._lock:
+            expired = [name for name, (_, _, t_created) in self._segments.items() if now - t_created > self.max_age_s]
+            expired = [self._segments.pop(name)[0] for name in expired]
+        for shm in expired:
+            self._unlink(shm)
+
+    def close(self):
+        with self._lock:
+            segments = [shm for shm, _, _ in self._segments.values()]
+            self._segments = {}
+        for shm in segments:
+            self._unlink(shm)
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._segments)
+
+    @staticmethod
+    def _unlink(shm: shared_memory.SharedMemory):
+        shm.close()     # The views of this process were only used to write the segment
+        try:
+            shm.unlink()
+        except FileNotFoundError:
+            pass
+        _created_names.discard(shm.name)
+
+
+def request_tensors(scene_pcd: PointCloud, grasp_pcd: PointCloud, current_poses: SE3) -> Dict[str, torch.Tensor]:
+    return {'scene_points': scene_pcd.points, 'scene_colors': scene_pcd.colors,
+            'grasp_points': grasp_pcd.points, 'grasp_colors': grasp_pcd.colors,
+            'poses': current_poses.poses}
+
+
+def request_from_tensors(tensors: Dict[str, torch.Tensor]) -> Tuple[PointCloud, PointCloud, SE3]:
+    return (PointCloud(points=tensors['scene_points'], colors=tensors['scene_colors']),
+            PointCloud(points=tensors['grasp_points'], colors=tensors['grasp_colors']),
+            SE3(poses=tensors['poses']))
+
+
+class SharedMemoryAgentClient():
+    """
+    Client-side wrapper of an agent server proxy (diffusion_edf/agent_server.py) that sends the point clouds and poses of
+    request_trajectories and denoise through shared memory, and receives the denoised trajectories the same way.
+    Whether the server is on the same host is probed on the first request (a server on another host cannot attach to the segments).
+    Otherwise, or if the server has the transport disabled, the requests go through the usual Pyro methods.
+    """
+    def __init__(self, proxy: Any, use_shm: Optional[bool] = None):
+        self.proxy = proxy
+        self.use_shm = use_shm        # None: probe on the first request
+        self._store = SharedSegmentStore(max_age_s=None)  # Request segments live for the duration of the call
+
+    def _shm_available(self) -> bool:
+        if self.use_shm is None:
+            descriptor = self._store.create({'probe': torch.zeros(1)})
+            try:
+                self.use_shm = bool(self.proxy.shm_probe(descriptor=descriptor))
+            except Exception as e:
+                warnings.warn(f"Shared-memory transport unavailable, falling back to Pyro serialization ({e})")
+                self.use_shm = False
+            finally:
+                self._store.release(descriptor['name'])
+        return self.use_shm
+
+    def _call_shm(self, method: str, scene_pcd: PointCloud, grasp_pcd: PointCloud, current_poses: SE3, **kwargs) -> Any:
+        descriptor = self._store.create(request_tensors(scene_pcd=scene_pcd, grasp_pcd=grasp_pcd, current_poses=current_poses))
+        try:
+            return getattr(self.proxy, method)(request=descriptor, **kwargs)
+        finally:
+            self._store.release(descriptor['name'])
+
+    def request_trajectories(self, scene_pcd: PointCloud, grasp_pcd: PointCloud, current_poses: SE3, task_name: str, **kwargs) -> Tuple[List[SE3], Dict[str, Any]]:
+        if not self._shm_available():
+            return self.proxy.request_trajectories(scene_pcd=scene_pcd, grasp_pcd=grasp_pcd, current_poses=current_poses, task_name=task_name, **kwargs)
+        return self._call_shm('request_trajectories_shm', scene_pcd=scene_pcd, grasp_pcd=grasp_pcd, current_poses=current_poses, task_name=task_name, **kwargs)
+
+    def denoise(self, scene_pcd: PointCloud, grasp_pcd: PointCloud, current_poses: SE3, task_name: str, **kwargs) -> Tuple[List[SE3], Dict[str, Any]]:
+        if not self._shm_available():
+            return self.proxy.denoise(scene_pcd=scene_pcd, grasp_pcd=grasp_pcd, current_poses=current_poses, task_name=task_name, **kwargs)
+        result, info = self._call_shm('denoise_shm', scene_pcd=scene_pcd, grasp_pcd=grasp_pcd, current_poses=current_poses, task_name=task_name, **kwargs)
+        try:
+            traj_tensors = SharedTensors(result, copy=True).tensors['trajectories']     # (nFrames, nT, 7)
+        finally:
+            self.proxy.release_shm(name=result['name'])
+        return [SE3(poses=Ts) for Ts in traj_tensors.unbind(dim=-2)], info
+
+    def close(self):
+        self._store.close()
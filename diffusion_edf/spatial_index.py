@@ -0,0 +1,175 @@
+from typing import List, Optional, Union, Tuple, NamedTuple
+import math
+
+import torch
+
+
+class SpatialIndex(NamedTuple):
+    """
+    Hashed voxel grid of a fixed point cloud. Points are sorted by their cell keys so that
+    each occupied cell is a contiguous slice [cell_start, cell_start + cell_count).
+    """
+    cell_size: float
+    origin: torch.Tensor      # (3,), minimum corner of the grid
+    grid_dims: torch.Tensor   # (3,), number of cells along each axis
+    points: torch.Tensor      # (N, 3), sorted by cell key
+    batch: torch.Tensor       # (N,), sorted by cell key
+    perm: torch.Tensor        # (N,), original index of each sorted point
+    cell_keys: torch.Tensor   # (nCell,), sorted unique keys of the occupied cells
+    cell_start: torch.Tensor  # (nCell,)
+    cell_count: torch.Tensor  # (nCell,)
+
+
+@torch.jit.script
+def _cell_keys(cell_coords: torch.Tensor, batch: torch.Tensor, grid_dims: torch.Tensor) -> torch.Tensor:
+    # cell_coords: (..., 3) || batch: (...) || grid_dims: (3,)
+    return ((batch * grid_dims[0] + cell_coords[..., 0]) * grid_dims[1] + cell_coords[..., 1]) * grid_dims[2] + cell_coords[..., 2]
+
+
+@torch.jit.script
+def build_spatial_index(points: torch.Tensor, batch: torch.Tensor, cell_size: float) -> SpatialIndex:
+    assert points.ndim == 2 and points.shape[-1] == 3, f"{points.shape}"
+    assert batch.shape == points.shape[:1], f"{batch.shape}"
+    assert cell_size > 0.
+
+    if len(points) == 0:
+        origin = torch.zeros(3, device=points.device, dtype=points.dtype)
+    else:
+        origin = points.detach().min(dim=0).values
+    cell_coords = torch.floor((points.detach() - origin) / cell_size).long()        # (N, 3)
+    if len(points) == 0:
+        grid_dims = torch.ones(3, device=points.device, dtype=torch.long)
+    else:
+        grid_dims = cell_coords.max(dim=0).values + 1                               # (3,)
+    keys = _cell_keys(cell_coords, batch, grid_dims)                                 # (N,)
+    keys, perm = torch.sort(keys, stable=True)
+    cell_keys, cell_count = torch.unique_consecutive(keys, return_counts=True)      # (nCell,), (nCell,)
+    cell_start = torch.cumsum(cell_count, dim=0) - cell_count                       # (nCell,)
+
+    return SpatialIndex(cell_size=cell_size,
+                        origin=origin,
+                        grid_dims=grid_dims,
+                        points=points.index_select(0, perm),
+                        batch=batch.index_select(0, perm),
+                        perm=perm,
+                        cell_keys=cell_keys,
+                        cell_start=cell_start,
+                        cell_count=cell_count)
+
+
+@torch.jit.script
+def _probe_cells(index: SpatialIndex,
+                 y: torch.Tensor,
+                 batch_y: torch.Tensor,
+                 r: float) -> Tuple[torch.Tensor, torch.Tensor, int]:
+    """
+    Returns:
+        found_idx: (nFound,), flattened (query, probe) index of the occupied cells around each query.
+        cell_idx: (nFound,), index of the corresponding occupied cell.
+        n_probes: number of probed cells per query.
+    """
+    device = y.device
+    n_probe = int(math.ceil(r / index.cell_size))
+    probe_range = torch.arange(-n_probe, n_probe+1, device=device)
+    probe_offsets = torch.stack(torch.meshgrid(probe_range, probe_range, probe_range, indexing='ij'), dim=-1).reshape(-1,3)  # (nProbe, 3)
+    n_probes = len(probe_offsets)
+
+    cell_coords = torch.floor((y.detach() - index.origin) / index.cell_size).long()                     # (nY, 3)
+    probe_coords = cell_coords.unsqueeze(-2) + probe_offsets                                           # (nY, nProbe, 3)
+    in_grid = ((probe_coords >= 0) & (probe_coords < index.grid_dims)).all(dim=-1)                     # (nY, nProbe)
+    probe_keys = _cell_keys(probe_coords, batch_y.unsqueeze(-1), index.grid_dims).reshape(-1)          # (nY*nProbe,)
+
+    cell_idx = torch.searchsorted(index.cell_keys, probe_keys).clamp(max=max(len(index.cell_keys)-1, 0))    # (nY*nProbe,)
+    if len(index.cell_keys) == 0:
+        found = torch.zeros_like(in_grid).reshape(-1)
+    else:
+        found = (index.cell_keys.index_select(0, cell_idx) == probe_keys) & in_grid.reshape(-1)        # (nY*nProbe,)
+    found_idx = found.nonzero().squeeze(-1)                                                            # (nFound,)
+    cell_idx = cell_idx.index_select(0, found_idx)                                                     # (nFound,)
+    return found_idx, cell_idx, n_probes
+
+
+@torch.jit.script
+def _radius_query(index: SpatialIndex,
+                  y: torch.Tensor,
+                  batch_y: torch.Tensor,
+                  r: float,
+                  max_num_neighbors: int,
+                  dst_offset: int) -> torch.Tensor:
+    device = y.device
+    found_idx, cell_idx, n_probes = _probe_cells(index=index, y=y, batch_y=batch_y, r=r)
+    counts = index.cell_count.index_select(0, cell_idx)                                                # (nFound,)
+    starts = index.cell_start.index_select(0, cell_idx)                                                # (nFound,)
+
+    # Expand each probed cell into its points
+    n_candidates = int(counts.sum())
+    candidate_dst = torch.repeat_interleave(found_idx // n_probes, counts, output_size=n_candidates)  # (nCandidate,)
+    probe_first = torch.cumsum(counts, dim=0) - counts
+    candidate_src = torch.arange(n_candidates, device=device) \
+        + torch.repeat_interleave(starts - probe_first, counts, output_size=n_candidates)             # (nCandidate,), sorted order
+
+    dist_sq = (index.points.index_select(0, candidate_src) - y.index_select(0, candidate_dst)).square().sum(dim=-1)
+    in_range_idx = (dist_sq < r*r).nonzero().squeeze(-1)
+    edge_dst = candidate_dst.index_select(0, in_range_idx)
+    edge_src = candidate_src.index_select(0, in_range_idx)
+
+    # Keep at most max_num_neighbors edges per query point. Edges are already grouped by edge_dst.
+    n_edges_per_dst = torch.bincount(edge_dst, minlength=len(y))
+    dst_first = torch.cumsum(n_edges_per_dst, dim=0) - n_edges_per_dst
+    rank = torch.arange(len(edge_dst), device=device) - dst_first.index_select(0, edge_dst)
+    if len(rank) > 0 and int(rank.max()) >= max_num_neighbors:
+        keep = (rank < max_num_neighbors).nonzero().squeeze(-1)
+        edge_dst, edge_src = edge_dst.index_select(0, keep), edge_src.index_select(0, keep)
+
+    return torch.stack([edge_dst + dst_offset, index.perm.index_select(0, edge_src)], dim=0)
+
+
+@torch.jit.script
+def radius_query(index: SpatialIndex,
+                 y: torch.Tensor,
+                 r: float,
+                 batch_y: Optional[torch.Tensor] = None,
+                 max_num_neighbors: int = 32,
+                 chunk_size: int = 4096) -> torch.Tensor:
+    """
+    Drop-in replacement of torch_cluster.radius(x, y, r, batch_x, batch_y, max_num_neighbors)
+    with x and batch_x given by the prebuilt index. The ordering of neighbors may be different.
+    Query chunks are processed in parallel on the inter-op thread pool.
+
+    Returns:
+        edge: (2, nEdge), edge[0] is the index of y and edge[1] is the index of x.
+    """
+    assert y.ndim == 2 and y.shape[-1] == 3, f"{y.shape}"
+    if batch_y is None:
+        batch_y = torch.zeros(len(y), device=y.device, dtype=torch.long)
+
+    futures: List[torch.jit.Future[torch.Tensor]] = []
+    for start in range(0, len(y), chunk_size):
+        end = min(start + chunk_size, len(y))
+        futures.append(
+            torch.jit.fork(_radius_query, index, y[start:end], batch_y[start:end], r, max_num_neighbors, start)
+        )
+    if len(futures) == 0:
+        return torch.empty(2, 0, device=y.device, dtype=torch.long)
+    return torch.cat([torch.jit.wait(future) for future in futures], dim=-1)
+
+
+@torch.jit.script
+def count_radius_candidates(index: SpatialIndex,
+                            y: torch.Tensor,
+                            r: float,
+                            batch_y: Optional[torch.Tensor] = None) -> torch.Tensor:
+    """
+    Upper bound of the number of neighbors of each query within radius r, 
+    i.e., the number of indexed points in the cells probed by radius_query. 
+    No distance is computed, so it is much cheaper than the query itself.
+
+    Returns:
+        n_candidates: (nY,)
+    """
+    assert y.ndim == 2 and y.shape[-1] == 3, f"{y.shape}"
+    if batch_y is None:
+        batch_y = torch.zeros(len(y), device=y.device, dtype=torch.long)
+    found_idx, cell_idx, n_probes = _probe_cells(index=index, y=y, batch_y=batch_y, r=r)
+    n_candidates = torch.zeros(len(y), device=y.device, dtype=torch.long)
+    return n_candidates.index_add_(0, found_idx // n_probes, index.cell_count.index_select(0, cell_idx))
@@ -20,6 +20,8 @@ from edf_interface.data import PointCloud, SE3, TargetPoseDemo, DemoSequence
 from edf_interface.data import preprocess
 from diffusion_edf.gnn_data import FeaturedPoints, merge_featured_points, pcd_to_featured_points
 from diffusion_edf.dist import diffuse_isotropic_se3_batched
+from diffusion_edf.spatial_index import SpatialIndex, radius_query
+from diffusion_edf import transforms
 
 def compose_proc_fn(preprocess_config: Dict) -> Callable:
     proc_fn = []
@@ -57,8 +59,21 @@ def get_collate_fn(task, proc_fn):
 
     return collate_fn
 
-def sample_reference_points(src_points: torch.Tensor, dst_points: torch.Tensor, r: float, n_samples: int = 1) -> Tuple[torch.Tensor, torch.Tensor]:
-    edge_dst, edge_src = radius(x=src_points, y=dst_points, r=r)
+def sample_reference_points(src_points: torch.Tensor, dst_points: torch.Tensor, r: float, n_samples: int = 1,
+                            src_index: Optional[SpatialIndex] = None,
+                            T_dst: Optional[torch.Tensor] = None) -> Tuple[torch.Tensor, torch.Tensor]:
+    """
+    If src_index (prebuilt on src_points) is given, it is probed instead of building a search structure from scratch.
+    T_dst: (7,) pose of the frame of dst_points in that of src_points, if they differ. 
+        The neighbors are counted around the transformed dst_points, and the sampled dst_points are returned untransformed.
+    """
+    query_points = dst_points
+    if T_dst is not None:
+        query_points = transforms.quaternion_apply(T_dst[:4], dst_points) + T_dst[4:]
+    if src_index is None:
+        edge_dst, edge_src = radius(x=src_points, y=query_points, r=r)
+    else:
+        edge_dst, edge_src = radius_query(index=src_index, y=query_points, r=r)
     n_points = len(dst_points)
     n_neighbor = scatter_sum(src=torch.ones_like(edge_dst), index=edge_dst, dim_size=n_points)
     total_count = n_neighbor.sum()
@@ -75,7 +90,12 @@ def transform_and_sample_reference_points(T_target: torch.Tensor,
                                           grasp_points: FeaturedPoints,
                                           contact_radius: Union[float, int],
                                           n_samples_x_ref: int,
-                                          xref_bbox: Optional[torch.Tensor] = None,) -> Tuple[torch.Tensor, torch.Tensor]:
+                                          xref_bbox: Optional[torch.Tensor] = None,
+                                          scene_index: Optional[SpatialIndex] = None) -> Tuple[torch.Tensor, torch.Tensor]:
+    """
+    scene_index: Spatial index prebuilt on scene_points.x, e.g., shared by the calls on the same scene. 
+        If given, the grasp points are transformed into the scene frame instead of the scene points into the grasp frame.
+    """
     assert T_target.ndim == 2 and T_target.shape[-1] == 7, f"{T_target.shape}" # (nT, 7)
     if len(T_target) != 1:
         raise NotImplementedError
@@ -84,6 +104,13 @@ def transform_and_sample_reference_points(T_target: torch.Tensor,
         inrange_idx = ((dst_points >= xref_bbox[:,0]) * (dst_points <= xref_bbox[:,1])).all(dim=-1).nonzero().squeeze()
         dst_points = dst_points.index_select(index=inrange_idx, dim=0)
     
+    if scene_index is not None:
+        return sample_reference_points(src_points=scene_points.x, 
+                                       dst_points=dst_points, 
+                                       r=float(contact_radius), 
+                                       n_samples=n_samples_x_ref, 
+                                       src_index=scene_index, 
+                                       T_dst=T_target[0])
     x_ref, n_neighbors = sample_reference_points(
         src_points = PointCloud(points=scene_points.x, colors=scene_points.f).transformed(
                                 SE3(T_target).inv(), squeeze=True
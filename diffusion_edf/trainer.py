@@ -12,12 +12,41 @@ from torch.utils.data import DataLoader
 
 from edf_interface.data import PointCloud, SE3, DemoDataset
 from diffusion_edf.gnn_data import FeaturedPoints
+from diffusion_edf.spatial_index import SpatialIndex, build_spatial_index
 from diffusion_edf import train_utils
 from diffusion_edf.score_model_base import ScoreModelBase
 from diffusion_edf.point_attentive_score_model import PointAttentiveScoreModel
 from diffusion_edf.multiscale_score_model import MultiscaleScoreModel
 
 
+@beartype
+def build_score_model(model_configs: Dict, 
+                      deterministic: bool = False, 
+                      device: Union[str, torch.device] = 'cpu',
+                      checkpoint_dir: Optional[str] = None,
+                      strict: bool = True) -> ScoreModelBase:
+    """
+    Build the score model of score_model_configs.yaml (model_configs) and load the checkpoint if given.
+    """
+    device = torch.device(device)
+    if model_configs['model_name'] == 'PointAttentiveScoreModel':
+        score_model =  PointAttentiveScoreModel(**model_configs['model_kwargs'], deterministic=deterministic)
+    elif model_configs['model_name'] == 'MultiscaleScoreModel':
+        score_model = MultiscaleScoreModel(**model_configs['model_kwargs'], deterministic=deterministic)
+    else:
+        raise ValueError(f"Unknown score model name: {model_configs['model_name']}")
+    
+    if checkpoint_dir is not None:
+        checkpoint = torch.load(checkpoint_dir, map_location=device)
+        score_model.load_state_dict(checkpoint['score_model_state_dict'], strict=strict)
+        # optimizer.load_state_dict(checkpoint['optimizer_state_dict'], strict=strict)
+        epoch = checkpoint['epoch']
+        steps = checkpoint['steps']
+        print(f"Successfully Loaded checkpoint @ epoch: {epoch} (steps: {steps})")
+    
+    return score_model.to(device)
+
+
 class DiffusionEdfTrainer():
     configs_root_dir: str
     train_configs_file: str
@@ -128,25 +157,11 @@ class DiffusionEdfTrainer():
                   ) -> ScoreModelBase:
         if device is None:
             device = self.device
-        else:
-            device = torch.device(device)
-
-        if self.model_configs['model_name'] == 'PointAttentiveScoreModel':
-            score_model =  PointAttentiveScoreModel(**self.model_configs['model_kwargs'], deterministic=deterministic)
-        elif self.model_configs['model_name'] == 'MultiscaleScoreModel':
-            score_model = MultiscaleScoreModel(**self.model_configs['model_kwargs'], deterministic=deterministic)
-        else:
-            raise ValueError(f"Unknown score model name: {self.model_configs['model_name']}")
-        
-        if checkpoint_dir is not None:
-            checkpoint = torch.load(checkpoint_dir)
-            score_model.load_state_dict(checkpoint['score_model_state_dict'], strict=strict)
-            # optimizer.load_state_dict(checkpoint['optimizer_state_dict'], strict=strict)
-            epoch = checkpoint['epoch']
-            steps = checkpoint['steps']
-            print(f"Successfully Loaded checkpoint @ epoch: {epoch} (steps: {steps})")
-        
-        return score_model.to(device)
+        return build_score_model(model_configs=self.model_configs, 
+                                 deterministic=deterministic, 
+                                 device=device, 
+                                 checkpoint_dir=checkpoint_dir, 
+                                 strict=strict)
             
     @beartype
     def _init_model(self, deterministic: bool = False, 
@@ -251,6 +266,7 @@ class DiffusionEdfTrainer():
                           n_samples_x_ref: int,
                           contact_radius: Optional[Union[int, float]] = None,
                           xref_bbox: Optional[torch.Tensor] = None,
+                          scene_index: Optional[SpatialIndex] = None,
                           ) -> Tuple[torch.Tensor, 
                                      torch.Tensor, 
                                      torch.Tensor,
@@ -266,6 +282,8 @@ class DiffusionEdfTrainer():
             delta_T: (nT * n_samples_x_ref, 7)
             time_in: (nT * n_samples_x_ref, )
             gt_<...>_score: (nT * n_samples_x_ref, 3)
+        scene_index: Spatial index prebuilt on scene_points.x, shared by the diffusions on the same scene 
+            (see train_utils.transform_and_sample_reference_points).
         """
         assert T_init.ndim == 2 and T_init.shape[-1] == 7, f"T_init.shape must be (N_poses, 7), but {T_init.shape} is given."
         nT = len(T_init)
@@ -292,7 +310,8 @@ class DiffusionEdfTrainer():
             grasp_points=grasp_points,
             contact_radius=contact_radius,
             n_samples_x_ref=n_samples_x_ref,
-            xref_bbox=xref_bbox
+            xref_bbox=xref_bbox,
+            scene_index=scene_index
         )
         T_diffused, delta_T, time_in, (gt_ang_score, gt_lin_score), (gt_ang_score_ref, gt_lin_score_ref) = train_utils.diffuse_T_target(
             T_target=T_init, 
@@ -355,6 +374,10 @@ class DiffusionEdfTrainer():
         assert self.is_initialized, f"Trainer not initialized!"
         assert T_target.shape == (1,7), f"T_target.shape must be (1,7), but {T_target.shape} is given."
         
+        # Contact neighbors of the reference points are searched in the scene by every diffusion below.
+        # Rewrapped, as the scripted builder returns TorchScript's own copy of the SpatialIndex class, which beartype rejects.
+        scene_index = SpatialIndex(*build_spatial_index(points=scene_input.x, batch=scene_input.b, cell_size=float(self.contact_radius)))
+
         ########################################## Augmentation #########################################
         if self.t_augment is not None:
             T_target, _, __, ___, ____ = self.biequiv_diffusion(
@@ -365,6 +388,7 @@ class DiffusionEdfTrainer():
                 ang_mult=self.score_model.ang_mult,
                 lin_mult=self.score_model.lin_mult,
                 n_samples_x_ref=1,
+                scene_index=scene_index,
             )
         ##################################################################################################
 
@@ -388,7 +412,8 @@ class DiffusionEdfTrainer():
                 grasp_points=grasp_input,
                 ang_mult=self.score_model.ang_mult,
                 lin_mult=self.score_model.lin_mult,
-                n_samples_x_ref=self.n_samples_x_ref
+                n_samples_x_ref=self.n_samples_x_ref,
+                scene_index=scene_index
             )            
             
             (gt_ang_score_, gt_lin_score_), (gt_ang_score_ref_, gt_lin_score_ref_) = gt_score_, gt_score_ref_
@@ -80,6 +80,58 @@ def wigner_D(l: int, alpha: torch.Tensor, beta: torch.Tensor, gamma: torch.Tenso
     Xc = _z_rot_mat(gamma, l)
     return Xa @ J @ Xb @ J @ Xc
 
+def l2_basis(dtype: torch.dtype = torch.float32, device: Union[str, torch.device] = 'cpu') -> torch.Tensor:
+    r"""
+    Orthonormal basis (5, 3, 3) of the symmetric traceless matrices, ordered as the l=2 irrep (e3nn's wigner_3j(1, 1, 2) times sqrt(5)):
+    (xz+zx)/sqrt(2), (xy+yx)/sqrt(2), (2yy-xx-zz)/sqrt(6), (yz+zy)/sqrt(2), (zz-xx)/sqrt(2).
+    """
+    E = torch.zeros(5, 3, 3, dtype=torch.float64)
+    s2, s6 = 2 ** -0.5, 6 ** -0.5
+    E[0, 0, 2] = E[0, 2, 0] = s2
+    E[1, 0, 1] = E[1, 1, 0] = s2
+    E[2, 0, 0], E[2, 1, 1], E[2, 2, 2] = -s6, 2 * s6, -s6
+    E[3, 1, 2] = E[3, 2, 1] = s2
+    E[4, 0, 0], E[4, 2, 2] = -s2, s2
+    return E.to(dtype=dtype, device=device)
+
+def wigner_D1_from_matrix(R: torch.Tensor) -> torch.Tensor:
+    r"""
+    In the basis of wigner_D, the l=1 Wigner D matrix of a rotation is its rotation matrix. (Nt, 3, 3) -> (Nt, 3, 3)
+    """
+    return R
+
+def l2_coupling(dtype: torch.dtype = torch.float32, device: Union[str, torch.device] = 'cpu') -> torch.Tensor:
+    r"""
+    K (81, 25) such that the l=2 Wigner D matrix of R is (R_flat outer R_flat) @ K, with K[(a,c),(b,d)][(i,j)] = E_i[a,b] E_j[c,d] (E = l2_basis()).
+    """
+    E = l2_basis(dtype=torch.float64)
+    return torch.einsum('iab,jcd->acbdij', E, E).reshape(81, 25).to(dtype=dtype, device=device)
+
+def wigner_D2_from_matrix(R: torch.Tensor, K: torch.Tensor) -> torch.Tensor:
+    r"""
+    l=2 Wigner D matrix of rotation matrices, D[i,j] = <E_i, R E_j R^T> with E = l2_basis(), and K = l2_coupling(). (Nt, 3, 3) -> (Nt, 5, 5)
+    The entries are quadratic in R (quartic in the quaternion), computed as one matrix product with no trigonometric function.
+    """
+    R = R.reshape(-1, 9)
+    return torch.matmul((R.unsqueeze(-1) * R.unsqueeze(-2)).reshape(-1, 81), K).reshape(-1, 5, 5)
+
+def wigner_D_from_quaternion(l: int, q: torch.Tensor, J: torch.Tensor, K: Optional[torch.Tensor] = None) -> torch.Tensor:
+    r"""
+    Same as wigner_D at the Euler angles of the unit quaternions q (Nt, 4), but in closed form for l <= 2 (K = l2_coupling() for l = 2).
+    Higher l go through the Euler angles.
+    """
+    if l == 0:
+        return q.new_ones((len(q), 1, 1))
+    elif l == 1:
+        return wigner_D1_from_matrix(quaternion_to_matrix(q))
+    elif l == 2:
+        if K is None:
+            K = l2_coupling(dtype=q.dtype, device=q.device)
+        return wigner_D2_from_matrix(quaternion_to_matrix(q), K)
+    else:
+        angle = quat_to_angle_fast(standardize_quaternion(q))
+        return wigner_D(l, angle[0], angle[1], angle[2], J)
+
 def D_from_angles_(ls: List[int], muls: List[int], Js: List[torch.Tensor], alpha: torch.Tensor, beta: torch.Tensor, gamma: torch.Tensor) -> List[torch.Tensor]:
     Ds = []
     for l, mul, J in zip(ls, muls, Js):
@@ -229,7 +281,27 @@ class SliceAndTransform(torch.nn.Module):
         else:
             return transform_feature_slice_nonscalar(feature=sliced, alpha=alpha, beta=beta, gamma=gamma, l=self.l, J=self.J)
 
+    @torch.jit.export
+    def transform_into(self, feature: torch.Tensor, D: torch.Tensor, out: torch.Tensor):
+        """
+        Writes the slice of feature (N_Q, N_D) rotated by the Wigner D matrices D (N_T, 2l+1, 2l+1) into its slice of out (N_T, N_Q, N_D).
+        """
+        sliced = torch.narrow(feature, dim=-1, start=self.start, length=self.len)
+        out_sliced = torch.narrow(out, dim=-1, start=self.start, length=self.len)
+        if self.l == 0:
+            out_sliced.copy_(sliced)    # Broadcast over N_T
+        else:
+            nT, nQ = out_sliced.shape[0], out_sliced.shape[1]
+            rotated = torch.matmul(D, sliced.reshape(nQ*self.mul, self.dim).t())                    # (N_T, 2l+1, N_Q*mul)
+            out_sliced.view(nT, nQ, self.mul, self.dim).copy_(rotated.view(nT, self.dim, nQ, self.mul).permute(0, 2, 3, 1))  # (N_T, N_Q, mul, 2l+1)
+
 class TransformFeatureQuaternion(torch.nn.Module):
+    """
+    Rotates the features (N_Q, N_D) of irreps by every quaternion (N_T, 4), into (N_T, N_Q, N_D).
+    The blocks of the block-diagonal Wigner D matrices (one per l, see wigner_Ds) are built in forward, 
+    unless given as Ds, so that the consumers of the same poses (e.g., every chunk of a score evaluation) can share a single construction.
+    Every irrep is written into its slice of a single output tensor.
+    """
     dim: torch.jit.Final[int]
     lmax: torch.jit.Final[int]
     # __constants__ = ['Js']
@@ -243,6 +315,7 @@ class TransformFeatureQuaternion(torch.nn.Module):
                 raise NotImplementedError(f"E3 equivariance is not implemented! (input_irreps: {irreps})")
         self.dim = irreps.dim
         self.lmax = irreps.lmax
+        self.register_buffer("K", l2_coupling(), persistent=False)
         
         self.transforms = torch.nn.ModuleList()
         for (mul, l), (start, end) in zip(
@@ -252,9 +325,29 @@ class TransformFeatureQuaternion(torch.nn.Module):
             self.transforms.append(
                 SliceAndTransform(mul=mul, l=l, start=start, end=end, allow_zero_len=False)
             )
+
+    @torch.jit.export
+    def wigner_Ds(self, q: torch.Tensor) -> List[torch.Tensor]:
+        """
+        Blocks of the block-diagonal Wigner D matrices of the quaternions q (N_T, 4), one per l = 0, ..., lmax: [(N_T, 1, 1), (N_T, 3, 3), ...].
+        l <= 2 are built in closed form from the rotation matrices (see wigner_D_from_quaternion), higher l from the Euler angles.
+        Blocks of l > 2 that no irrep uses are left empty. Differentiable with respect to q.
+        """
+        q = q / torch.norm(q, dim=-1, keepdim=True)
+        R = quaternion_to_matrix(q)
+        Ds: List[torch.Tensor] = [q.new_ones((len(q), 1, 1)), wigner_D1_from_matrix(R)]
+        if self.lmax >= 2:
+            Ds.append(wigner_D2_from_matrix(R, self.K.to(dtype=R.dtype)))
+        if self.lmax > 2:
+            angle = quat_to_angle_fast(standardize_quaternion(q))
+            for _ in range(3, self.lmax+1):
+                Ds.append(q.new_empty(0))
+            for transform in self.transforms:
+                if transform.l > 2 and Ds[transform.l].numel() == 0:
+                    Ds[transform.l] = wigner_D(transform.l, angle[0], angle[1], angle[2], transform.J)
+        return Ds[:self.lmax+1]
         
-        
-    def forward(self, feature: torch.Tensor, q: torch.Tensor) -> torch.Tensor : # (N_Q, N_D) x (N_T, 4) -> (N_T, N_Q, N_D)
+    def forward(self, feature: torch.Tensor, q: torch.Tensor, Ds: Optional[List[torch.Tensor]] = None) -> torch.Tensor : # (N_Q, N_D) x (N_T, 4) -> (N_T, N_Q, N_D)
         assert q.ndim == 2 and q.shape[-1] == 4, f"{q.shape}" # (nT, 4)
         assert feature.ndim == 2 and feature.shape[-1] == self.dim, f"{feature.shape}" # (nQ, D)
 
@@ -265,22 +358,17 @@ class TransformFeatureQuaternion(torch.nn.Module):
             return feature.expand(len(q), -1, -1)
         
         # --------------------------------------------------- #
-        # Quaternion to Euler angles
+        # Wigner D blocks (one per l)
         # --------------------------------------------------- #
-        q = standardize_quaternion(q / torch.norm(q, dim=-1, keepdim=True))
-        angle = quat_to_angle_fast(q)
-        alpha, beta, gamma = angle[0], angle[1], angle[2]
+        if Ds is None:
+            Ds = self.wigner_Ds(q)
+        assert len(Ds) > self.lmax, f"{len(Ds)} <= {self.lmax}"
         
         # --------------------------------------------------- #
-        # Quaternion to Euler angles
+        # Rotate the irreps into their slices of the output
         # --------------------------------------------------- #
-        feature_transformed = []
+        out = feature.new_empty((len(q), len(feature), self.dim))
         for transform in self.transforms:
-            feature_transformed.append(
-                transform(feature=feature, alpha=alpha, beta=beta, gamma=gamma)
-            )
+            transform.transform_into(feature=feature, D=Ds[transform.l], out=out)
         
-        return torch.cat(feature_transformed, dim=-1)
-
-
-
+        return out